@@ -0,0 +1,148 @@
+import argparse
+import json
+import os
+import time
+from ast import literal_eval
+
+from p2p_di.client.rfc_client import RFC_Index
+from p2p_di.utils import codec
+from p2p_di.utils.message import (Message, MessageType, MethodType,
+                                  StatusCodes, WireFormat)
+
+# Round-trip check and throughput comparison of the legacy text format
+# against the binary codec
+#
+# usage: python -m benchmarks.codec_bench [--iterations N] [--peers N] [--json FILE]
+
+
+def sample_messages(peer_count: int) -> dict:
+    base_path = os.path.dirname(__file__)
+    rfcs = sorted(os.listdir(os.path.join(base_path, '..', 'rfc_store')))
+    peers = ['10.0.{}.{}:{}'.format(i // 256, i % 256, 40000 + i)
+             for i in range(peer_count)]
+
+    keep_alive = Message(MessageType.REQUEST_SERVER)
+    keep_alive.method = MethodType.KEEP_ALIVE.name
+    keep_alive.headers['hostname'] = '10.0.0.1'
+    keep_alive.headers['cookie'] = 'c' * 32
+
+    pquery = Message(MessageType.SERVER_RESPONSE)
+    pquery.headers['hostname'] = '10.0.0.1'
+    pquery.status_code = StatusCodes.SUCCESS.value
+    pquery.data = peers
+
+    owners = [{peer.split(':')[0]: int(peer.split(':')[1])
+               for peer in peers[i:i + 3]} for i in range(peer_count)]
+    index = RFC_Index.from_dict(
+        {rfc: owners[i % peer_count] for i, rfc in enumerate(rfcs)})
+    rfc_query = Message(MessageType.PEER_RESPONSE)
+    rfc_query.headers['hostname'] = '10.0.0.1'
+    rfc_query.status_code = StatusCodes.SUCCESS.value
+    rfc_query.data = index.to_dict()
+
+    return {'keep_alive': keep_alive, 'pquery': pquery, 'rfc_query': rfc_query}
+
+# legacy messages carry their data as a string, the way the servers built them
+
+
+def legacy_round_trip(message: Message):
+    legacy = Message(MessageType[message.message_type])
+    legacy.headers = message.headers
+    legacy.method = message.method
+    legacy.status_code = message.status_code
+    legacy.wire_format = WireFormat.LEGACY
+    legacy.data = str(message.data) if message.data is not None else None
+    encoded = legacy.to_bytes()
+    decoded = Message.bytes_to_dict(encoded)
+    if 'data' in decoded:
+        decoded['data'] = literal_eval(decoded['data'])
+    return encoded, decoded
+
+
+def binary_round_trip(message: Message):
+    message.wire_format = WireFormat.BINARY
+    encoded = message.to_bytes()
+    return encoded, Message.bytes_to_dict(encoded)
+
+
+def payload_round_trip(data, wire_format: WireFormat):
+    if wire_format == WireFormat.BINARY:
+        encoded = codec.encode_value(data)
+        return encoded, codec.decode_value(memoryview(encoded), 0)[0]
+    encoded = str(data).encode('utf-8')
+    return encoded, literal_eval(str(encoded, 'utf-8'))
+
+
+def expected_dict(message: Message) -> dict:
+    expected = dict(message.headers)
+    expected['message_type'] = message.message_type
+    expected['method'] = message.method
+    expected['status_code'] = message.status_code
+    expected['data'] = message.data
+    return {k: v for k, v in expected.items() if v not in ('', None)}
+
+
+def time_it(function, iterations: int) -> float:
+    start = time.perf_counter()
+    for _ in range(iterations):
+        function()
+    return (time.perf_counter() - start) / iterations
+
+
+def run(iterations: int, peer_count: int) -> dict:
+    results = {}
+    for name, message in sample_messages(peer_count).items():
+        result = {}
+        for format_name, round_trip in (('legacy', legacy_round_trip), ('binary', binary_round_trip)):
+            try:
+                encoded, decoded = round_trip(message)
+                if decoded != expected_dict(message):
+                    raise AssertionError('round trip changed the message')
+            except Exception as e:
+                result[format_name] = {'error': '{}: {}'.format(
+                    type(e).__name__, e)}
+                continue
+            seconds = time_it(lambda: round_trip(message), iterations)
+            result[format_name] = {'bytes': len(encoded),
+                                   'us_per_round_trip': seconds * 1e6,
+                                   'round_trips_per_s': 1 / seconds}
+        if message.data is not None:
+            # data section alone, as the legacy clients parsed it with eval
+            for wire_format in WireFormat:
+                encoded, decoded = payload_round_trip(
+                    message.data, wire_format)
+                assert decoded == message.data
+                seconds = time_it(lambda: payload_round_trip(
+                    message.data, wire_format), iterations)
+                result['{}_payload'.format(wire_format.name.lower())] = {
+                    'bytes': len(encoded), 'us_per_round_trip': seconds * 1e6,
+                    'round_trips_per_s': 1 / seconds}
+        results[name] = result
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Compare the legacy and binary message formats')
+    parser.add_argument('--iterations', type=int, default=200)
+    parser.add_argument('--peers', type=int, default=1000,
+                        help='peers in the PQUERY response')
+    parser.add_argument('--json', help='also write results to this file')
+    args = parser.parse_args()
+
+    results = run(args.iterations, args.peers)
+    for name, result in results.items():
+        print(name)
+        for variant, numbers in result.items():
+            if 'error' in numbers:
+                print('  {:<16} failed - {}'.format(variant, numbers['error']))
+            else:
+                print('  {:<16} {:>9} bytes {:>12.1f} us {:>12.0f} /s'.format(
+                    variant, numbers['bytes'], numbers['us_per_round_trip'], numbers['round_trips_per_s']))
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,506 @@
+import argparse
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from queue import Empty, Queue
+from struct import Struct
+from threading import Event, Lock, Thread
+from uuid import uuid4
+
+from p2p_di.utils.message import Message, MessageType, MethodType, StatusCodes
+from p2p_di.utils.utils import (DEFAULT_RS_PORT, DEFAULT_TTL, HOST_ENV,
+                                PEER_STORE_SQLITE, PEER_STORES, RS_PORT_ENV,
+                                SERVING_MODES, Peer_Entry, receive, send)
+
+# Load test of the registration server
+#
+# Starts an rs in a subprocess on loopback and drives it with simulated
+# peers: every peer registers, then keep alives and peer queries are sent
+# at fixed rates while some peers leave and register again. Requests are
+# scheduled ahead of time and their latency counts from the scheduled
+# time, so an rs that falls behind shows up as latency instead of as a
+# lower request rate; the service time counts from when the request was
+# sent, a large gap between the two means the senders fell behind. The
+# rs's cpu and memory are read from /proc.
+#
+# The expiry scenario registers a large population with a short ttl and
+# keeps only some of it alive, so the rs's update_loop expires thousands
+# of peers while the load runs.
+#
+# The rs runs in assets/rs with clean=True, it replaces the peer list of
+# any rs run from this tree before.
+#
+# --restore times a warm restart instead: --peers peers are written to a
+# peer store in a temporary directory, then read back by the rs's
+# load_peers as on a start with clean=False.
+#
+# usage: python -m benchmarks.rs_bench [--scenario steady|expiry] [--peers N]
+#        [--duration S] [--keep-alive-rate N] [--pquery-rate N]
+#        [--leave-rate N] [--json FILE]
+#        python -m benchmarks.rs_bench --restore [--peers N] [--peer-store S]
+
+SCENARIOS = {
+    'steady': {'peers': 1000, 'duration': 30, 'keep_alive_rate': 500, 'pquery_rate': 50,
+               'leave_rate': 5, 'ttl': 7200, 'live_fraction': 1.0},
+    # the peers that are not kept alive expire while the load runs, the
+    # others send a keep alive every 2 seconds on average
+    'expiry': {'peers': 20000, 'duration': 40, 'keep_alive_rate': 1000, 'pquery_rate': 20,
+               'leave_rate': 5, 'ttl': 20, 'live_fraction': 0.1},
+}
+# connections are closed with a reset, so a long run does not leave tens of
+# thousands of loopback ports in TIME_WAIT
+LINGER_RESET = Struct('ii').pack(1, 0)
+SAMPLE_INTERVAL = 1
+
+
+def request(address, message: Message, timeout: float) -> dict:
+    with socket.create_connection(address, timeout) as conn:
+        conn.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, LINGER_RESET)
+        send(conn, message.to_bytes())
+        return Message.bytes_to_dict(receive(conn))
+
+
+def rs_message(method: MethodType, cookie: str = None, data=None) -> Message:
+    message = Message(MessageType.REQUEST_SERVER)
+    message.method = method.name
+    message.headers['hostname'] = '127.0.0.1'
+    if cookie:
+        message.headers['cookie'] = cookie
+    message.data = data
+    return message
+
+
+# a simulated peer, it never listens on its port
+class Peer():
+
+    def __init__(self, number: int) -> None:
+        self.name = 'bench_{}'.format(number)
+        self.port = 1024 + number % 64000
+        self.cookie: str = None
+        # set while a LEAVE and the REGISTER after it are in flight, and
+        # keep alives are skipped
+        self.busy = False
+
+
+class Recorder():
+
+    def __init__(self) -> None:
+        self.lock = Lock()
+        # operation -> [latency], from the time the request was scheduled
+        self.latencies = {}
+        # operation -> [service time], from the time it was sent
+        self.service_times = {}
+        # operation -> {error: count}
+        self.errors = {}
+
+    def add(self, operation: str, latency: float, service_time: float, error: str = None) -> None:
+        with self.lock:
+            self.latencies.setdefault(operation, []).append(latency)
+            self.service_times.setdefault(
+                operation, []).append(service_time)
+            if error != None:
+                errors = self.errors.setdefault(operation, {})
+                errors[error] = errors.get(error, 0) + 1
+
+    def summary(self, seconds: float) -> dict:
+        results = {}
+        with self.lock:
+            for operation, latencies in sorted(self.latencies.items()):
+                errors = self.errors.get(operation, {})
+                error_count = sum(errors.values())
+                results[operation] = {
+                    'count': len(latencies), 'errors': error_count,
+                    'error_rate': error_count / len(latencies),
+                    'error_kinds': errors,
+                    'throughput': len(latencies) / seconds,
+                    'latency_ms': percentiles(latencies),
+                    'service_ms': percentiles(self.service_times[operation])}
+        return results
+
+
+# @param scale multiplies every value, the default turns seconds into ms
+def percentiles(values: list, scale: float = 1e3) -> dict:
+    values = sorted(values)
+    if not values:
+        return {}
+
+    def at(q):
+        return round(values[min(len(values) - 1, int(q * len(values)))] * scale, 3)
+    return {'p50': at(0.5), 'p90': at(0.9), 'p99': at(0.99), 'p999': at(0.999),
+            'max': round(values[-1] * scale, 3), 'mean': round(sum(values) / len(values) * scale, 3)}
+
+
+# sends a request and records it, returns the response dict or None if
+# none came
+def timed(recorder: Recorder, operation: str, address, message: Message, scheduled: float,
+          timeout: float) -> dict:
+    error = None
+    response = None
+    sent = time.perf_counter()
+    try:
+        response = request(address, message, timeout)
+        if response.get('status_code') != StatusCodes.SUCCESS.value:
+            error = 'status {}'.format(response.get('status_code'))
+    except Exception as e:
+        error = type(e).__name__
+    now = time.perf_counter()
+    recorder.add(operation, now - scheduled, now - sent, error)
+    return response
+
+
+def register(peer: Peer, recorder: Recorder, address, scheduled: float, timeout: float,
+             operation='REGISTER') -> None:
+    response = timed(recorder, operation, address, rs_message(
+        MethodType.REGISTER, peer.cookie, {'name': peer.name, 'hostname': '127.0.0.1',
+                                           'port': peer.port}), scheduled, timeout)
+    if response != None and response.get('status_code') == StatusCodes.SUCCESS.value:
+        peer.cookie = response['data']['cookie']
+
+
+# registers every peer with workers threads, returns the seconds it took
+def register_all(peers: list, recorder: Recorder, address, workers: int, timeout: float) -> float:
+    queue = Queue()
+    for peer in peers:
+        queue.put(peer)
+
+    def worker():
+        while True:
+            try:
+                peer = queue.get_nowait()
+            except Empty:
+                return
+            register(peer, recorder, address, time.perf_counter(), timeout)
+    start = time.perf_counter()
+    threads = [Thread(target=worker) for _ in range(workers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - start
+
+
+# runs the keep alive, peer query and leave mix for duration seconds
+# arrivals of each operation are a poisson process at its rate
+# peers with a LEAVE in flight are skipped
+def run_load(live: list, recorder: Recorder, address, args) -> float:
+    queue = Queue()
+    rates = [('KEEP_ALIVE', args.keep_alive_rate), ('PQUERY', args.pquery_rate),
+             ('LEAVE', args.leave_rate)]
+    rates = [(operation, rate) for operation, rate in rates if rate > 0]
+    total_rate = sum(rate for _, rate in rates)
+    pquery_options = {'sample': args.pquery_sample} if args.pquery_sample else None
+
+    def worker():
+        while True:
+            work = queue.get()
+            if work == None:
+                return
+            operation, peer, scheduled = work
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            if operation == 'KEEP_ALIVE':
+                response = timed(recorder, operation, address, rs_message(
+                    MethodType.KEEP_ALIVE, peer.cookie), scheduled, args.timeout)
+                # an expired peer registers again, as a client would
+                if response != None and response.get('status_code') != StatusCodes.SUCCESS.value:
+                    register(peer, recorder, address, time.perf_counter(),
+                             args.timeout, 'REGISTER_AGAIN')
+            elif operation == 'PQUERY':
+                timed(recorder, operation, address, rs_message(
+                    MethodType.PQUERY, peer.cookie, pquery_options), scheduled, args.timeout)
+            else:
+                timed(recorder, operation, address, rs_message(
+                    MethodType.LEAVE, peer.cookie), scheduled, args.timeout)
+                register(peer, recorder, address, time.perf_counter(),
+                         args.timeout, 'REGISTER_AGAIN')
+                peer.busy = False
+
+    threads = [Thread(target=worker, daemon=True)
+               for _ in range(args.workers)]
+    for thread in threads:
+        thread.start()
+    start = time.perf_counter()
+    end = start + args.duration
+    scheduled = start
+    random_source = random.Random(args.seed)
+    # the scheduler keeps about a second of work queued ahead of time
+    while True:
+        scheduled += random_source.expovariate(total_rate)
+        if scheduled >= end:
+            break
+        pick = random_source.uniform(0, total_rate)
+        for operation, rate in rates:
+            pick -= rate
+            if pick <= 0:
+                break
+        peer = random_source.choice(live)
+        if peer.busy:
+            continue
+        if operation == 'LEAVE':
+            peer.busy = True
+        queue.put((operation, peer, scheduled))
+        ahead = scheduled - time.perf_counter()
+        if ahead > 1:
+            time.sleep(ahead - 1)
+    for _ in threads:
+        queue.put(None)
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - start
+
+
+# cpu seconds and resident bytes of a process, None when /proc is missing
+def process_usage(pid: int) -> tuple:
+    try:
+        with open('/proc/{}/stat'.format(pid)) as file:
+            fields = file.read().rsplit(')', 1)[1].split()
+        with open('/proc/{}/status'.format(pid)) as file:
+            status = dict(line.split(':', 1) for line in file if ':' in line)
+    except OSError:
+        return None
+    cpu = (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+    rss = int(status['VmRSS'].split()[0]) * 1024
+    peak = int(status.get('VmHWM', status['VmRSS']).split()[0]) * 1024
+    return cpu, rss, peak
+
+
+# samples the rs every SAMPLE_INTERVAL seconds until stopped
+class Monitor(Thread):
+
+    def __init__(self, pid: int, address, timeout: float) -> None:
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.address = address
+        self.timeout = timeout
+        self.stopped = Event()
+        self.start_time = time.perf_counter()
+        # {'t', 'cpu_percent', 'rss', 'active_peers'}
+        self.samples = []
+
+    def run(self) -> None:
+        last = (time.perf_counter(), process_usage(self.pid))
+        while not self.stopped.wait(SAMPLE_INTERVAL):
+            now, usage = time.perf_counter(), process_usage(self.pid)
+            sample = {'t': round(now - self.start_time, 3)}
+            if usage != None and last[1] != None:
+                sample['cpu_percent'] = round(
+                    (usage[0] - last[1][0]) / (now - last[0]) * 100, 1)
+                sample['rss'] = usage[1]
+            sample['active_peers'] = rs_gauges(
+                self.address, self.timeout).get('active_peers')
+            self.samples.append(sample)
+            last = (now, usage)
+
+    def summary(self) -> dict:
+        usage = process_usage(self.pid)
+        cpu = [sample['cpu_percent']
+               for sample in self.samples if 'cpu_percent' in sample]
+        result = {'cpu_percent_mean': round(sum(cpu) / len(cpu), 1) if cpu else None,
+                  'cpu_percent_max': max(cpu) if cpu else None}
+        if usage != None:
+            result.update({'cpu_seconds': round(usage[0], 3), 'rss_bytes': usage[1],
+                           'rss_peak_bytes': usage[2]})
+        return result
+
+
+def rs_stats(address, timeout: float) -> dict:
+    try:
+        response = request(address, rs_message(MethodType.STATS), timeout)
+        return response.get('data') or {}
+    except Exception:
+        return {}
+
+
+def rs_gauges(address, timeout: float) -> dict:
+    return rs_stats(address, timeout).get('gauges', {})
+
+
+# starts an rs in a subprocess on loopback and waits until it listens
+def start_rs(port: int, mode='threaded', peer_store='tinydb', ttl=DEFAULT_TTL,
+             backlog: int = None) -> subprocess.Popen:
+    env = dict(os.environ)
+    env[HOST_ENV] = '127.0.0.1'
+    env[RS_PORT_ENV] = str(port)
+    command = [sys.executable, '-m', 'benchmarks.rs_bench', '--serve', '--mode', mode,
+               '--peer-store', peer_store, '--ttl', str(ttl)]
+    if backlog != None:
+        command += ['--backlog', str(backlog)]
+    root = os.path.join(os.path.dirname(__file__), '..')
+    rs = subprocess.Popen(command, cwd=root, env=env,
+                          stdout=subprocess.DEVNULL)
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        if rs.poll() != None:
+            raise RuntimeError('rs exited with {}'.format(rs.returncode))
+        try:
+            socket.create_connection(('127.0.0.1', port), 1).close()
+            return rs
+        except OSError:
+            time.sleep(0.1)
+    rs.kill()
+    raise RuntimeError('rs did not start listening')
+
+
+# entry point of the rs subprocess
+def serve(args) -> None:
+    from p2p_di.server.rs import RegistrationServer
+    RegistrationServer(peer_store=args.peer_store, ttl=args.ttl,
+                       mode=args.mode, backlog=args.backlog)
+
+
+# writes peers the way the rs does and times reading them back
+def restore(args) -> dict:
+    from p2p_di.server.peer_store import (SQLite_Peer_Store,
+                                          TinyDB_Peer_Store,
+                                          Write_Behind_Store)
+    from p2p_di.server.rs import RegistrationServer
+    store_class = SQLite_Peer_Store if args.peer_store == PEER_STORE_SQLITE else TinyDB_Peer_Store
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'peer_list')
+        start = time.perf_counter()
+        peers_db = Write_Behind_Store(
+            store_class(path), flush_threshold=args.peers + 1)
+        for i in range(args.peers):
+            peers_db.insert(Peer_Entry(uuid4().hex, 'bench_{}'.format(i), '127.0.0.1',
+                                       1024 + i % 64000).to_dict())
+        peers_db.close()
+        write_seconds = time.perf_counter() - start
+
+        # only what load_peers needs, without starting the rs
+        rs = RegistrationServer.__new__(RegistrationServer)
+        rs.ttl = args.ttl
+        start = time.perf_counter()
+        rs.peers_db = Write_Behind_Store(store_class(path))
+        rs.load_peers()
+        restore_seconds = time.perf_counter() - start
+        restored = len(rs.peers)
+        rs.peers_db.close()
+    return {'config': {'peers': args.peers, 'peer_store': args.peer_store, 'revision': git_revision()},
+            'write_seconds': round(write_seconds, 3), 'restore_seconds': round(restore_seconds, 3),
+            'restored_peers': restored}
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(__file__), timeout=10).stdout.strip() or None
+    except Exception:
+        return None
+
+
+def run(args) -> dict:
+    address = ('127.0.0.1', args.port)
+    rs = start_rs(args.port, args.mode, args.peer_store,
+                  args.ttl, args.backlog)
+    try:
+        monitor = Monitor(rs.pid, address, args.timeout)
+        monitor.start()
+        peers = [Peer(i) for i in range(args.peers)]
+        register_recorder = Recorder()
+        register_seconds = register_all(
+            peers, register_recorder, address, args.workers, args.timeout)
+        registered = [peer for peer in peers if peer.cookie]
+        random.Random(args.seed).shuffle(registered)
+        live = registered[:max(1, int(len(registered) * args.live_fraction))]
+        load_recorder = Recorder()
+        load_seconds = run_load(live, load_recorder, address, args)
+        monitor.stopped.set()
+        monitor.join()
+        stats = rs_stats(address, args.timeout)
+        return {
+            'config': dict({option: value for option, value in vars(args).items() if option != 'serve'},
+                           revision=git_revision()),
+            'register': dict(register_recorder.summary(register_seconds)['REGISTER'],
+                             seconds=round(register_seconds, 3)),
+            'load': {'seconds': round(load_seconds, 3),
+                     'operations': load_recorder.summary(load_seconds)},
+            'rs': dict(monitor.summary(), gauges=stats.get('gauges')),
+            'rs_stats': stats,
+            'timeline': monitor.samples,
+        }
+    finally:
+        rs.terminate()
+        try:
+            rs.wait(10)
+        except subprocess.TimeoutExpired:
+            rs.kill()
+
+
+def print_results(results: dict) -> None:
+    rows = [('REGISTER (all)', results['register'])] + \
+        list(results['load']['operations'].items())
+    for operation, numbers in rows:
+        print('{:<15} {:>7} reqs {:>8.1f} /s  p50 {:>9.3f} ms  p99 {:>9.3f} ms  service p99 {:>9.3f} ms  '
+              'errors {}'.format(operation, numbers['count'], numbers['throughput'],
+                                 numbers['latency_ms']['p50'], numbers['latency_ms']['p99'],
+                                 numbers['service_ms']['p99'], numbers['errors']))
+    rs = results['rs']
+    print('rs cpu {}% mean, {}% max, rss peak {} bytes, active peers {}'.format(
+        rs['cpu_percent_mean'], rs['cpu_percent_max'], rs.get('rss_peak_bytes'),
+        (rs.get('gauges') or {}).get('active_peers')))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Load test the registration server on loopback')
+    parser.add_argument('--scenario', choices=sorted(SCENARIOS), default='steady',
+                        help='defaults for the options below')
+    parser.add_argument('--peers', type=int, help='simulated peers')
+    parser.add_argument('--duration', type=float,
+                        help='seconds of keep alive / query load')
+    parser.add_argument('--keep-alive-rate', type=float,
+                        help='keep alives per second')
+    parser.add_argument('--pquery-rate', type=float,
+                        help='peer queries per second')
+    parser.add_argument('--leave-rate', type=float,
+                        help='peers leaving and registering again per second')
+    parser.add_argument('--ttl', type=float, help='rs peer ttl in seconds')
+    parser.add_argument('--live-fraction', type=float,
+                        help='share of the peers that keep sending requests after registering')
+    parser.add_argument('--pquery-sample', type=int, default=50,
+                        help='peers asked for per query, 0 for the full list')
+    parser.add_argument('--workers', type=int, default=64,
+                        help='threads sending requests')
+    parser.add_argument('--timeout', type=float, default=10)
+    parser.add_argument('--mode', choices=SERVING_MODES, default='threaded',
+                        help='rs serving mode')
+    parser.add_argument('--backlog', type=int,
+                        help='rs listen backlog, defaults to the mode\'s')
+    parser.add_argument('--peer-store', choices=PEER_STORES,
+                        default='tinydb')
+    parser.add_argument('--port', type=int, default=DEFAULT_RS_PORT)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help='also write results to this file')
+    parser.add_argument('--restore', action='store_true',
+                        help='time restoring --peers stored peers instead of running load')
+    parser.add_argument('--serve', action='store_true',
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    for option, value in SCENARIOS[args.scenario].items():
+        if getattr(args, option) == None:
+            setattr(args, option, value)
+
+    if args.serve:
+        serve(args)
+        return
+    if args.restore:
+        results = restore(args)
+        print('{} peers ({}) written in {:.3f} s, restored {} in {:.3f} s'.format(
+            args.peers, args.peer_store, results['write_seconds'], results['restored_peers'],
+            results['restore_seconds']))
+    else:
+        results = run(args)
+        print_results(results)
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,245 @@
+import argparse
+import json
+import os
+import random
+import tempfile
+import time
+from threading import Lock, Thread
+
+from benchmarks.rs_bench import git_revision, percentiles, start_rs
+from p2p_di.utils.utils import HOST_ENV, RS_PORT_ENV, SERVING_MODES, get_rs_address
+
+# Replication of a set of rfcs across a swarm of peers
+#
+# Starts an rs in a subprocess and peers (Client with its RFC_Server) in
+# this process, all on loopback. Peers are known by host, so every peer
+# gets an address of its own, 127.0.0.2 and up; the rs is on 127.0.0.1.
+# The seeds start with the rfcs, each rfc on replicas of them; every other
+# peer fetches every rfc with get_rfc, which finds the owners with find_peers_with_rfc and downloads from all of
+# them, so peers that finished an rfc serve it to the rest. Reports the
+# time until every peer has every rfc, the throughput of each transfer,
+# the cost of the index lookups and the bytes sent, from the STATS of every
+# server.
+#
+# Peers keep their files in assets/peer/<name>, the rs runs in assets/rs
+# with clean=True.
+#
+# usage: python -m benchmarks.swarm_bench [--peers N] [--seeds N]
+#        [--files N | --rfcs NAME ...] [--replicas N] [--upload-rate B]
+#        [--json FILE]
+
+
+def pick_rfcs(args) -> list:
+    store = os.path.join(os.path.dirname(__file__), '..', 'rfc_store')
+    if args.rfcs:
+        missing = [rfc for rfc in args.rfcs
+                   if not os.path.isfile(os.path.join(store, rfc))]
+        if missing:
+            raise ValueError('Not in rfc_store: {}'.format(missing))
+        return list(args.rfcs)
+    return sorted(os.listdir(store))[:args.files]
+
+
+def rfc_size(rfc: str) -> int:
+    return os.path.getsize(os.path.join(os.path.dirname(__file__), '..', 'rfc_store', rfc))
+
+
+# rfcs each seed starts with, every rfc on replicas seeds
+def seed_lists(rfcs: list, seeds: int, replicas: int) -> list:
+    lists = [[] for _ in range(seeds)]
+    for i, rfc in enumerate(rfcs):
+        for replica in range(min(replicas, seeds)):
+            lists[(i + replica) % seeds].append(rfc)
+    return lists
+
+
+# a Client on its own loopback address, servers take their host from
+# HOST_ENV when they are created
+def new_peer(Client, i: int, name: str, rfcs_owned_list: str = None, **server_options):
+    os.environ[HOST_ENV] = '127.0.0.{}'.format(i + 2)
+    return Client(name, rfcs_owned_list, **server_options)
+
+
+# times find_peers_with_rfc of one client; get_rfc calls it through the
+# instance, so each lookup it makes is timed too
+class Timed_Lookups():
+
+    def __init__(self, client) -> None:
+        self.find_peers_with_rfc = client.find_peers_with_rfc
+        self.last = 0.0
+        client.find_peers_with_rfc = self
+
+    def __call__(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return self.find_peers_with_rfc(*args, **kwargs)
+        finally:
+            self.last = time.perf_counter() - start
+
+
+class Results():
+
+    def __init__(self) -> None:
+        self.lock = Lock()
+        # {'rfc', 'size', 'seconds', 'lookup_seconds', 'ok'}
+        self.transfers = []
+        # peer name -> seconds until it had every rfc, None if it failed
+        self.completions = {}
+
+    def add_transfer(self, transfer: dict) -> None:
+        with self.lock:
+            self.transfers.append(transfer)
+
+
+# fetches every rfc in a random order
+def leech(client, lookups: Timed_Lookups, rfcs: list, results: Results, start: float,
+          random_source: random.Random) -> None:
+    order = list(rfcs)
+    random_source.shuffle(order)
+    complete = True
+    for rfc in order:
+        began = time.perf_counter()
+        lookups.last = 0.0
+        ok = client.get_rfc(rfc)
+        seconds = time.perf_counter() - began
+        results.add_transfer({'rfc': rfc, 'size': rfc_size(rfc), 'seconds': seconds,
+                              'lookup_seconds': lookups.last, 'ok': ok})
+        complete = complete and ok
+    results.completions[client.name] = time.perf_counter() - start if complete else None
+
+
+# adds up the request metrics of every rfc server, per method
+def peer_traffic(clients: list) -> dict:
+    methods = {}
+    for client in clients:
+        for method, numbers in client.rfc_server.stats()['methods'].items():
+            total = methods.setdefault(
+                method, {'count': 0, 'errors': 0, 'bytes_in': 0, 'bytes_out': 0})
+            for key in total:
+                total[key] += numbers[key]
+    return methods
+
+
+def run(args) -> dict:
+    from p2p_di.client.rfc_client import Client
+
+    rfcs = pick_rfcs(args)
+    rs = start_rs(args.port, args.mode)
+    # resolved once, before the host changes for every peer
+    get_rs_address()
+    try:
+        list_dir = tempfile.mkdtemp(prefix='swarm_bench_')
+        server_options = {'mode': args.mode}
+        if args.upload_rate:
+            server_options['upload_rate'] = args.upload_rate
+        seeds = []
+        for i, owned in enumerate(seed_lists(rfcs, args.seeds, args.replicas)):
+            list_path = os.path.join(list_dir, 'seed_{}.txt'.format(i))
+            with open(list_path, 'w') as file:
+                file.write('\n'.join(owned))
+            seeds.append(new_peer(Client, i, 'seed_{}'.format(i), list_path, **server_options))
+        leechers = [new_peer(Client, args.seeds + i, 'leecher_{}'.format(i), **server_options)
+                    for i in range(args.peers - args.seeds)]
+        for client in seeds + leechers:
+            client.register()
+        results = Results()
+        random_source = random.Random(args.seed)
+        lookups = [Timed_Lookups(client) for client in leechers]
+        start = time.perf_counter()
+        threads = [Thread(target=leech, args=(client, client_lookups, rfcs, results, start,
+                                              random.Random(random_source.random())))
+                   for client, client_lookups in zip(leechers, lookups)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        replication_seconds = time.perf_counter() - start
+
+        transfers = [transfer for transfer in results.transfers if transfer['ok']]
+        # what the leechers got, failed transfers delivered nothing
+        payload = sum(transfer['size'] for transfer in transfers)
+        traffic = peer_traffic(seeds + leechers)
+        rs_stats = seeds[0].request_stats() or {}
+        completions = [seconds for seconds in results.completions.values()
+                       if seconds != None]
+        sent = sum(numbers['bytes_out'] for numbers in traffic.values())
+        return {
+            'config': dict(vars(args), rfcs=rfcs, revision=git_revision()),
+            'replication': {
+                'seconds': round(replication_seconds, 3),
+                'complete_peers': len(completions), 'peers': len(leechers),
+                'peer_completion_s': percentiles(completions, 1),
+                'payload_bytes': payload,
+                'goodput_mb_s': round(payload / replication_seconds / 1e6, 3)},
+            'transfers': {
+                'count': len(results.transfers),
+                'failed': len(results.transfers) - len(transfers),
+                'throughput_mb_s': percentiles(
+                    [transfer['size'] / max(1e-9, transfer['seconds'] - transfer['lookup_seconds'])
+                     for transfer in transfers], 1e-6),
+                'ms': percentiles([transfer['seconds'] for transfer in transfers])},
+            'index_queries': {
+                'lookup_ms': percentiles([transfer['lookup_seconds'] for transfer in transfers]),
+                'rfc_query': traffic.get('RFC_QUERY'),
+                'rs': {method: {key: numbers[key] for key in ('count', 'bytes_in', 'bytes_out')}
+                       for method, numbers in rs_stats.get('methods', {}).items()}},
+            'wire': {'peer_methods': traffic, 'peer_bytes_sent': sent,
+                     'overhead': round(sent / payload, 4) if payload else None},
+        }
+    finally:
+        rs.terminate()
+        rs.wait(10)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Measure how fast rfcs replicate across a swarm of peers on loopback')
+    parser.add_argument('--peers', type=int, default=8,
+                        help='peers, seeds included')
+    parser.add_argument('--seeds', type=int, default=2,
+                        help='peers that start with the rfcs')
+    parser.add_argument('--files', type=int, default=20,
+                        help='first N rfcs of rfc_store')
+    parser.add_argument('--rfcs', nargs='+',
+                        help='rfcs of rfc_store to use instead of --files')
+    parser.add_argument('--replicas', type=int, default=1,
+                        help='seeds each rfc starts on')
+    parser.add_argument('--upload-rate', type=int,
+                        help='upload cap of every peer in bytes per second')
+    parser.add_argument('--mode', choices=SERVING_MODES, default='threaded',
+                        help='serving mode of the rs and the rfc servers')
+    parser.add_argument('--port', type=int, default=64998, help='rs port')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help='also write results to this file')
+    args = parser.parse_args()
+    if not 0 < args.seeds < args.peers:
+        parser.error('need at least one seed and one other peer')
+    if args.peers > 253:
+        parser.error('at most 253 peers, one per loopback address')
+    # the rs address, read by every peer
+    os.environ[HOST_ENV] = '127.0.0.1'
+    os.environ[RS_PORT_ENV] = str(args.port)
+
+    results = run(args)
+    replication = results['replication']
+    print('replicated {} rfcs to {}/{} peers in {:.3f} s, {:.3f} MB/s of payload'.format(
+        len(results['config']['rfcs']), replication['complete_peers'], replication['peers'],
+        replication['seconds'], replication['goodput_mb_s']))
+    transfers = results['transfers']
+    print('transfers {} ({} failed), throughput p50 {} MB/s p99 {} MB/s'.format(
+        transfers['count'], transfers['failed'], transfers['throughput_mb_s'].get('p50'),
+        transfers['throughput_mb_s'].get('p99')))
+    lookups = results['index_queries']
+    print('lookups p50 {} ms p99 {} ms, {} RFC_QUERY requests'.format(
+        lookups['lookup_ms'].get('p50'), lookups['lookup_ms'].get('p99'),
+        (lookups['rfc_query'] or {}).get('count')))
+    wire = results['wire']
+    print('peers sent {} bytes for {} bytes of payload ({}x)'.format(
+        wire['peer_bytes_sent'], replication['payload_bytes'], wire['overhead']))
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
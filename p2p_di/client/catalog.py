@@ -0,0 +1,160 @@
+import os
+import re
+from threading import Lock
+from typing import Dict, List
+
+# Metadata of a peer's rfcs
+#
+# The header of every rfc is parsed once, when it is loaded or downloaded,
+# into a row of FIELDS. Text rfcs give number, title, date, category and
+# the rfcs they obsolete or update; other formats only give what the file
+# name and size tell. CATALOG requests filter these rows and return only
+# the fields asked for, so peers can browse and plan downloads without
+# fetching any rfc.
+
+FIELDS = ('rfc', 'number', 'title', 'date', 'category',
+          'obsoletes', 'updates', 'size')
+# fields holding lists, a filter on them matches rfcs whose list contains
+# the value
+LIST_FIELDS = ('obsoletes', 'updates')
+# bytes read from the start of an rfc to find its header
+HEADER_SIZE = 4096
+
+HEADER_FIELD = re.compile(
+    r'^(Request for Comments|Obsoletes|Updates|Category):\s*(.*)$', re.IGNORECASE)
+MONTHS = ('January', 'February', 'March', 'April', 'May', 'June', 'July', 'August', 'September',
+          'October', 'November', 'December')
+DATE = re.compile(r'\b({})\s+(?:\d{{1,2}},?\s+)?(\d{{4}})\b'.format('|'.join(MONTHS)))
+COLUMN_GAP = re.compile(r'\s{2,}')
+# the right column sometimes starts a single space after the category
+CATEGORY = re.compile(r'^(Standards? Track|Best Current Practice|Informational|Experimental|Historic)\b',
+                      re.IGNORECASE)
+NUMBER = re.compile(r'\d+')
+
+
+# returns {field: value} for the rfc stored at path, fields that could not
+# be found are None; dates are 'YYYY-MM' so they sort and compare in order
+def parse_rfc_header(rfc: str, path: str) -> dict:
+    number = NUMBER.search(rfc)
+    row = {'rfc': rfc, 'number': int(number.group()) if number else None, 'title': None,
+           'date': None, 'category': None, 'obsoletes': [], 'updates': [],
+           'size': os.path.getsize(path)}
+    if not rfc.lower().endswith('.txt'):
+        return row
+    with open(path, 'rb') as file:
+        lines = file.read(HEADER_SIZE).decode(
+            'utf-8', errors='ignore').splitlines()
+    # header block: the first lines that are not blank, a left column of
+    # fields and a right column of authors and the date
+    start = 0
+    while start < len(lines) and not lines[start].strip():
+        start += 1
+    end = start
+    field = None
+    while end < len(lines) and lines[end].strip():
+        line = lines[end]
+        columns = COLUMN_GAP.split(line.strip())
+        left = columns[0] if not line[0].isspace() else ''
+        right = columns[-1] if len(columns) > 1 or line[0].isspace() else ''
+        match = HEADER_FIELD.match(left)
+        if match:
+            field, value = match.group(1).lower(), match.group(2)
+        elif left and field in ('obsoletes', 'updates'):
+            # continued list of rfc numbers
+            value = left
+        else:
+            field, value = None, ''
+        if field == 'request for comments' and NUMBER.search(value):
+            row['number'] = int(NUMBER.search(value).group())
+        elif field == 'category':
+            category = CATEGORY.match(value)
+            row['category'] = category.group().title().replace(
+                'Standard Track', 'Standards Track') if category else value.strip()
+        elif field in ('obsoletes', 'updates'):
+            row[field] += [int(n) for n in NUMBER.findall(value)]
+        date = DATE.search(right)
+        if date:
+            row['date'] = '{}-{:02}'.format(date.group(2),
+                                            MONTHS.index(date.group(1)) + 1)
+        end += 1
+    # title: the next lines that are not blank
+    while end < len(lines) and not lines[end].strip():
+        end += 1
+    title = []
+    while end < len(lines) and lines[end].strip():
+        title.append(lines[end].strip())
+        end += 1
+    if title:
+        row['title'] = ' '.join(title)
+    return row
+
+
+# True if value passes the filter condition for a field
+# @param condition is a value to be equal to (or contained, for list
+# fields), a list of values of which one has to match, or a dict with any
+# of 'min', 'max' and 'contains' (case insensitive substring)
+def matches(value, condition, list_field=False) -> bool:
+    if isinstance(condition, list):
+        return any(matches(value, option, list_field) for option in condition)
+    if isinstance(condition, dict):
+        if value == None:
+            return False
+        if 'min' in condition and value < condition['min']:
+            return False
+        if 'max' in condition and value > condition['max']:
+            return False
+        if 'contains' in condition and str(condition['contains']).lower() not in str(value).lower():
+            return False
+        return True
+    if list_field:
+        return condition in value
+    return value == condition
+
+
+class Catalog():
+
+    def __init__(self) -> None:
+        self.lock = Lock()
+        # rfc -> tuple of FIELDS
+        self.rows: Dict[str, tuple] = {}
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def add(self, rfc: str, path: str) -> None:
+        row = parse_rfc_header(rfc, path)
+        with self.lock:
+            self.rows[rfc] = tuple(row[field] for field in FIELDS)
+
+    # returns the rows matching filter as lists of the requested fields
+    # @param fields defaults to all of FIELDS
+    # @param filter is {field: condition}, see matches
+    # @param sort is a field to order by, prefixed with '-' for descending;
+    # rows without a value for it come last
+    # @param limit is the most rows returned
+    # raises ValueError for unknown fields
+    def query(self, fields: List[str] = None, filter: dict = None, sort: str = None,
+              limit: int = None) -> List[list]:
+        fields = list(fields or FIELDS)
+        filter = filter or {}
+        sort_field = sort.lstrip('-') if sort else None
+        unknown = [field for field in fields + list(filter) + ([sort_field] if sort else [])
+                   if field not in FIELDS]
+        if unknown:
+            raise ValueError('Unknown catalog fields: {}'.format(unknown))
+        positions = [FIELDS.index(field) for field in fields]
+        conditions = [(FIELDS.index(field), condition, field in LIST_FIELDS)
+                      for field, condition in filter.items()]
+        with self.lock:
+            rows = [row for row in self.rows.values()
+                    if all(matches(row[position], condition, list_field)
+                           for position, condition, list_field in conditions)]
+        if sort:
+            position = FIELDS.index(sort_field)
+            present = [row for row in rows if row[position] != None]
+            present.sort(key=lambda row: row[position],
+                         reverse=sort.startswith('-'))
+            rows = present + [row for row in rows if row[position] == None]
+        if limit != None:
+            rows = rows[:limit]
+        return [[row[position] for position in positions] for row in rows]
@@ -0,0 +1,184 @@
+import hashlib
+import os
+import socket
+from contextlib import suppress
+from shutil import copyfile
+from threading import Lock
+from typing import Dict, List
+
+from p2p_di.utils.compression import receive_decompressed
+from p2p_di.utils.utils import (DEFAULT_DOWNLOAD_CHUNK_SIZE,
+                                HashMismatchException, receive_to_fd)
+
+# Content addressed storage for a peer's rfcs
+#
+# Every rfc is kept once under objects/<sha256 of its content> in the rfc
+# store, and the file named after the rfc is a hard link to that object, so
+# rfcs with identical content share one copy on disk while the rfc server
+# keeps reading files by name. Besides the digest of the whole file the
+# sha256 of every chunk_size chunk is kept, which lets downloads check
+# each chunk as it arrives.
+
+
+# digest and chunk hashes of one stored object
+class Content_Info():
+
+    def __init__(self, digest: str, size: int, chunk_size: int, chunks: List[str]) -> None:
+        self.digest = digest
+        self.size = size
+        self.chunk_size = chunk_size
+        self.chunks = chunks
+
+    # what GET_RFC sends along when asked for the manifest
+    def to_dict(self) -> dict:
+        return {'digest': self.digest, 'chunk_size': self.chunk_size, 'chunks': self.chunks}
+
+    @staticmethod
+    def from_dict(size: int, manifest: dict):
+        chunk_size = manifest['chunk_size']
+        chunks = list(manifest['chunks'])
+        if chunk_size <= 0 or len(chunks) != max(1, -(-size // chunk_size)):
+            raise HashMismatchException(
+                'Chunk list does not match the size of the rfc!')
+        return Content_Info(manifest['digest'], size, chunk_size, chunks)
+
+
+class Content_Store():
+
+    def __init__(self, root: str, chunk_size: int = DEFAULT_DOWNLOAD_CHUNK_SIZE) -> None:
+        self.root = root
+        self.objects_dir = os.path.join(root, 'objects')
+        os.makedirs(self.objects_dir, exist_ok=True)
+        self.chunk_size = chunk_size
+        self.lock = Lock()
+        # digest -> Content_Info
+        self.objects: Dict[str, Content_Info] = {}
+        # rfc name -> digest
+        self.names: Dict[str, str] = {}
+
+    def object_path(self, digest: str) -> str:
+        return os.path.join(self.objects_dir, digest)
+
+    def has(self, digest: str) -> bool:
+        return digest in self.objects
+
+    def info_for(self, name: str) -> Content_Info:
+        digest = self.names.get(name)
+        return self.objects.get(digest)
+
+    def hash_file(self, path: str) -> Content_Info:
+        digest = hashlib.sha256()
+        chunks = []
+        buffer = bytearray(self.chunk_size)
+        view = memoryview(buffer)
+        size = 0
+        with open(path, 'rb', buffering=0) as file:
+            while True:
+                # a chunk can take several reads
+                filled = 0
+                while filled < self.chunk_size:
+                    read = file.readinto(view[filled:])
+                    if not read:
+                        break
+                    filled += read
+                if filled == 0 and chunks:
+                    break
+                digest.update(view[:filled])
+                chunks.append(hashlib.sha256(view[:filled]).hexdigest())
+                size += filled
+                if filled < self.chunk_size:
+                    break
+        return Content_Info(digest.hexdigest(), size, self.chunk_size, chunks)
+
+    # moves the file at path into the store as rfc name, checking it against
+    # expected_digest first; content already stored is not kept twice
+    # raises HashMismatchException and leaves path alone if the check fails
+    def add(self, name: str, path: str, expected_digest: str = None) -> Content_Info:
+        info = self.hash_file(path)
+        if expected_digest and info.digest != expected_digest:
+            raise HashMismatchException('{} has digest {}, expected {}!'.format(
+                name, info.digest, expected_digest))
+        with self.lock:
+            if info.digest in self.objects:
+                os.remove(path)
+                info = self.objects[info.digest]
+            else:
+                os.replace(path, self.object_path(info.digest))
+                self.objects[info.digest] = info
+            self.link(name, info.digest)
+        return info
+
+    # makes rfc name point at a stored object, call with lock held
+    def link(self, name: str, digest: str) -> None:
+        name_path = os.path.join(self.root, name)
+        temp_path = '{}.link'.format(name_path)
+        try:
+            os.link(self.object_path(digest), temp_path)
+        except OSError:
+            # file systems without hard links get a copy
+            copyfile(self.object_path(digest), temp_path)
+        os.replace(temp_path, name_path)
+        # renaming a link over another link to the same file does nothing
+        with suppress(FileNotFoundError):
+            os.remove(temp_path)
+        self.names[name] = digest
+
+    # stores rfc name as a copy of content already in the store
+    def add_existing(self, name: str, digest: str) -> Content_Info:
+        with self.lock:
+            self.link(name, digest)
+            return self.objects[digest]
+
+
+# receives length bytes of an rfc starting at offset, checking each chunk
+# against its hash as it arrives; offset must be at a chunk boundary
+def receive_chunks(conn: socket.socket, fd: int, offset: int, length: int, info: Content_Info) -> None:
+    if offset % info.chunk_size:
+        raise HashMismatchException(
+            'Range at {} does not start on a chunk!'.format(offset))
+    end = offset + length
+    while offset < end:
+        index = offset // info.chunk_size
+        count = min(info.chunk_size, info.size - offset)
+        if offset + count > end:
+            raise HashMismatchException(
+                'Range ending at {} splits a chunk!'.format(end))
+        hasher = hashlib.sha256()
+        receive_to_fd(conn, count, fd, offset, hasher=hasher)
+        if hasher.hexdigest() != info.chunks[index]:
+            raise HashMismatchException('Chunk {} of {} is corrupt!'.format(
+                index, info.digest))
+        offset += count
+
+
+# receives count compressed bytes that decompress to length bytes of an rfc
+# starting at offset, checking each chunk against its hash as soon as the
+# decompressed data reaches its end; the range must line up with the chunks
+def receive_decompressed_chunks(conn: socket.socket, count: int, fd: int, codec: str, offset: int, length: int,
+                                info: Content_Info) -> None:
+    end = offset + length
+    if offset % info.chunk_size:
+        raise HashMismatchException(
+            'Range at {} does not start on a chunk!'.format(offset))
+    if end != info.size and end % info.chunk_size:
+        raise HashMismatchException(
+            'Range ending at {} splits a chunk!'.format(end))
+    hasher = hashlib.sha256()
+    chunk_end = min(offset + info.chunk_size, info.size)
+    for data in receive_decompressed(conn, count, codec, length):
+        view = memoryview(data)
+        while view:
+            piece = view[:chunk_end - offset]
+            hasher.update(piece)
+            written = 0
+            while written < len(piece):
+                written += os.pwrite(fd, piece[written:], offset + written)
+            offset += len(piece)
+            view = view[len(piece):]
+            if offset == chunk_end:
+                index = (offset - 1) // info.chunk_size
+                if hasher.hexdigest() != info.chunks[index]:
+                    raise HashMismatchException('Chunk {} of {} is corrupt!'.format(
+                        index, info.digest))
+                hasher = hashlib.sha256()
+                chunk_end = min(offset + info.chunk_size, info.size)
@@ -1,44 +1,275 @@
 from __future__ import annotations
 
+import contextlib
 import os
 import socket
+import sys
+import time
+from ast import literal_eval
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from heapq import heappop, heappush
 from random import randint
 from shutil import copyfile
+from threading import Lock
 from typing import Dict, List
+from uuid import uuid4
 from xmlrpc.client import Boolean
 
+from p2p_di.client.catalog import Catalog
+from p2p_di.client.content_store import (Content_Info, Content_Store,
+                                         receive_chunks,
+                                         receive_decompressed_chunks)
+from p2p_di.client.search_index import Search_Index
 from p2p_di.server.rfc_server import RFC_Server
-from p2p_di.utils.message import Message, MessageType, MethodType, StatusCodes
-from p2p_di.utils.utils import log, receive, save_rfc_file, send
+from p2p_di.utils.compression import (SUPPORTED_CODECS,
+                                      receive_decompressed_to_fd)
+from p2p_di.utils.message import (Message, MessageType, MethodType,
+                                  StatusCodes, WireFormat)
+from p2p_di.utils.utils import (DEFAULT_CHANGE_LOG_SIZE,
+                                DEFAULT_DOWNLOAD_CHUNK_SIZE,
+                                DEFAULT_FANOUT_WORKERS,
+                                DEFAULT_HEARTBEAT_LOSSES,
+                                DEFAULT_LOOKUP_DEADLINE, DEFAULT_PEER_TIMEOUT,
+                                DEFAULT_SEARCH_LIMIT,
+                                DEFAULT_TRANSFER_TIMEOUT, HEARTBEAT_ACK,
+                                HEARTBEAT_REJECT, PEER_SET_CACHE_SIZE,
+                                SEARCH_INDEX_FILE,
+                                HashMismatchException,
+                                exchange, get_logger, get_rs_address,
+                                legacy_peers, log, receive,
+                                receive_to_fd, save_rfc_file, send)
+
+# interned peer addresses of one rfc index
+# every (ip, port) in the index gets a small integer id, and index entries
+# keep their owners as a bitset of those ids instead of a dict of strings,
+# so an address is stored once however many rfcs it hosts and merging
+# owner lists costs a few integer operations, however many owners are
+# already known
+# an address drops out of the index only when its ip shows up with another
+# port; its id is freed once no entry holds it any more and the lowest free
+# id is handed out next, so bitsets stay as wide as the number of peers the
+# index knows
+
+
+class Peer_Table():
+
+    def __init__(self) -> None:
+        self.lock = Lock()
+        # (ip, port) -> id
+        self.ids: Dict[tuple, int] = {}
+        # id -> (ip, port), None for free ids
+        self.addresses: List[tuple] = []
+        # min-heap of the free ids
+        self.free: List[int] = []
+        # ip -> bitset of the ids of every port seen for it
+        self.host_masks: Dict[str, int] = {}
+        # bitset of the ids of ips seen with more than one port
+        self.moved_mask = 0
+        # bitset of the ids merge dropped from some entry, see collect
+        self.dropped = 0
+        # bitset -> owners, most owner sets are shared by many rfcs
+        self.decoded: Dict[int, tuple] = {}
+
+    def intern(self, host: str, port: int) -> int:
+        address = (host, port)
+        peer_id = self.ids.get(address)
+        if peer_id != None:
+            return peer_id
+        with self.lock:
+            peer_id = self.ids.get(address)
+            if peer_id == None:
+                host = sys.intern(host)
+                if self.free:
+                    peer_id = heappop(self.free)
+                    self.addresses[peer_id] = (host, port)
+                else:
+                    peer_id = len(self.addresses)
+                    self.addresses.append((host, port))
+                mask = self.host_masks.get(host, 0)
+                if mask:
+                    self.moved_mask |= mask | 1 << peer_id
+                self.host_masks[host] = mask | 1 << peer_id
+                self.ids[address] = peer_id
+        return peer_id
+
+    # frees the dropped ids that are not in held, the owners of every entry
+    def collect(self, held: int) -> None:
+        with self.lock:
+            unused = self.dropped & ~held
+            self.dropped = 0
+            if not unused:
+                return
+            for peer_id in self.ids_of(unused):
+                address = self.addresses[peer_id]
+                del self.ids[address]
+                self.addresses[peer_id] = None
+                heappush(self.free, peer_id)
+                mask = self.host_masks[address[0]] & ~(1 << peer_id)
+                if mask:
+                    self.host_masks[address[0]] = mask
+                else:
+                    del self.host_masks[address[0]]
+                # a host down to one port has not moved any more
+                if mask & (mask - 1) == 0:
+                    self.moved_mask &= ~mask
+            self.moved_mask &= ~unused
+            # cached owner sets may hold ids that can now be reused
+            self.decoded = {}
+
+    # ids of the set bits, lowest first
+    @staticmethod
+    def ids_of(bits: int) -> List[int]:
+        peer_ids = []
+        while bits:
+            low = bits & -bits
+            peer_ids.append(low.bit_length() - 1)
+            bits ^= low
+        return peer_ids
+
+    # bitset of the owners in {'ip': port}
+    def to_bits(self, hosted_on: Dict[str, int]) -> int:
+        peer_ids = list(map(self.ids.get, hosted_on.items()))
+        if None in peer_ids:
+            peer_ids = [self.intern(host, int(port))
+                        for host, port in hosted_on.items()]
+        bits = 0
+        for peer_id in peer_ids:
+            bits |= 1 << peer_id
+        return bits
+
+    # owners in bits in the form {'ip': port}
+    def to_dict(self, bits: int) -> Dict[str, int]:
+        owners = self.decoded.get(bits)
+        if owners == None:
+            addresses = self.addresses
+            owners = tuple(addresses[peer_id]
+                           for peer_id in self.ids_of(bits))
+            if len(self.decoded) >= PEER_SET_CACHE_SIZE:
+                self.decoded = {}
+            self.decoded[bits] = owners
+        return dict(owners)
+
+    # returns a function turning bitsets of the table other into bitsets of
+    # the same addresses in this one
+    def translator(self, other: Peer_Table):
+        if other is self:
+            return lambda bits: bits
+        bit_of = [0 if address == None else 1 << self.intern(*address)
+                  for address in other.addresses]
+        # bitset of other -> bitset of this table
+        translated = {}
+
+        def translate(bits: int) -> int:
+            result = translated.get(bits)
+            if result == None:
+                result = 0
+                for peer_id in other.ids_of(bits):
+                    result |= bit_of[peer_id]
+                translated[bits] = result
+            return result
+        return translate
+
+    # returns bits with the owners in other added, None if other has no
+    # owner bits lacks; a new port for a known ip replaces the old one
+    def merge(self, bits: int, other: int) -> int:
+        new = other & ~bits
+        if not new:
+            return None
+        moved = new & self.moved_mask
+        if moved:
+            for host, _ in self.to_dict(moved).items():
+                self.dropped |= bits & self.host_masks[host] & ~new
+                bits &= ~self.host_masks[host]
+        return bits | new
 
 # class for the entries in RFC_Index
 
 
 class Index_Entry():
 
-    def __init__(self, owned: bool = False, hosted_on: dict = {}) -> None:
+    __slots__ = ('peers', 'owned', 'owners', 'digest')
+
+    # @param peers is the Peer_Table of the index holding the entry
+    # @param hosted_on is {'ip': port}, or owners a bitset of peers' ids
+    def __init__(self, peers: Peer_Table, owned: bool = False, hosted_on: dict = None, digest: str = None,
+                 owners: int = 0) -> None:
+        self.peers = peers
         self.owned = owned
-        # in the form {'ip':port}
-        self.hosted_on: Dict[str] = hosted_on
+        # bitset of the ids of the peers hosting the rfc, one port per ip
+        self.owners = peers.to_bits(hosted_on) if hosted_on else owners
+        # sha256 of the rfc's content, None if no owner advertised one
+        self.digest = digest
 
     def __str__(self) -> str:
         return str(self.hosted_on)
 
+    # in the form {'ip':port}
+    @property
+    def hosted_on(self) -> Dict[str, int]:
+        return self.peers.to_dict(self.owners)
+
     def is_owned(self) -> bool:
         return self.owned
 
     def get_peers_who_own(self) -> Dict[str]:
         return self.hosted_on
 
-    def merge_peer_list(self, other: Index_Entry) -> None:
-        self.hosted_on = self.hosted_on | other.hosted_on
+    # returns True if owners, a bitset of this entry's table, has owners
+    # this entry did not know about
+    def merge_owners(self, owners: int) -> bool:
+        merged = self.peers.merge(self.owners, owners)
+        if merged == None:
+            return False
+        self.owners = merged
+        return True
+
+    # returns True if other knew about owners this entry did not
+    def merge_peer_list(self, other: Index_Entry) -> bool:
+        return self.merge_owners(self.peers.translator(other.peers)(other.owners))
+
+# every change to an index bumps its version and is recorded in a bounded
+# change log, so peers can ask for only what changed since the version
+# they last saw; the epoch tells them when versions started over
 
 
 class RFC_Index():
 
-    def __init__(self, entries: dict = {}) -> None:
+    # @param peers is the Peer_Table entries were made with
+    def __init__(self, entries: dict = None, peers: Peer_Table = None) -> None:
+        self.peers = peers if peers != None else Peer_Table()
         self.rfc_store: str = None
-        self.rfcs: Dict[str, Index_Entry] = entries
+        self.content_store: Content_Store = None
+        self.search_index: Search_Index = None
+        self.catalog: Catalog = None
+        self.rfcs: Dict[str, Index_Entry] = entries if entries != None else {}
+        self.epoch = uuid4().hex
+        self.version = 0
+        # (version, rfc) for the latest changes
+        self.change_log = deque(maxlen=DEFAULT_CHANGE_LOG_SIZE)
+
+    def record_change(self, rfc: str) -> None:
+        self.version += 1
+        self.change_log.append((self.version, rfc))
+
+    # returns the rfcs changed after version since, or None if the change
+    # log no longer reaches back that far
+    def changes_since(self, since: int) -> set:
+        if since >= self.version:
+            return set()
+        if since < 0 or not self.change_log or self.change_log[0][0] > since + 1:
+            return None
+        return {rfc for version, rfc in self.change_log if version > since}
+
+    def set_owned(self, rfc: str, digest: str = None) -> None:
+        if rfc not in self.rfcs:
+            self.rfcs[rfc] = Index_Entry(self.peers, True, None, digest)
+        elif self.rfcs[rfc].is_owned() and digest in (None, self.rfcs[rfc].digest):
+            return
+        self.rfcs[rfc].owned = True
+        if digest != None:
+            self.rfcs[rfc].digest = digest
+        self.record_change(rfc)
 
     def __str__(self) -> str:
         ri = {}
@@ -49,6 +280,11 @@ class RFC_Index():
     def is_owned(self, rfc: str):
         return rfc in self.rfcs and self.rfcs[rfc].is_owned()
 
+    def get_digest(self, rfc: str) -> str:
+        if rfc not in self.rfcs:
+            return None
+        return self.rfcs[rfc].digest
+
     def get_owners(self, rfc: str) -> Dict[str]:
         if rfc not in self.rfcs:
             return {}
@@ -58,20 +294,70 @@ class RFC_Index():
     def to_bytes(self) -> bytes:
         return bytes(str(self), 'utf-8')
 
+    # returns {rfc: {'ip': port}} for sending in binary messages
+    # @param self_address is (ip, port) of this peer's rfc server, added as
+    # an owner of the rfcs this peer owns
+    # @param rfcs limits the result to these rfcs
+    def to_dict(self, self_address: tuple = None, rfcs: set = None) -> Dict[str, Dict[str, int]]:
+        ri = {}
+        for rfc in (self.rfcs if rfcs == None else rfcs):
+            entry = self.rfcs[rfc]
+            owners = entry.get_peers_who_own()
+            if self_address and entry.is_owned():
+                owners[self_address[0]] = self_address[1]
+            ri[rfc] = owners
+        return ri
+
+    # returns {rfc: digest} for the rfcs whose digest is known, sent next
+    # to to_dict so the owner lists keep their format
+    def to_digests(self, rfcs: set = None) -> Dict[str, str]:
+        return {rfc: self.rfcs[rfc].digest for rfc in (self.rfcs if rfcs == None else rfcs)
+                if self.rfcs[rfc].digest != None}
+
     def merge_index(self, other: RFC_Index):
-        for rfc in other.rfcs:
-            if rfc not in self.rfcs:
-                self.rfcs[rfc] = other.rfcs[rfc]
-            else:
-                self.rfcs[rfc].merge_peer_list(other.rfcs[rfc])
+        translate = self.peers.translator(other.peers)
+        for rfc, other_entry in other.rfcs.items():
+            entry = self.rfcs.get(rfc)
+            if entry == None:
+                self.rfcs[rfc] = Index_Entry(self.peers, False, None, other_entry.digest,
+                                             translate(other_entry.owners))
+                self.record_change(rfc)
+                continue
+            changed = entry.merge_owners(translate(other_entry.owners))
+            # the first digest heard of is kept, owners with other content
+            # fail verification when downloading
+            if entry.digest == None and other_entry.digest != None:
+                entry.digest = other_entry.digest
+                changed = True
+            if changed:
+                self.record_change(rfc)
+        # ports that moved may have left ids no entry holds
+        if self.peers.dropped:
+            held = 0
+            for entry in self.rfcs.values():
+                held |= entry.owners
+            self.peers.collect(held)
+
+    @staticmethod
+    def from_dict(rfc_owners: Dict[str, Dict[str, int]], digests: Dict[str, str] = None) -> RFC_Index:
+        peers = Peer_Table()
+        ri_dict = {}
+        for rfc in rfc_owners:
+            ri_dict[rfc] = Index_Entry(
+                peers, False, rfc_owners[rfc], (digests or {}).get(rfc))
+        return RFC_Index(ri_dict, peers)
 
     @staticmethod
     def from_string(string: str) -> RFC_Index:
-        dict_ie_string: Dict[str, str] = eval(string)
+        dict_ie_string: Dict[str, str] = literal_eval(string)
+        peers = Peer_Table()
         ri_dict = {}
         for rfc in dict_ie_string:
-            ri_dict[rfc] = Index_Entry(False, eval(dict_ie_string[rfc]))
-        to_return = RFC_Index(ri_dict)
+            owners = dict_ie_string[rfc]
+            if isinstance(owners, str):
+                owners = literal_eval(owners)
+            ri_dict[rfc] = Index_Entry(peers, False, owners)
+        to_return = RFC_Index(ri_dict, peers)
         return to_return
 
     @staticmethod
@@ -80,29 +366,76 @@ class RFC_Index():
         return RFC_Index.from_string(string)
 
 
+# a range request running in another thread, which download_rfc can abort
+# by shutting its connection down once another owner has sent the same
+# chunk
+class Range_Request():
+
+    def __init__(self) -> None:
+        self.lock = Lock()
+        self.conn = None
+        self.cancelled = False
+
+    # raises ConnectionAbortedError if the request was cancelled already
+    def attach(self, conn: socket.socket) -> None:
+        with self.lock:
+            if self.cancelled:
+                raise ConnectionAbortedError('Range request cancelled!')
+            self.conn = conn
+
+    def cancel(self) -> None:
+        with self.lock:
+            self.cancelled = True
+            if self.conn != None:
+                with contextlib.suppress(OSError):
+                    self.conn.shutdown(socket.SHUT_RDWR)
+
+
 class Client():
 
     # name is not hostname
     # @rfcs_owned is filename containing list of rfcs stored locally
     # rfcs_owned must have each rfc owned on a separate line
-    def __init__(self, name: str, rfcs_owned_list: str = None, port: int = None) -> None:
+    # @udp_heartbeats sends keep alives as udp datagrams, see stay_alive
+    # @rfc_store is the directory rfcs are kept in, assets/peer/<name>/rfc_store
+    # by default; a client started over the store of an earlier one keeps
+    # its search index instead of indexing every rfc again
+    # server_options are passed on to the client's RFC_Server
+    def __init__(self, name: str, rfcs_owned_list: str = None, port: int = None, udp_heartbeats=False,
+                 rfc_store: str = None, **server_options) -> None:
         random_int = randint(0, 999)
         self.name = '{}_{}'.format(name, random_int)
         self.cookie: str = None
+        self.udp_heartbeats = udp_heartbeats
+        # udp heartbeats lost in a row
+        self.heartbeat_losses = 0
         self.peer_list: Dict[str, str] = {}
+        # (epoch, version) of the last rfc index merged from each peer
+        self.peer_index_versions: Dict[tuple, tuple] = {}
         base_path = os.path.dirname(__file__)
-        os.makedirs(os.path.join(base_path, '..', '..', 'assets',
-                    'peer', self.name, 'rfc_store'), exist_ok=True)
+        if rfc_store == None:
+            rfc_store = os.path.join(
+                base_path, '..', '..', 'assets', 'peer', self.name, 'rfc_store')
+        os.makedirs(rfc_store, exist_ok=True)
         self.log_filename = os.path.join(
             base_path, '..', '..', 'assets', 'peer', self.name, 'action_log.txt')
+        # log() writes to log_filename through this logger
+        get_logger('client.{}'.format(self.name), self.log_filename)
+        self.content_store = Content_Store(rfc_store)
+        self.search_index = Search_Index(
+            os.path.join(rfc_store, SEARCH_INDEX_FILE))
+        self.catalog = Catalog()
         if rfcs_owned_list:
             rfcs_owned_list = os.path.join(os.getcwd(), rfcs_owned_list)
             self.rfc_index: RFC_Index = self.load_rfcs(rfcs_owned_list)
         else:
             self.rfc_index: RFC_Index = RFC_Index()
-        self.rfc_index.rfc_store = os.path.join(
-            base_path, '..', '..', 'assets', 'peer', self.name, 'rfc_store')
-        self.rfc_server = RFC_Server(self.name, self.rfc_index, True, port)
+        self.rfc_index.rfc_store = rfc_store
+        self.rfc_index.content_store = self.content_store
+        self.rfc_index.search_index = self.search_index
+        self.rfc_index.catalog = self.catalog
+        self.rfc_server = RFC_Server(
+            self.name, self.rfc_index, True, port, **server_options)
 
     # load rfc
     def load_rfcs(self, filename: str) -> RFC_Index:
@@ -111,32 +444,130 @@ class Client():
         if not os.path.isfile(filename):
             return owned
         with open(filename) as file:
-            while line := file.readline().strip():
+            for line in file:
+                line = line.strip()
                 file_path = os.path.join(
                     base_path, '..', '..', 'rfc_store', line)
-                if os.path.isfile(file_path):
-                    copyfile(file_path, os.path.join(
-                        base_path, '..', '..', 'assets', 'peer', self.name, 'rfc_store', file_path))
-                    owned.rfcs[filename] = Index_Entry(filename, True)
+                if line and os.path.isfile(file_path):
+                    stored_path = os.path.join(self.content_store.root, line)
+                    # the stored name may already link to an object of the
+                    # store, copying over it would change the object
+                    temp_path = '{}.part'.format(stored_path)
+                    copyfile(file_path, temp_path)
+                    info = self.content_store.add(line, temp_path)
+                    owned.set_owned(line, info.digest)
+                    self.search_index.add(
+                        line, stored_path, info.digest, journal=False)
+                    self.catalog.add(line, stored_path)
+        self.search_index.save()
         return owned
 
     def register(self):
         log(self.log_filename, 'Attempting to register on server', type='info')
         self.cookie = self.rfc_server.register(self.name)
 
+    # with udp heartbeats a lost ack falls back to a tcp keep alive for that
+    # ping, after DEFAULT_HEARTBEAT_LOSSES lost in a row only tcp is used
     def stay_alive(self):
-        log(self.log_filename, 'Pinging server to stay alive', type='info')
+        log(self.log_filename, 'Pinging server to stay alive',
+            type='info', event='keep_alive')
+        if self.udp_heartbeats and self.cookie:
+            reply = self.rfc_server.send_heartbeat(self.cookie)
+            if reply == HEARTBEAT_ACK:
+                self.heartbeat_losses = 0
+                return
+            if reply == HEARTBEAT_REJECT:
+                log(self.log_filename,
+                    'Heartbeat rejected by server, registering again', type='warning')
+                self.heartbeat_losses = 0
+                self.register()
+                return
+            self.heartbeat_losses += 1
+            if self.heartbeat_losses >= DEFAULT_HEARTBEAT_LOSSES:
+                log(self.log_filename, 'Lost {} heartbeats in a row, using tcp keep alives'.format(
+                    self.heartbeat_losses), type='warning')
+                self.udp_heartbeats = False
         self.rfc_server.server_requester(self.cookie, MethodType.KEEP_ALIVE, {
-                                         'success': 'Successfully pinged server!', 'failure': 'Failed to ping server'})
+                                         'success': 'Successfully pinged server!', 'failure': 'Failed to ping server',
+                                         'event': 'keep_alive'})
 
-    def query_for_peers(self):
+    # without arguments the server sends every active peer
+    # @param sample asks for only this many peers, picked at random
+    # @param page_size fetches the list in pages of this many peers
+    # @param exclude_self leaves this client out of the list
+    def query_for_peers(self, sample: int = None, page_size: int = None, exclude_self=False):
         log(self.log_filename, 'Querying server for peers', type='info')
-        peer_strings: List[str] = self.rfc_server.server_requester(
-            self.cookie, MethodType.PQUERY, {'success': 'Received peer list from server!'})
+        options = {}
+        if sample != None:
+            options['sample'] = sample
+        elif page_size != None:
+            options['page_size'] = page_size
+        if exclude_self:
+            options['exclude_self'] = True
+        peer_strings: List[str] = []
+        while True:
+            reply = self.rfc_server.server_requester(
+                self.cookie, MethodType.PQUERY, {'success': 'Received peer list from server!'}, options or None)
+            if reply == None:
+                return
+            # servers without options support send the whole list
+            if isinstance(reply, list):
+                peer_strings = reply
+                break
+            peer_strings.extend(reply['peers'])
+            if page_size == None or sample != None or not reply.get('cursor'):
+                break
+            options['cursor'] = reply['cursor']
+        self.set_peer_list(peer_strings)
+
+    # sends several requests to the registration server in one connection
+    # @param operations is a list of (MethodType, data), e.g.
+    # [(MethodType.KEEP_ALIVE, None), (MethodType.PQUERY, None)]
+    # returns one {'status_code', 'data'} per operation or None on failure
+    def batch(self, operations: List[tuple]) -> List[dict]:
+        return self.rfc_server.batch_requester(self.cookie, operations)
+
+    # keep alive and peer query in one request, registering instead of the
+    # keep alive when there is no cookie yet
+    # falls back to separate requests if the batch fails
+    def stay_alive_and_query(self, sample: int = None, exclude_self=False) -> None:
+        options = {}
+        if sample != None:
+            options['sample'] = sample
+        if exclude_self:
+            options['exclude_self'] = True
+        if self.cookie:
+            first = (MethodType.KEEP_ALIVE, None)
+        else:
+            first = (MethodType.REGISTER,
+                     self.rfc_server.registration_data(self.name))
+        results = self.batch([first, (MethodType.PQUERY, options or None)])
+        if results == None:
+            if self.cookie:
+                self.stay_alive()
+            else:
+                self.register()
+            self.query_for_peers(sample=sample, exclude_self=exclude_self)
+            return
+        first_result, query_result = results
+        if first_result['status_code'] != StatusCodes.SUCCESS.value:
+            log(self.log_filename, '{} failed in batch: {}'.format(
+                first[0].name, first_result.get('data')), type='error')
+        elif first[0] == MethodType.REGISTER:
+            self.cookie = first_result['data']['cookie']
+        if query_result['status_code'] != StatusCodes.SUCCESS.value:
+            log(self.log_filename, 'PQUERY failed in batch: {}'.format(
+                query_result.get('data')), type='error')
+            return
+        peers = query_result['data']
+        self.set_peer_list(peers['peers'] if isinstance(
+            peers, dict) else peers)
 
+    # peer_strings are 'host:port' strings as sent by the server
+    def set_peer_list(self, peer_strings: List[str]) -> None:
         def format_address(address): return (address[0], int(address[1]))
-        new_peer_list = dict(format_address(string.split(':')
-                             for string in peer_strings))
+        new_peer_list = dict(format_address(string.split(':'))
+                             for string in peer_strings)
         self.peer_list = new_peer_list
 
     def leave_rs(self):
@@ -144,87 +575,506 @@ class Client():
         self.rfc_server.server_requester(self.cookie, MethodType.LEAVE, {
                                          'success': 'Successfully updated status!', 'failure': 'Failed to update status'})
 
-    def request_rfc_index(self, peer_hostname: str, peer_port: str):
+    # safe to call from several threads at once, merges are done under the
+    # rfc server's lock
+    # @param timeout is how long to wait on the peer's socket, in seconds
+    def request_rfc_index(self, peer_hostname: str, peer_port: str, timeout: float = None) -> Boolean:
         log(self.log_filename, "Requesting RFC Index from peer @ {}:{}".format(
             peer_hostname, peer_port), type='info')
+        peer_address = (peer_hostname, peer_port)
         request = Message(MessageType.REQUEST_PEER)
         request.method = MethodType.RFC_QUERY
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as conn:
+        # only ask for what changed since the last index seen from this peer
+        epoch, since = self.peer_index_versions.get(peer_address, (None, 0))
+        request.data = {'since': since, 'epoch': epoch}
+        try:
+            response_dict = exchange(peer_address, request, timeout)
+            if response_dict['status_code'] != StatusCodes.SUCCESS.value:
+                log(self.log_filename, 'Peer ran into error while sending index - {}'.format(
+                    response_dict['data']), type='error')
+                return False
             try:
-                conn.connect(peer_hostname, peer_port)
-                send(conn, request.to_bytes())
-                response_bytes = receive(conn)
-                response_dict = Message.bytes_to_dict(response_bytes)
-                if response_dict['status_code'] != StatusCodes.SUCCESS.value:
-                    log(self.log_filename, 'Peer ran into error while sending index - {}'.format(
-                        response_dict['data']), type='error')
-                    return
-                try:
-                    peer_rfc_string = response_dict['data']
-                    peer_rfc_index: RFC_Index = RFC_Index.from_string(
-                        peer_rfc_string)
+                peer_rfc_data = response_dict['data']
+                peer_version = None
+                digests = None
+                # versioned reply, older peers send the whole index as is
+                if isinstance(peer_rfc_data, dict) and 'version' in peer_rfc_data and 'rfcs' in peer_rfc_data:
+                    peer_version = (
+                        peer_rfc_data['epoch'], peer_rfc_data['version'])
+                    digests = peer_rfc_data.get('digests')
+                    peer_rfc_data = peer_rfc_data['rfcs']
+                if isinstance(peer_rfc_data, dict):
+                    peer_rfc_index = RFC_Index.from_dict(
+                        peer_rfc_data, digests)
+                else:
+                    peer_rfc_index = RFC_Index.from_string(peer_rfc_data)
+                with self.rfc_server.lock:
                     self.rfc_index.merge_index(peer_rfc_index)
-                    self.rfc_server.client_rfc_index = self.rfc_index
-                    log(self.log_filename, 'Successfully merged RFC Index from peer @ {}:{}'.format(
-                        peer_hostname, peer_port), type='info')
-                except (KeyError, Exception) as e:
-                    log(self.log_filename, 'Invalid index data received from peer @ {}:{} - {}'.format(
-                        peer_hostname, peer_port, e), type='error')
-                    return
-            except (socket.error, Exception) as e:
-                log(self.log_filename,
-                    'Error while retrieving RFC Index from peer - {}'.format(e), type='error')
+                    if peer_version:
+                        self.peer_index_versions[peer_address] = peer_version
+                log(self.log_filename, 'Successfully merged RFC Index from peer @ {}:{}'.format(
+                    peer_hostname, peer_port), type='info')
+                return True
+            except (KeyError, Exception) as e:
+                log(self.log_filename, 'Invalid index data received from peer @ {}:{} - {}'.format(
+                    peer_hostname, peer_port, e), type='error')
+                return False
+        except (socket.error, Exception) as e:
+            log(self.log_filename,
+                'Error while retrieving RFC Index from peer - {}'.format(e), type='error')
+            return False
 
+    # streams the rfc straight to disk, falls back to request_rfc_lines for
+    # peers that only speak the legacy format
     def request_rfc(self, rfc_name, peer_hostname, peer_port) -> Boolean:
         log(self.log_filename, 'Requesting {} from peer @ {}:{}'.format(rfc_name,
             peer_hostname, peer_port), type='info')
+        peer_address = (peer_hostname, peer_port)
+        if peer_address in legacy_peers:
+            return self.request_rfc_lines(rfc_name, peer_hostname, peer_port)
         request = Message(MessageType.REQUEST_PEER)
         request.method = MethodType.GET_RFC
-        request.data = [rfc_name]
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as conn:
-            try:
-                conn.connect(peer_hostname, peer_port)
+        request.data = {'rfc': rfc_name, 'stream': True, 'manifest': True,
+                        'codecs': list(SUPPORTED_CODECS)}
+        temp_path = '{}.part'.format(os.path.join(
+            self.content_store.root, rfc_name))
+        digest = self.rfc_index.get_digest(rfc_name)
+        try:
+            with socket.create_connection(peer_address, DEFAULT_TRANSFER_TIMEOUT) as conn:
                 send(conn, request.to_bytes())
                 response_bytes = receive(conn)
-                response_dict = Message.bytes_to_dict(response_bytes)
-                if response_dict['status_code'] != StatusCodes.SUCCESS.value:
-                    log(self.log_filename, 'Peer ran into error while sending index - {}'.format(
-                        response_dict['data']), type='error')
-                    return False
-                try:
-                    requested_rfc = response_dict['data']
-                    save_rfc_file(requested_rfc, os.path.join(
-                        self.rfc_index.rfc_store, rfc_name))
-                    self.rfc_index.rfcs[rfc_name].owned = True
-                    log(self.log_filename, 'Successfully received {} from peer!'.format(
-                        rfc_name), type='info')
-                    return True
-                except (KeyError, Exception) as e:
-                    log(self.log_filename, 'Invalid rfc file received from peer @ {}:{} - {}'.format(
-                        peer_hostname, peer_port, e), type='error')
+                legacy = Message.wire_format_of(
+                    response_bytes) == WireFormat.LEGACY
+                if not legacy:
+                    response_dict = Message.bytes_to_dict(response_bytes)
+                    if response_dict['status_code'] != StatusCodes.SUCCESS.value:
+                        log(self.log_filename, 'Peer ran into error while sending {} - {}'.format(
+                            rfc_name, response_dict['data']), type='error')
+                        return False
+                    response_data = response_dict['data']
+                    manifest = self.check_manifest(
+                        response_data['size'], response_data, digest)
+                    fd = os.open(temp_path, os.O_WRONLY |
+                                 os.O_CREAT | os.O_TRUNC, 0o644)
+                    try:
+                        if response_data.get('encoding') and manifest:
+                            receive_decompressed_chunks(
+                                conn, response_data['length'], fd, response_data['encoding'],
+                                0, response_data['size'], manifest)
+                            digest = manifest.digest
+                        elif response_data.get('encoding'):
+                            receive_decompressed_to_fd(
+                                conn, response_data['length'], fd,
+                                response_data['encoding'], response_data['size'])
+                        elif manifest:
+                            receive_chunks(
+                                conn, fd, 0, response_data['size'], manifest)
+                            digest = manifest.digest
+                        else:
+                            receive_to_fd(conn, response_data['size'], fd, 0)
+                        os.fsync(fd)
+                    finally:
+                        os.close(fd)
+        except (socket.error, Exception) as e:
+            log(self.log_filename,
+                'Error while retrieving {} from peer - {}'.format(rfc_name, e), type='error')
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(temp_path)
+            return False
+        if legacy:
+            legacy_peers.add(peer_address)
+            return self.request_rfc_lines(rfc_name, peer_hostname, peer_port)
+        if not self.store_rfc(rfc_name, temp_path, digest):
+            return False
+        log(self.log_filename, 'Successfully received {} from peer!'.format(
+            rfc_name), type='info')
+        return True
+
+    # requests the rfc as a list of lines inside the response
+    def request_rfc_lines(self, rfc_name, peer_hostname, peer_port) -> Boolean:
+        request = Message(MessageType.REQUEST_PEER)
+        request.method = MethodType.GET_RFC
+        request.data = rfc_name
+        try:
+            response_dict = exchange((peer_hostname, peer_port), request)
+            if response_dict['status_code'] != StatusCodes.SUCCESS.value:
+                log(self.log_filename, 'Peer ran into error while sending {} - {}'.format(
+                    rfc_name, response_dict['data']), type='error')
+                return False
+            try:
+                requested_rfc = response_dict['data']
+                # legacy peers send the list as a string
+                if isinstance(requested_rfc, str):
+                    requested_rfc = literal_eval(requested_rfc)
+                temp_path = '{}.part'.format(os.path.join(
+                    self.content_store.root, rfc_name))
+                save_rfc_file(requested_rfc, temp_path)
+                # line endings do not survive this transfer, so there is no
+                # digest to check the copy against
+                if not self.store_rfc(rfc_name, temp_path):
                     return False
-            except (socket.error, Exception) as e:
-                log(self.log_filename,
-                    'Error while retrieving {} from peer - {}'.format(rfc_name, e), type='error')
+                log(self.log_filename, 'Successfully received {} from peer!'.format(
+                    rfc_name), type='info')
+                return True
+            except (KeyError, Exception) as e:
+                log(self.log_filename, 'Invalid rfc file received from peer @ {}:{} - {}'.format(
+                    peer_hostname, peer_port, e), type='error')
                 return False
+        except (socket.error, Exception) as e:
+            log(self.log_filename,
+                'Error while retrieving {} from peer - {}'.format(rfc_name, e), type='error')
+            return False
+
+    def mark_owned(self, rfc_name: str, digest: str = None) -> None:
+        with self.rfc_server.lock:
+            self.rfc_index.set_owned(rfc_name, digest)
+        rfc_path = os.path.join(self.content_store.root, rfc_name)
+        self.search_index.add(rfc_name, rfc_path, digest)
+        self.catalog.add(rfc_name, rfc_path)
+
+    # moves a received rfc into the content store and marks it owned
+    # returns False and drops the file if it does not match digest
+    def store_rfc(self, rfc_name: str, temp_path: str, digest: str = None) -> Boolean:
+        try:
+            info = self.content_store.add(rfc_name, temp_path, digest)
+        except HashMismatchException as he:
+            log(self.log_filename, 'Received corrupt copy of {} - {}'.format(
+                rfc_name, he), type='error')
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(temp_path)
+            return False
+        self.mark_owned(rfc_name, info.digest)
+        return True
+
+    # returns the chunk hashes sent with a GET_RFC reply, None if the peer
+    # sent none; raises HashMismatchException if they are for other content
+    # than the digest this client expects
+    @staticmethod
+    def check_manifest(size: int, response_data: dict, digest: str = None) -> Content_Info:
+        if 'chunks' not in response_data:
+            return None
+        manifest = Content_Info.from_dict(size, response_data)
+        if digest and manifest.digest != digest:
+            raise HashMismatchException('Peer has {} instead of {}!'.format(
+                manifest.digest, digest))
+        return manifest
 
-    def find_peers_with_rfc(self, rfc_name: str) -> Dict[str, str]:
+    # refreshes the rfc index from every known peer at once
+    # @param min_owners returns as soon as this many owners are known
+    # @param peer_timeout is how long a single peer gets to answer
+    # @param deadline is how long the whole lookup may take, peers that
+    # have not answered by then are left out
+    def find_peers_with_rfc(self, rfc_name: str, min_owners: int = None, peer_timeout: float = DEFAULT_PEER_TIMEOUT,
+                            deadline: float = DEFAULT_LOOKUP_DEADLINE) -> Dict[str, str]:
         log(self.log_filename, 'Finding peers with {}!'.format(rfc_name), type='info')
         self.query_for_peers()  # refreshing peer list
-        for (host, port) in self.peer_list.items():  # refresh rfc index
-            self.request_rfc_index(host, port)
-        rfc_owners = {}
-        if rfc_name not in self.rfc_index.rfcs:
-            return rfc_owners
+        end_time = time.time() + deadline
+        executor = ThreadPoolExecutor(
+            max_workers=max(1, min(len(self.peer_list), DEFAULT_FANOUT_WORKERS)))
+        try:
+            pending = {executor.submit(self.request_rfc_index, host, port, peer_timeout)
+                       for (host, port) in self.peer_list.items()}
+            while pending:
+                remaining = end_time - time.time()
+                if remaining <= 0:
+                    log(self.log_filename, 'Gave up on {} peers after {}s'.format(
+                        len(pending), deadline), type='warning')
+                    break
+                _, pending = wait(pending, timeout=remaining,
+                                  return_when=FIRST_COMPLETED)
+                if min_owners and len(self.rfc_index.get_owners(rfc_name)) >= min_owners:
+                    break
+        finally:
+            # stragglers finish (or time out) in the background
+            executor.shutdown(wait=False, cancel_futures=True)
+        with self.rfc_server.lock:
+            return dict(self.rfc_index.get_owners(rfc_name))
+
+    # searches the rfcs of this peer and of every known peer for query
+    # returns up to limit (rfc, score, {'ip': port}) tuples, best match first,
+    # with the peers whose rfcs matched; scores from different peers are
+    # merged by keeping the highest
+    # @param peer_timeout and deadline are as for find_peers_with_rfc
+    def search(self, query: str, limit: int = DEFAULT_SEARCH_LIMIT, peer_timeout: float = DEFAULT_PEER_TIMEOUT,
+               deadline: float = DEFAULT_LOOKUP_DEADLINE) -> List[tuple]:
+        log(self.log_filename, 'Searching peers for {}!'.format(query), type='info')
+        self.query_for_peers()  # refreshing peer list
+        self_address = (self.rfc_server.host, self.rfc_server.port)
+        # rfc -> [score, owners]
+        results = {}
+
+        def merge(matches, peer_address):
+            for rfc, score in matches:
+                result = results.setdefault(rfc, [score, {}])
+                result[0] = max(result[0], score)
+                result[1][peer_address[0]] = peer_address[1]
+        merge(self.search_index.search(query, limit), self_address)
+        peers = [peer_address for peer_address in self.peer_list.items()
+                 if peer_address != self_address]
+        if peers:
+            executor = ThreadPoolExecutor(
+                max_workers=min(len(peers), DEFAULT_FANOUT_WORKERS))
+            try:
+                futures = {executor.submit(self.request_search, host, port, query, limit, peer_timeout): (host, port)
+                           for (host, port) in peers}
+                done, pending = wait(futures, timeout=deadline)
+                if pending:
+                    log(self.log_filename, 'Gave up on {} peers after {}s'.format(
+                        len(pending), deadline), type='warning')
+                for future in done:
+                    merge(future.result() or [], futures[future])
+            finally:
+                # stragglers finish (or time out) in the background
+                executor.shutdown(wait=False, cancel_futures=True)
+        ranked = sorted(results.items(),
+                        key=lambda item: (-item[1][0], item[0]))[:limit]
+        return [(rfc, score, owners) for rfc, (score, owners) in ranked]
+
+    # asks one peer for its best matches for query
+    # returns a list of (rfc, score) or None if the peer failed to answer
+    def request_search(self, peer_hostname: str, peer_port: int, query: str, limit: int,
+                       timeout: float = None) -> List[tuple]:
+        request = Message(MessageType.REQUEST_PEER)
+        request.method = MethodType.SEARCH
+        request.data = {'query': query, 'limit': limit}
+        try:
+            response_dict = exchange((peer_hostname, peer_port), request, timeout)
+            if response_dict['status_code'] != StatusCodes.SUCCESS.value:
+                log(self.log_filename, 'Peer @ {}:{} ran into error while searching - {}'.format(
+                    peer_hostname, peer_port, response_dict['data']), type='error')
+                return None
+            return [(rfc, score) for rfc, score in response_dict['data']]
+        except (socket.error, Exception) as e:
+            log(self.log_filename, 'Error while searching peer @ {}:{} - {}'.format(
+                peer_hostname, peer_port, e), type='error')
+            return None
+
+    # asks a peer for the metadata of its rfcs, see Catalog.query for fields,
+    # filter, sort and limit
+    # returns a list of {field: value} or None if the peer failed to answer
+    def request_catalog(self, peer_hostname: str, peer_port: int, fields: List[str] = None, filter: dict = None,
+                        sort: str = None, limit: int = None, timeout: float = None) -> List[dict]:
+        request = Message(MessageType.REQUEST_PEER)
+        request.method = MethodType.CATALOG
+        request.data = {key: value for key, value in (('fields', fields), ('filter', filter),
+                                                      ('sort', sort), ('limit', limit)) if value != None}
+        try:
+            response_dict = exchange((peer_hostname, peer_port), request, timeout)
+            if response_dict['status_code'] != StatusCodes.SUCCESS.value:
+                log(self.log_filename, 'Peer @ {}:{} ran into error while sending catalog - {}'.format(
+                    peer_hostname, peer_port, response_dict['data']), type='error')
+                return None
+            catalog = response_dict['data']
+            return [dict(zip(catalog['fields'], row)) for row in catalog['rows']]
+        except (socket.error, Exception) as e:
+            log(self.log_filename, 'Error while retrieving catalog from peer @ {}:{} - {}'.format(
+                peer_hostname, peer_port, e), type='error')
+            return None
+
+    # asks a peer's rfc server, or the registration server when no peer is
+    # given, for its request metrics, see Server.stats
+    # returns the metrics or None if the server failed to answer
+    def request_stats(self, peer_hostname: str = None, peer_port: int = None, timeout: float = None) -> dict:
+        if peer_hostname == None:
+            address = get_rs_address()
+            request = Message(MessageType.REQUEST_SERVER)
         else:
-            return self.rfc_index.rfcs[rfc_name].get_peers_who_own()
+            address = (peer_hostname, peer_port)
+            request = Message(MessageType.REQUEST_PEER)
+        request.method = MethodType.STATS
+        try:
+            response_dict = exchange(address, request, timeout)
+            if response_dict['status_code'] != StatusCodes.SUCCESS.value:
+                log(self.log_filename, 'Server @ {}:{} ran into error while sending stats - {}'.format(
+                    address[0], address[1], response_dict['data']), type='error')
+                return None
+            return response_dict['data']
+        except (socket.error, Exception) as e:
+            log(self.log_filename, 'Error while retrieving stats from server @ {}:{} - {}'.format(
+                address[0], address[1], e), type='error')
+            return None
 
-    # tries to find rfc, pinging every owner till its found
+    # requests length bytes of the rfc starting at offset and writes them at
+    # the same offset of fd, returns (total size of the rfc, manifest)
+    # with a manifest every chunk is checked against its hash as it arrives,
+    # without one the peer is asked for its manifest, which has to match
+    # digest if that is known; the peer may compress the range with any of
+    # SUPPORTED_CODECS
+    # @param handle lets another thread cancel the request
+    def request_rfc_range(self, rfc_name: str, peer_address: tuple, offset: int, length: int, fd: int,
+                          timeout: float = DEFAULT_TRANSFER_TIMEOUT, manifest: Content_Info = None,
+                          digest: str = None, handle: Range_Request = None) -> tuple:
+        request = Message(MessageType.REQUEST_PEER)
+        request.method = MethodType.GET_RFC
+        request.data = {'rfc': rfc_name, 'stream': True, 'offset': offset, 'length': length,
+                        'manifest': manifest == None, 'codecs': list(SUPPORTED_CODECS)}
+        with socket.create_connection(peer_address, timeout) as conn:
+            if handle != None:
+                handle.attach(conn)
+            send(conn, request.to_bytes())
+            response_dict = Message.bytes_to_dict(receive(conn))
+            if response_dict['status_code'] != StatusCodes.SUCCESS.value:
+                raise Exception('Peer indicated - {}'.format(
+                    response_dict.get('data')))
+            response_data = response_dict['data']
+            rfc_size = response_data['size']
+            # a compressed range is sent in 'length' bytes
+            encoding = response_data.get('encoding')
+            range_length = min(length, rfc_size - offset)
+            if response_data['offset'] != offset or (encoding == None and response_data['length'] != range_length):
+                raise Exception('Peer sent the wrong byte range!')
+            verify = manifest != None
+            if manifest == None:
+                manifest = self.check_manifest(rfc_size, response_data, digest)
+                # a range that does not line up with the peer's chunks is
+                # taken as is, download_rfc fetches it again in chunks
+                end = offset + range_length
+                verify = manifest != None and offset % manifest.chunk_size == 0 and (
+                    end == rfc_size or end % manifest.chunk_size == 0)
+            elif rfc_size != manifest.size:
+                raise HashMismatchException(
+                    'Peer has a copy of another size!')
+            if verify and encoding:
+                receive_decompressed_chunks(conn, response_data['length'], fd, encoding,
+                                            offset, range_length, manifest)
+            elif verify:
+                receive_chunks(conn, fd, offset, range_length, manifest)
+            elif encoding:
+                receive_decompressed_to_fd(conn, response_data['length'], fd, encoding,
+                                           range_length, offset)
+            else:
+                receive_to_fd(conn, range_length, fd, offset)
+            return rfc_size, manifest
+
+    # downloads the rfc in chunks of chunk_size bytes, spread over every
+    # owner at once; a chunk whose owner fails, times out or sends data that
+    # does not match the chunk's hash goes back in line for the remaining
+    # owners
+    # once every chunk has been handed out, owners that are done ask for the
+    # chunks still in flight too, and the first copy of a chunk to arrive
+    # cancels the others, so a slow owner does not hold up the end
+    def download_rfc(self, rfc_name: str, owners: List[tuple], chunk_size: int = DEFAULT_DOWNLOAD_CHUNK_SIZE) -> Boolean:
+        rfc_path = os.path.join(self.rfc_index.rfc_store, rfc_name)
+        temp_path = '{}.part'.format(rfc_path)
+        digest = self.rfc_index.get_digest(rfc_name)
+        fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        complete = False
+        try:
+            # the first chunk also tells us how large the rfc is and, from
+            # peers that keep them, the hashes of its chunks
+            idle = list(owners)
+            rfc_size = None
+            manifest = None
+            while idle and rfc_size == None:
+                owner = idle.pop(0)
+                try:
+                    rfc_size, manifest = self.request_rfc_range(
+                        rfc_name, owner, 0, chunk_size, fd, digest=digest)
+                    idle.append(owner)
+                except (socket.error, Exception) as e:
+                    log(self.log_filename, 'Peer @ {}:{} failed to send {} - {}'.format(
+                        owner[0], owner[1], rfc_name, e), type='error')
+            if rfc_size == None:
+                return False
+            if manifest:
+                digest = manifest.digest
+                if manifest.chunk_size != chunk_size:
+                    # ranges have to line up with the hashed chunks
+                    chunk_size = manifest.chunk_size
+                    pending_start = 0
+                else:
+                    pending_start = chunk_size
+            else:
+                pending_start = chunk_size
+            os.ftruncate(fd, rfc_size)
+            pending = deque(range(pending_start, rfc_size, chunk_size))
+            # future -> (owner, offset, handle)
+            running = {}
+            # offset -> futures fetching that chunk
+            copies = {}
+            finished = set()
+            with ThreadPoolExecutor(max_workers=len(owners)) as executor:
+
+                def fetch(owner, offset):
+                    handle = Range_Request()
+                    future = executor.submit(self.request_rfc_range, rfc_name, owner, offset, chunk_size,
+                                             fd, manifest=manifest, handle=handle)
+                    running[future] = (owner, offset, handle)
+                    copies.setdefault(offset, set()).add(future)
+
+                while pending or running:
+                    while pending and idle:
+                        fetch(idle.pop(0), pending.popleft())
+                    # endgame: the unfinished chunk with the fewest copies
+                    # in flight is asked for again
+                    while idle and not pending:
+                        unfinished = [offset for offset in copies
+                                      if offset not in finished]
+                        if not unfinished:
+                            break
+                        fetch(idle.pop(0), min(unfinished, key=lambda offset: len(copies[offset])))
+                    if not running:
+                        break
+                    done, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        owner, offset, handle = running.pop(future)
+                        others = copies.pop(offset)
+                        others.discard(future)
+                        if others:
+                            copies[offset] = others
+                        try:
+                            future.result()
+                            idle.append(owner)
+                            if offset not in finished:
+                                finished.add(offset)
+                                for other in others:
+                                    running[other][2].cancel()
+                        except (socket.error, Exception) as e:
+                            if offset in finished:
+                                # lost the race to another owner
+                                idle.append(owner)
+                                continue
+                            # owner is dropped for the rest of this download
+                            log(self.log_filename, 'Peer @ {}:{} failed to send {} bytes {}+ - {}'.format(
+                                owner[0], owner[1], rfc_name, offset, e), type='error')
+                            if not others:
+                                pending.appendleft(offset)
+            if pending:
+                log(self.log_filename, 'No owners left to finish downloading {}'.format(
+                    rfc_name), type='error')
+                return False
+            os.fsync(fd)
+            complete = True
+        finally:
+            os.close(fd)
+            if not complete:
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(temp_path)
+        if not self.store_rfc(rfc_name, temp_path, digest):
+            return False
+        log(self.log_filename, 'Successfully downloaded {} from {} peers!'.format(
+            rfc_name, len(owners)), type='info')
+        return True
+
+    # fetches the rfc from all its owners at once, falling back to asking
+    # owners one at a time for the whole file (this also covers legacy peers)
     def get_rfc(self, rfc_name: str) -> Boolean:
         rfc_owners = self.find_peers_with_rfc(rfc_name)
         if len(rfc_owners) == 0:
             return False
+        # same content already stored under another name
+        digest = self.rfc_index.get_digest(rfc_name)
+        if digest and self.content_store.has(digest):
+            self.content_store.add_existing(rfc_name, digest)
+            self.mark_owned(rfc_name, digest)
+            log(self.log_filename, '{} already stored, linked to {}'.format(
+                rfc_name, digest), type='info')
+            return True
+        owners = [owner for owner in rfc_owners.items()
+                  if owner not in legacy_peers]
+        if owners and self.download_rfc(rfc_name, owners):
+            return True
         for (host, port) in rfc_owners.items():
             if self.request_rfc(rfc_name, host, port):
                 return True
-        return True
+        return False
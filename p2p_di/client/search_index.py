@@ -0,0 +1,173 @@
+import gzip
+import json
+import math
+import os
+import re
+from collections import Counter
+from threading import Lock
+from typing import Dict, List, Tuple
+
+from p2p_di.utils.utils import SEARCH_BM25_B, SEARCH_BM25_K1
+
+# Full-text index over a peer's rfcs
+#
+# An inverted index from terms to the rfcs containing them, ranked with
+# BM25. Rfcs are added as they are loaded or downloaded and skipped when
+# their content digest has not changed. The index is kept next to the rfc
+# store as a gzipped json snapshot plus a journal of the rfcs added since,
+# one json line each, so adding an rfc appends a line instead of rewriting
+# the index and a restart does not read every rfc again. The journal is
+# folded into the snapshot by save(), or once it is JOURNAL_LIMIT lines
+# long. Text rfcs are indexed by content, other formats only by file name.
+
+TEXT_EXTENSIONS = ('.txt',)
+# runs of 2 to 32 letters and digits, longer runs are skipped
+TOKEN = re.compile(r'(?<![a-z0-9])[a-z0-9]{2,32}(?![a-z0-9])')
+STOP_WORDS = frozenset((
+    'a', 'an', 'and', 'are', 'as', 'at', 'be', 'by', 'for', 'from', 'has', 'in', 'is', 'it',
+    'its', 'may', 'must', 'not', 'of', 'on', 'or', 'such', 'that', 'the', 'this', 'to', 'which',
+    'will', 'with'))
+JOURNAL_LIMIT = 64
+
+
+def tokenize(text: str) -> List[str]:
+    return [token for token in TOKEN.findall(text.lower()) if token not in STOP_WORDS]
+
+
+# terms of an rfc: its name, e.g. rfc3501 and 3501, and the text of text rfcs
+def rfc_terms(rfc: str, path: str) -> List[str]:
+    stem = os.path.splitext(rfc)[0]
+    terms = tokenize(stem) + tokenize(re.sub(r'^rfc', '', stem.lower()))
+    if rfc.lower().endswith(TEXT_EXTENSIONS):
+        with open(path, 'rb') as file:
+            terms += tokenize(file.read().decode('utf-8', errors='ignore'))
+    return terms
+
+
+class Search_Index():
+
+    def __init__(self, path: str = None) -> None:
+        # file the index is saved to, None keeps it in memory only
+        self.path = path
+        self.journal_path = '{}.journal'.format(path) if path else None
+        self.journal_length = 0
+        self.lock = Lock()
+        # rfc -> (digest, number of terms)
+        self.docs: Dict[str, Tuple[str, int]] = {}
+        # term -> {rfc: occurrences}
+        self.postings: Dict[str, Dict[str, int]] = {}
+        self.total_terms = 0
+        self.dirty = False
+        if path:
+            self.load()
+
+    def __len__(self) -> int:
+        return len(self.docs)
+
+    # indexes the rfc stored at path, unless its digest is already indexed
+    # @param journal set to False when adding many rfcs followed by save()
+    def add(self, rfc: str, path: str, digest: str = None, journal=True) -> bool:
+        with self.lock:
+            if digest != None and self.docs.get(rfc, (None,))[0] == digest:
+                return False
+        counts = Counter(rfc_terms(rfc, path))
+        with self.lock:
+            self.insert(rfc, digest, counts)
+            if self.journal_path and journal:
+                with open(self.journal_path, 'a') as file:
+                    file.write(json.dumps([rfc, digest, counts], separators=(',', ':')) + '\n')
+                self.journal_length += 1
+            compact = self.journal_length >= JOURNAL_LIMIT
+        if compact:
+            self.save()
+        return True
+
+    # call with lock held
+    def insert(self, rfc: str, digest: str, counts: Dict[str, int]) -> None:
+        self.remove(rfc)
+        for term, count in counts.items():
+            self.postings.setdefault(term, {})[rfc] = count
+        length = sum(counts.values())
+        self.docs[rfc] = (digest, length)
+        self.total_terms += length
+        self.dirty = True
+
+    # call with lock held
+    def remove(self, rfc: str) -> None:
+        if rfc not in self.docs:
+            return
+        self.total_terms -= self.docs.pop(rfc)[1]
+        for term in [term for term, rfcs in self.postings.items() if rfc in rfcs]:
+            del self.postings[term][rfc]
+            if not self.postings[term]:
+                del self.postings[term]
+        self.dirty = True
+
+    # returns up to limit (rfc, score) pairs, best match first
+    def search(self, query: str, limit: int) -> List[Tuple[str, float]]:
+        terms = set(tokenize(query))
+        scores = Counter()
+        with self.lock:
+            if not self.docs:
+                return []
+            doc_count = len(self.docs)
+            average_length = max(1, self.total_terms / doc_count)
+            for term in terms:
+                rfcs = self.postings.get(term)
+                if not rfcs:
+                    continue
+                idf = math.log(1 + (doc_count - len(rfcs) + 0.5) / (len(rfcs) + 0.5))
+                for rfc, count in rfcs.items():
+                    length = self.docs[rfc][1]
+                    scores[rfc] += idf * count * (SEARCH_BM25_K1 + 1) / (count + SEARCH_BM25_K1 * (
+                        1 - SEARCH_BM25_B + SEARCH_BM25_B * length / average_length))
+        return [(rfc, round(score, 4)) for rfc, score in scores.most_common(limit)]
+
+    # writes the index to path and empties the journal, if the index changed
+    # since it was last saved; postings are stored against document numbers
+    # to keep the file small
+    def save(self) -> None:
+        if not self.path:
+            return
+        with self.lock:
+            if not self.dirty:
+                return
+            rfcs = list(self.docs)
+            numbers = {rfc: number for number, rfc in enumerate(rfcs)}
+            data = {'docs': [[rfc, self.docs[rfc][0], self.docs[rfc][1]] for rfc in rfcs],
+                    'postings': {term: [value for rfc, count in entries.items() for value in (numbers[rfc], count)]
+                                 for term, entries in self.postings.items()}}
+            self.dirty = False
+            # rfcs journaled from here on are not in this snapshot
+            temp_path = '{}.part'.format(self.path)
+            with open(temp_path, 'wb') as file:
+                file.write(gzip.compress(json.dumps(
+                    data, separators=(',', ':')).encode('utf-8'), compresslevel=1))
+            os.replace(temp_path, self.path)
+            with open(self.journal_path, 'w'):
+                pass
+            self.journal_length = 0
+
+    # reads the snapshot, then replays the journal on top of it
+    def load(self) -> None:
+        with self.lock:
+            if os.path.isfile(self.path):
+                with open(self.path, 'rb') as file:
+                    data = json.loads(gzip.decompress(file.read()))
+                rfcs = [doc[0] for doc in data['docs']]
+                self.docs = {rfc: (digest, length)
+                             for rfc, digest, length in data['docs']}
+                self.postings = {term: {rfcs[entries[i]]: entries[i + 1] for i in range(0, len(entries), 2)}
+                                 for term, entries in data['postings'].items()}
+                self.total_terms = sum(length for _, length in self.docs.values())
+            self.dirty = False
+            if os.path.isfile(self.journal_path):
+                with open(self.journal_path) as file:
+                    for line in file:
+                        try:
+                            rfc, digest, counts = json.loads(line)
+                        except ValueError:
+                            # a line cut short by a crash
+                            continue
+                        self.insert(rfc, digest, counts)
+                        self.journal_length += 1
@@ -0,0 +1,294 @@
+import time
+from threading import Lock, current_thread, local
+from typing import Dict, List
+
+from p2p_di.utils.utils import METRICS_SHARD_FOLD_THRESHOLD
+
+# Request metrics of a server
+#
+# Every thread that serves requests counts into a shard of its own, so
+# recording a request takes no lock and never waits on another thread;
+# reading the metrics adds up all shards. Shards of threads that have
+# finished, e.g. the per connection threads of the threaded serving mode,
+# are folded into one retired shard. Durations are kept in histograms with
+# one bucket per power of two microseconds, percentiles are reported as the
+# upper bound of the bucket they fall in.
+
+HISTOGRAM_BUCKETS = 40
+# label for requests whose method could not be read
+UNKNOWN_METHOD = 'UNKNOWN'
+
+
+# bucket i counts durations below 2 ** i microseconds
+class Histogram():
+
+    __slots__ = ('buckets', 'count', 'total', 'max')
+
+    def __init__(self) -> None:
+        self.buckets = [0] * HISTOGRAM_BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    # @param seconds is the duration to count
+    def add(self, seconds: float) -> None:
+        self.buckets[min(int(seconds * 1e6).bit_length(),
+                         HISTOGRAM_BUCKETS - 1)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def merge(self, other) -> None:
+        for i, count in enumerate(list(other.buckets)):
+            self.buckets[i] += count
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    # returns the upper bound, in seconds, of the bucket holding quantile q
+    def percentile(self, q: float) -> float:
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.buckets):
+            seen += count
+            if seen >= rank:
+                return min((1 << i) / 1e6, self.max)
+        return self.max
+
+    def summary(self) -> dict:
+        return {'count': self.count, 'total': round(self.total, 6),
+                'mean': round(self.total / self.count, 6) if self.count else 0.0,
+                'p50': round(self.percentile(0.5), 6), 'p99': round(self.percentile(0.99), 6),
+                'max': round(self.max, 6)}
+
+
+class Method_Counters():
+
+    __slots__ = ('count', 'errors', 'bytes_in', 'bytes_out', 'latency')
+
+    def __init__(self) -> None:
+        self.count = 0
+        self.errors = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.latency = Histogram()
+
+    def merge(self, other) -> None:
+        self.count += other.count
+        self.errors += other.errors
+        self.bytes_in += other.bytes_in
+        self.bytes_out += other.bytes_out
+        self.latency.merge(other.latency)
+
+
+class Lock_Counters():
+
+    __slots__ = ('acquired', 'contended', 'wait')
+
+    def __init__(self) -> None:
+        self.acquired = 0
+        # acquisitions that had to wait, their waits are in wait
+        self.contended = 0
+        self.wait = Histogram()
+
+    def merge(self, other) -> None:
+        self.acquired += other.acquired
+        self.contended += other.contended
+        self.wait.merge(other.wait)
+
+
+# counters written by one thread only
+class Shard():
+
+    def __init__(self) -> None:
+        self.opened = 0
+        self.closed = 0
+        # method name -> Method_Counters
+        self.methods: Dict[str, Method_Counters] = {}
+        # lock name -> Lock_Counters
+        self.locks: Dict[str, Lock_Counters] = {}
+
+    def merge(self, other) -> None:
+        self.opened += other.opened
+        self.closed += other.closed
+        for method, counters in list(other.methods.items()):
+            self.methods.setdefault(method, Method_Counters()).merge(counters)
+        for name, counters in list(other.locks.items()):
+            self.locks.setdefault(name, Lock_Counters()).merge(counters)
+
+
+class Metrics():
+
+    def __init__(self) -> None:
+        self.local = local()
+        # guards shards and retired, never taken to record
+        self.lock = Lock()
+        # (thread, shard) of every thread that recorded something
+        self.shards = []
+        self.retired = Shard()
+
+    # shard of the calling thread
+    def shard(self) -> Shard:
+        try:
+            return self.local.shard
+        except AttributeError:
+            pass
+        shard = self.local.shard = Shard()
+        with self.lock:
+            if len(self.shards) >= METRICS_SHARD_FOLD_THRESHOLD:
+                self.fold()
+            self.shards.append((current_thread(), shard))
+        return shard
+
+    # call with lock held
+    def fold(self) -> None:
+        alive = []
+        for thread, shard in self.shards:
+            if thread.is_alive():
+                alive.append((thread, shard))
+            else:
+                self.retired.merge(shard)
+        self.shards = alive
+
+    def connection_opened(self) -> None:
+        self.shard().opened += 1
+
+    def connection_closed(self) -> None:
+        self.shard().closed += 1
+
+    # counts a request
+    # @param seconds is the time from reading the request to sending the
+    # response
+    def record(self, method: str, seconds: float, bytes_in: int, bytes_out: int, error=False) -> None:
+        methods = self.shard().methods
+        counters = methods.get(method)
+        if counters == None:
+            counters = methods[method] = Method_Counters()
+        counters.count += 1
+        counters.errors += error
+        counters.bytes_in += bytes_in
+        counters.bytes_out += bytes_out
+        counters.latency.add(seconds)
+
+    # counts an acquisition of the lock called name
+    # @param wait is the time spent waiting for it, None if it was free
+    def record_lock(self, name: str, wait: float = None) -> None:
+        locks = self.shard().locks
+        counters = locks.get(name)
+        if counters == None:
+            counters = locks[name] = Lock_Counters()
+        counters.acquired += 1
+        if wait != None:
+            counters.contended += 1
+            counters.wait.add(wait)
+
+    # all shards added up
+    def total(self) -> Shard:
+        total = Shard()
+        with self.lock:
+            self.fold()
+            total.merge(self.retired)
+            shards = [shard for _, shard in self.shards]
+        for shard in shards:
+            total.merge(shard)
+        return total
+
+    def snapshot(self) -> dict:
+        total = self.total()
+        return {
+            'active_connections': total.opened - total.closed,
+            'connections': total.opened,
+            'methods': {method: {'count': counters.count, 'errors': counters.errors,
+                                 'bytes_in': counters.bytes_in, 'bytes_out': counters.bytes_out,
+                                 'latency': counters.latency.summary()}
+                        for method, counters in sorted(total.methods.items())},
+            'locks': {name: {'acquired': counters.acquired, 'contended': counters.contended,
+                             'wait': counters.wait.summary()}
+                      for name, counters in sorted(total.locks.items())}}
+
+    # returns the metrics in the prometheus text format
+    # @param server is the value of the server label
+    # @param gauges is {name: number} of other values to export
+    def to_prometheus(self, server: str, gauges: dict = None) -> str:
+        total = self.total()
+        lines = []
+
+        def metric(name: str, kind: str, samples: List[tuple]) -> None:
+            lines.append('# TYPE p2p_di_{} {}'.format(name, kind))
+            for suffix, labels, value in samples:
+                labels = dict(labels, server=server)
+                lines.append('p2p_di_{}{}{{{}}} {}'.format(name, suffix, ','.join(
+                    '{}="{}"'.format(key, labels[key]) for key in sorted(labels)), value))
+
+        def histogram(labels: dict, histogram: Histogram) -> List[tuple]:
+            samples = []
+            seen = 0
+            for i, count in enumerate(histogram.buckets[:-1]):
+                seen += count
+                samples.append(
+                    ('_bucket', dict(labels, le=repr((1 << i) / 1e6)), seen))
+            samples.append(('_bucket', dict(labels, le='+Inf'), histogram.count))
+            samples.append(('_sum', labels, repr(histogram.total)))
+            samples.append(('_count', labels, histogram.count))
+            return samples
+
+        methods = sorted(total.methods.items())
+        metric('requests_total', 'counter', [
+            ('', {'method': method}, counters.count) for method, counters in methods])
+        metric('request_errors_total', 'counter', [
+            ('', {'method': method}, counters.errors) for method, counters in methods])
+        metric('request_bytes_in_total', 'counter', [
+            ('', {'method': method}, counters.bytes_in) for method, counters in methods])
+        metric('request_bytes_out_total', 'counter', [
+            ('', {'method': method}, counters.bytes_out) for method, counters in methods])
+        metric('request_duration_seconds', 'histogram', [
+            sample for method, counters in methods
+            for sample in histogram({'method': method}, counters.latency)])
+        metric('active_connections', 'gauge', [
+               ('', {}, total.opened - total.closed)])
+        locks = sorted(total.locks.items())
+        metric('lock_acquisitions_total', 'counter', [
+            ('', {'lock': name}, counters.acquired) for name, counters in locks])
+        metric('lock_wait_seconds', 'histogram', [
+            sample for name, counters in locks
+            for sample in histogram({'lock': name}, counters.wait)])
+        for name, value in sorted((gauges or {}).items()):
+            metric(name, 'gauge', [('', {}, value)])
+        return '\n'.join(lines) + '\n'
+
+
+# lock that counts its acquisitions, and the time spent waiting for the
+# ones that could not be taken right away, into metrics under name
+class Timed_Lock():
+
+    __slots__ = ('lock', 'metrics', 'name')
+
+    def __init__(self, lock, metrics: Metrics, name: str) -> None:
+        self.lock = lock
+        self.metrics = metrics
+        self.name = name
+
+    def acquire(self, blocking=True, timeout=-1) -> bool:
+        if self.lock.acquire(False):
+            self.metrics.record_lock(self.name)
+            return True
+        if not blocking:
+            return False
+        start = time.perf_counter()
+        acquired = self.lock.acquire(True, timeout)
+        if acquired:
+            self.metrics.record_lock(
+                self.name, time.perf_counter() - start)
+        return acquired
+
+    def release(self) -> None:
+        self.lock.release()
+
+    def __enter__(self) -> bool:
+        return self.acquire()
+
+    def __exit__(self, *args) -> None:
+        self.release()
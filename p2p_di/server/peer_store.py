@@ -0,0 +1,254 @@
+import sqlite3
+from threading import Event, Lock, Thread
+from typing import List
+
+import tinydb
+from p2p_di.server.metrics import Timed_Lock
+from p2p_di.utils.utils import (DEFAULT_FLUSH_INTERVAL, DEFAULT_FLUSH_THRESHOLD,
+                                DEFAULT_LOCK_STRIPES, log)
+
+# Persistence for the registration server's peer list
+#
+# Request handlers never touch the disk. They record inserts and updates on
+# a Write_Behind_Store, which coalesces them per cookie and hands them to
+# the backing store in one batch every flush_interval seconds, or sooner
+# once flush_threshold cookies are dirty. The pending changes are striped by
+# cookie like the peer locks of the registration server, so handlers of
+# different peers rarely wait on each other. stop() flushes whatever is left.
+#
+# Durability window: a crash loses at most the mutations of the last
+# flush_interval seconds (DEFAULT_FLUSH_INTERVAL unless configured). Peers
+# recover from that by re-registering, which they do once their keep alive
+# is refused.
+
+
+# peer list kept in a TinyDB json file
+# TinyDB rewrites the whole file on every write, so all changes of a batch
+# go in a single update and a single insert
+class TinyDB_Peer_Store():
+
+    def __init__(self, db_path) -> None:
+        open(db_path, 'a+').close()  # creating the file
+        self.db = tinydb.TinyDB(db_path)
+
+    def all(self) -> List[dict]:
+        return self.db.all()
+
+    # @param inserts is cookie -> full peer record
+    # @param updates is cookie -> changed fields, for peers already stored
+    def write_batch(self, inserts: dict, updates: dict) -> None:
+        if updates:
+            Peer = tinydb.Query()
+
+            def apply_update(document):
+                document.update(updates[document['cookie']])
+            self.db.update(apply_update, Peer.cookie.one_of(set(updates)))
+        if inserts:
+            self.db.insert_multiple(inserts.values())
+
+    def truncate(self) -> None:
+        self.db.truncate()
+
+    def close(self) -> None:
+        self.db.close()
+
+
+# peer list kept in an sqlite database
+# WAL mode lets a batch commit without blocking reads, cookie is the primary
+# key and last_active is indexed for queries on recently seen peers
+class SQLite_Peer_Store():
+
+    columns = ('cookie', 'name', 'hostname', 'port',
+               'last_active', 'registration_number')
+
+    def __init__(self, db_path) -> None:
+        # used from the flush thread as well, calls are serialized by lock
+        self.connection = sqlite3.connect(db_path, check_same_thread=False)
+        self.lock = Lock()
+        with self.lock, self.connection:
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('PRAGMA synchronous=NORMAL')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS peers ('
+                                    'cookie TEXT PRIMARY KEY, name TEXT, hostname TEXT, port INTEGER, '
+                                    'last_active REAL, registration_number INTEGER)')
+            self.connection.execute(
+                'CREATE INDEX IF NOT EXISTS peers_last_active ON peers (last_active)')
+        self.insert_statement = 'INSERT INTO peers ({}) VALUES ({}) ON CONFLICT (cookie) DO UPDATE SET {}'.format(
+            ', '.join(self.columns), ', '.join('?' * len(self.columns)),
+            ', '.join('{0} = excluded.{0}'.format(column) for column in self.columns[1:]))
+
+    def all(self) -> List[dict]:
+        with self.lock:
+            rows = self.connection.execute(
+                'SELECT {} FROM peers'.format(', '.join(self.columns))).fetchall()
+        return [dict(zip(self.columns, row)) for row in rows]
+
+    # @param inserts is cookie -> full peer record
+    # @param updates is cookie -> changed fields, for peers already stored
+    def write_batch(self, inserts: dict, updates: dict) -> None:
+        # one prepared statement per set of changed columns
+        statements = {}
+        for cookie, fields in updates.items():
+            changed = tuple(sorted(column for column in fields
+                                   if column in self.columns and column != 'cookie'))
+            if changed:
+                statements.setdefault(changed, []).append(
+                    [fields[column] for column in changed] + [cookie])
+        with self.lock, self.connection:
+            if inserts:
+                self.connection.executemany(self.insert_statement, (
+                    [document.get(column) for column in self.columns] for document in inserts.values()))
+            for changed, rows in statements.items():
+                self.connection.executemany('UPDATE peers SET {} WHERE cookie = ?'.format(
+                    ', '.join('{} = ?'.format(column) for column in changed)), rows)
+
+    def truncate(self) -> None:
+        with self.lock, self.connection:
+            self.connection.execute('DELETE FROM peers')
+
+    def close(self) -> None:
+        with self.lock:
+            self.connection.close()
+
+
+# buffers peer list changes in memory and writes them to a backing store
+# from a background thread
+class Write_Behind_Store():
+
+    # @param store is the backing store, e.g. TinyDB_Peer_Store
+    # @param flush_interval is the most seconds a change stays in memory
+    # @param flush_threshold is the number of dirty peers that triggers an
+    # early flush
+    # @param stripes is the number of locks the pending changes are spread
+    # over, by cookie
+    # @param metrics records acquisitions and waits of the stripe locks
+    def __init__(self, store, flush_interval=DEFAULT_FLUSH_INTERVAL,
+                 flush_threshold=DEFAULT_FLUSH_THRESHOLD, log_filename=None,
+                 stripes=DEFAULT_LOCK_STRIPES, metrics=None) -> None:
+        self.store = store
+        self.flush_interval = flush_interval
+        self.flush_threshold = flush_threshold
+        self.log_filename = log_filename
+        # each stripe holds the pending changes of its cookies, its lock is
+        # held only to record or swap them
+        self.locks = [Lock() if metrics == None else Timed_Lock(Lock(), metrics, 'store')
+                      for _ in range(stripes)]
+        self.pending_inserts = [{} for _ in range(stripes)]
+        self.pending_updates = [{} for _ in range(stripes)]
+        # a stripe asks for a flush at its share of flush_threshold, cookies
+        # are spread evenly so the total is close to flush_threshold then
+        self.stripe_threshold = max(1, -(-flush_threshold // stripes))
+        # serializes writes to the backing store
+        self.flush_lock = Lock()
+        self.flush_needed = Event()
+        self.running = False
+        self.flush_thread: Thread = None
+
+    def start(self) -> None:
+        self.running = True
+        self.flush_thread = Thread(target=self.flush_loop, daemon=True)
+        self.flush_thread.start()
+
+    def stripe(self, cookie) -> int:
+        return hash(cookie) % len(self.locks)
+
+    # records a new peer, re-inserting a known cookie replaces its record
+    def insert(self, document: dict) -> None:
+        cookie = document['cookie']
+        index = self.stripe(cookie)
+        with self.locks[index]:
+            self.pending_updates[index].pop(cookie, None)
+            self.pending_inserts[index][cookie] = dict(document)
+            self.check_threshold(index)
+
+    # records changed fields of a peer, merged with its earlier changes
+    def update(self, cookie, fields: dict) -> None:
+        index = self.stripe(cookie)
+        with self.locks[index]:
+            if cookie in self.pending_inserts[index]:
+                self.pending_inserts[index][cookie].update(fields)
+            else:
+                self.pending_updates[index].setdefault(
+                    cookie, {}).update(fields)
+            self.check_threshold(index)
+
+    # call with the lock of the stripe held
+    def check_threshold(self, index) -> None:
+        if len(self.pending_inserts[index]) + len(self.pending_updates[index]) >= self.stripe_threshold:
+            self.flush_needed.set()
+
+    def dirty_count(self) -> int:
+        count = 0
+        for index, lock in enumerate(self.locks):
+            with lock:
+                count += len(self.pending_inserts[index]) + \
+                    len(self.pending_updates[index])
+        return count
+
+    # writes all pending changes to the backing store
+    def flush(self) -> None:
+        with self.flush_lock:
+            inserts, updates = {}, {}
+            for index, lock in enumerate(self.locks):
+                with lock:
+                    inserts.update(self.pending_inserts[index])
+                    updates.update(self.pending_updates[index])
+                    self.pending_inserts[index] = {}
+                    self.pending_updates[index] = {}
+            if not inserts and not updates:
+                return
+            try:
+                self.store.write_batch(inserts, updates)
+            except Exception:
+                # put the batch back under any newer changes so it is retried
+                for cookie, fields in updates.items():
+                    index = self.stripe(cookie)
+                    with self.locks[index]:
+                        if cookie in self.pending_inserts[index]:
+                            continue
+                        fields.update(
+                            self.pending_updates[index].get(cookie, {}))
+                        self.pending_updates[index][cookie] = fields
+                for cookie, document in inserts.items():
+                    index = self.stripe(cookie)
+                    with self.locks[index]:
+                        document.update(
+                            self.pending_updates[index].pop(cookie, {}))
+                        document.update(
+                            self.pending_inserts[index].get(cookie, {}))
+                        self.pending_inserts[index][cookie] = document
+                raise
+
+    def flush_loop(self) -> None:
+        while self.running:
+            self.flush_needed.wait(self.flush_interval)
+            self.flush_needed.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                if self.log_filename:
+                    log(self.log_filename, 'Failed to persist peer list - {}'.format(
+                        e), type='error')
+
+    # reads the stored peers, pending changes are flushed first
+    def all(self) -> List[dict]:
+        self.flush()
+        return self.store.all()
+
+    # drops stored and pending peers
+    def truncate(self) -> None:
+        with self.flush_lock:
+            for index, lock in enumerate(self.locks):
+                with lock:
+                    self.pending_inserts[index] = {}
+                    self.pending_updates[index] = {}
+            self.store.truncate()
+
+    # stops the flush thread and writes the remaining changes
+    def close(self) -> None:
+        self.running = False
+        self.flush_needed.set()
+        if self.flush_thread is not None:
+            self.flush_thread.join()
+        self.flush()
+        self.store.close()
@@ -0,0 +1,70 @@
+from collections import OrderedDict
+from threading import Lock
+
+from p2p_di.utils.utils import DEFAULT_RESPONSE_CACHE_SIZE
+
+# LRU cache of encoded responses
+#
+# Entries hold a response exactly as it goes on the wire, frame header
+# included, together with the file stream that follows it. Every entry
+# carries a tag describing the state it was built from (the rfc index
+# version, the stat of the rfc file); a lookup with a different tag drops
+# the entry instead of returning it. Entries are evicted least recently
+# used first once their total size exceeds max_bytes.
+
+
+class Response_Cache():
+
+    def __init__(self, max_bytes=DEFAULT_RESPONSE_CACHE_SIZE) -> None:
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.lock = Lock()
+        # key -> (tag, framed bytes, stream)
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    # returns (framed bytes, stream) of the entry for key, None if there is
+    # no entry built from the state described by tag
+    def get(self, key, tag) -> tuple:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry != None and entry[0] != tag:
+                self.remove(key)
+                self.invalidations += 1
+                entry = None
+            if entry == None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1], entry[2]
+
+    def put(self, key, tag, framed: bytes, stream: tuple = None) -> None:
+        if len(framed) > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.remove(key)
+            self.entries[key] = (tag, framed, stream)
+            self.size += len(framed)
+            while self.size > self.max_bytes:
+                self.remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    # call with lock held
+    def remove(self, key) -> None:
+        self.size -= len(self.entries.pop(key)[1])
+
+    def clear(self) -> None:
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'invalidations': self.invalidations, 'entries': len(self.entries),
+                    'bytes': self.size, 'max_bytes': self.max_bytes}
@@ -1,55 +1,160 @@
+from __future__ import annotations
+
+import asyncio
 import contextlib
 import datetime
 import os
 import socket
+import time
+from ast import literal_eval
 from math import inf
-from threading import Lock
-from typing import Any, Dict
-from p2p_di.client.rfc_client import RFC_Index
+from threading import Lock, Thread
+from typing import TYPE_CHECKING, Any, Dict, List, Tuple
+
+from p2p_di.client.catalog import FIELDS as CATALOG_FIELDS
+from p2p_di.server.metrics import Timed_Lock
+from p2p_di.server.response_cache import Response_Cache
 from p2p_di.server.server import Server
+from p2p_di.utils.compression import Compression_Cache, choose_codec
 from p2p_di.utils.message import Message, MessageType, MethodType, StatusCodes
-from p2p_di.utils.utils import (BadFormatException, find_free_port, get_rfc_data,
-                                get_rs_address, log, receive, send)
+from p2p_di.utils.utils import (DEFAULT_CHUNK_SIZE, DEFAULT_HEARTBEAT_TIMEOUT,
+                                DEFAULT_RESPONSE_CACHE_SIZE,
+                                DEFAULT_SEARCH_LIMIT, FRAME_HEADER,
+                                HEARTBEAT_PING, HEARTBEAT_WANT_REPLY,
+                                MAX_SEARCH_LIMIT,
+                                BadFormatException, Token_Bucket,
+                                exchange, find_free_port, get_rfc_data,
+                                get_logger, get_rs_address, log,
+                                pack_heartbeat,
+                                unpack_heartbeat)
+
+if TYPE_CHECKING:
+    from p2p_di.client.rfc_client import RFC_Index
 
 
 class RFC_Server(Server):
 
+    request_type = MessageType.REQUEST_PEER
+    response_type = MessageType.PEER_RESPONSE
+    stats_name = 'rfc_server'
+
     # constructor
     # set clean to false to have server use existing log
-    def __init__(self, client_name, client_rfc_index: RFC_Index, clean=True, port: int = None) -> None:
-        super().__init__()
+    # @param response_cache_size is the most bytes of encoded responses kept
+    # for repeated RFC_QUERY and GET_RFC requests, 0 disables the cache
+    # @param upload_rate caps the bytes per second of rfc data sent to other
+    # peers, shared by all transfers; None for no cap
+    # server_options are passed on to Server (e.g. mode='asyncio')
+    def __init__(self, client_name, client_rfc_index: RFC_Index, clean=True, port: int = None,
+                 response_cache_size=DEFAULT_RESPONSE_CACHE_SIZE, upload_rate: int = None,
+                 **server_options) -> None:
+        super().__init__(**server_options)
         self.client_rfc_index = client_rfc_index
-        self.lock = Lock()
+        self.upload_bucket = Token_Bucket(
+            upload_rate, DEFAULT_CHUNK_SIZE) if upload_rate else None
+        self.upload_lock = Lock()
+        # guards the rfc index, waits for it are counted in the metrics
+        self.lock = Timed_Lock(Lock(), self.metrics, 'index')
+        self.response_cache = Response_Cache(response_cache_size)
+        # udp socket for heartbeats to the RS, opened on first use
+        self.heartbeat_socket: socket.socket = None
+        self.handlers = {
+            MethodType.RFC_QUERY.name: self.send_rfc_index,
+            MethodType.GET_RFC.name: self.send_rfc,
+            MethodType.SEARCH.name: self.send_search_results,
+            MethodType.CATALOG.name: self.send_catalog,
+            MethodType.STATS.name: self.send_stats,
+        }
 
         base_path = os.path.dirname(__file__)
         log_path = os.path.join(
             base_path, '..', '..', 'assets', 'peer', client_name, 'rfc_server_log.txt')
         self.log_filename = log_path
+        # compressed copies of the rfcs served, next to the rfc store
+        self.compression_cache = Compression_Cache(os.path.join(
+            base_path, '..', '..', 'assets', 'peer', client_name, 'rfc_cache'))
 
         if clean:
             with contextlib.suppress(FileNotFoundError):
                 with open(self.log_filename, 'w') as file:
                     now = datetime.datetime.now()
-                    file.write('New log for RFC server created at:',
-                               now.isoformat())
+                    file.write('New log for RFC server created at: {}'.format(
+                               now.isoformat()))
         else:
             with open(self.log_filename, 'a') as file:
                 now = datetime.datetime.now()
-                file.write('New RFC server instance created at:',
-                           now.isoformat())
+                file.write('New RFC server instance created at: {}'.format(
+                           now.isoformat()))
+        # log() writes to log_filename through this logger
+        get_logger('rfc_server.{}'.format(client_name), self.log_filename)
         self.startup(port)
 
     # Adding default port in override
+    # serves from a background thread so the owning client is not blocked
     def startup(self, port=None, period=inf) -> None:
         self.port: int = port
         if port == None:
             self.port = find_free_port()
             log(self.log_filename, 'Using free port {}!'.format(
                 self.port), type='info')
-        super().startup(self.port, period)
+        self.bind(self.port)
+        self.serve_thread = Thread(
+            target=self.serve, args=(period,), daemon=True)
+        self.serve_thread.start()
         log(self.log_filename, 'Server listening at port {}!'.format(
             self.port), type='info')
 
+    # answers repeated RFC_QUERY and GET_RFC requests with the bytes sent the
+    # last time, as long as the index and the rfc file have not changed
+    # identical requests are byte for byte the same, so the request itself is
+    # the cache key
+    def handle_request(self, received: bytes, peer_address) -> Message:
+        tag = self.cache_tag(received)
+        if tag != None:
+            key = bytes(received)
+            cached = self.response_cache.get(key, tag)
+            if cached != None:
+                response = Message(self.response_type)
+                response.framed, response.stream = cached
+                response.request_method = tag[0]
+                return response
+        response = super().handle_request(received, peer_address)
+        if tag != None and response.status_code == StatusCodes.SUCCESS.value:
+            data = response.to_bytes()
+            response.framed = FRAME_HEADER.pack(len(data)) + data
+            self.response_cache.put(
+                key, tag, response.framed, response.stream)
+        return response
+
+    # returns what the response to a request depends on: the method and the
+    # index's epoch and version for RFC_QUERY, the method and the rfc file's
+    # inode, mtime and size for GET_RFC; None for requests that are not cached
+    def cache_tag(self, received: bytes) -> tuple:
+        if self.response_cache.max_bytes <= 0:
+            return None
+        try:
+            message_dict = Message.bytes_to_dict(received)
+            method = message_dict.get('method')
+            with self.lock:
+                index = self.client_rfc_index
+                if method == MethodType.RFC_QUERY.name:
+                    return (method, index.epoch, index.version)
+                if method != MethodType.GET_RFC.name:
+                    return None
+                request_data = message_dict['data']
+                rfc = request_data['rfc'] if isinstance(
+                    request_data, dict) else request_data
+                if isinstance(rfc, list):
+                    rfc = rfc[0]
+                if not index.is_owned(rfc):
+                    return None
+                rfc_store = index.rfc_store
+            stat = os.stat(os.path.join(rfc_store, rfc))
+            return (method, stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        except Exception:
+            # the handler reports bad requests
+            return None
+
     # server_owner is name + random int, not ip
     def register(self, server_owner: str, current_cookie: str = None) -> str:
         message = Message(MessageType.REQUEST_SERVER)
@@ -57,23 +162,18 @@ class RFC_Server(Server):
         message.headers['hostname'] = self.host
         if current_cookie:
             message.headers['cookie'] = current_cookie
-        message.data = {'name': server_owner,
-                        'hostname': self.host, 'port': self.port}
+        message.data = self.registration_data(server_owner)
         rs_address = get_rs_address()
         try:
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as conn:
-                conn.connect(rs_address)
-                send(conn, message.to_bytes())
-                response_bytes = receive(conn)
-                response_dict = Message.bytes_to_dict(response_bytes)
-                if response_dict['message_type'] != MessageType.SERVER_RESPONSE.name:
-                    log(self.log_filename,
-                        'Response sent by registration server might be invalid!', type='warning')
-                if response_dict['status_code'] != StatusCodes.SUCCESS.value:
-                    raise Exception(
-                        'Server indicated - {}'.format(response_dict['status_code']))
-                response_data = response_dict['data']
-                rs_cookie = response_data['cookie']
+            response_dict = exchange(rs_address, message)
+            if response_dict['message_type'] != MessageType.SERVER_RESPONSE.name:
+                log(self.log_filename,
+                    'Response sent by registration server might be invalid!', type='warning')
+            if response_dict['status_code'] != StatusCodes.SUCCESS.value:
+                raise Exception(
+                    'Server indicated - {}'.format(response_dict['status_code']))
+            response_data = response_dict['data']
+            rs_cookie = response_data['cookie']
         except KeyError as e:
             log(self.log_filename, 'Missing data from server response: {}'.format(
                 e), type='error')
@@ -86,116 +186,306 @@ class RFC_Server(Server):
             rs_address[0], rs_address[1]), type='info')
         return rs_cookie
 
+    # sends a keep alive datagram to the registration server
+    # returns the kind of the reply (HEARTBEAT_ACK / HEARTBEAT_REJECT), None
+    # if no reply came within timeout or want_reply is False
+    def send_heartbeat(self, cookie: str, want_reply=True, timeout=DEFAULT_HEARTBEAT_TIMEOUT) -> int:
+        try:
+            if self.heartbeat_socket == None:
+                self.heartbeat_socket = socket.socket(
+                    socket.AF_INET, socket.SOCK_DGRAM)
+                # the rs takes heartbeats on the udp port numbered like its
+                # tcp port
+                self.heartbeat_socket.connect(get_rs_address())
+            self.heartbeat_socket.settimeout(timeout)
+            self.heartbeat_socket.send(pack_heartbeat(
+                HEARTBEAT_PING, cookie, HEARTBEAT_WANT_REPLY if want_reply else 0))
+            if not want_reply:
+                return
+            while True:
+                heartbeat = unpack_heartbeat(self.heartbeat_socket.recv(64))
+                # skips late replies meant for an earlier cookie
+                if heartbeat != None and heartbeat[2] == cookie:
+                    return heartbeat[0]
+        except (socket.error, ValueError) as e:
+            log(self.log_filename, 'No reply to heartbeat : {}'.format(
+                e), type='warning')
+            return
+
+    # data sent with a REGISTER
+    def registration_data(self, server_owner: str) -> dict:
+        return {'name': server_owner, 'hostname': self.host, 'port': self.port}
+
+    # sends several requests to the registration server in one BATCH
+    # @param operations is a list of (MethodType, data)
+    # returns one {'status_code', 'data'} per operation, in order, or None
+    # if the batch itself failed
+    def batch_requester(self, cookie: str, operations: List[Tuple[MethodType, Any]]) -> List[dict]:
+        message = Message(MessageType.REQUEST_SERVER)
+        message.method = MethodType.BATCH.name
+        message.headers['hostname'] = self.host
+        if cookie:
+            message.headers['cookie'] = cookie
+        message.data = [{'method': method.name, 'data': data}
+                        for method, data in operations]
+        try:
+            response_dict = exchange(get_rs_address(), message)
+            if response_dict['message_type'] != MessageType.SERVER_RESPONSE.name:
+                log(self.log_filename,
+                    'Response sent by registration server might be invalid!', type='warning')
+            if response_dict['status_code'] != StatusCodes.SUCCESS.value:
+                raise Exception(
+                    'Server indicated - {}'.format(response_dict['status_code']))
+            results = response_dict.get('data')
+            if not isinstance(results, list) or len(results) != len(operations):
+                raise BadFormatException('Malformed batch response!')
+        except (socket.error, Exception) as e:
+            log(self.log_filename,
+                'Batch request to server failed : {}'.format(e), type='error')
+            return
+        log(self.log_filename, 'Sent batch of {} operations to server'.format(
+            len(operations)), type='info')
+        return results
+
     # helper function used for leave / keep alive / pquery
-    # returns list if pquery
-    def server_requester(self, cookie: str, method: MethodType, log_entries: Dict[str]) -> Any:
+    # data is sent along with the request, e.g. PQUERY options
+    # returns list if pquery, or the {'peers', 'cursor', 'total'} dict when
+    # options were sent
+    def server_requester(self, cookie: str, method: MethodType, log_entries: Dict[str], data=None) -> Any:
         message = Message(MessageType.REQUEST_SERVER)
         message.method = method.name
         message.headers['hostname'] = self.host
         message.headers['cookie'] = cookie
+        message.data = data
         rs_address = get_rs_address()
         try:
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as conn:
-                conn.connect(rs_address)
-                send(conn, message.to_bytes())
-                response_bytes = receive(conn)
-                response_dict = Message.bytes_to_dict(response_bytes)
-                if response_dict['message_type'] != MessageType.SERVER_RESPONSE.name:
-                    log(self.log_filename,
-                        'Response sent by registration server might be invalid!', type='warning')
-                if response_dict['status_code'] != StatusCodes.SUCCESS.value:
-                    raise Exception(
-                        'Server indicated - {}'.format(message.status_code))
-                if method == MethodType.PQUERY:
-                    try:
-                        data = response_dict['data']
-                        peer_list = eval(data)
-                    except KeyError as ke:
-                        log(self.log_filename, 'No peer list data returned in server response: {}'.format(
-                            ke), type='error')
-                        return
-                    except SyntaxError as se:
-                        log(self.log_filename, 'Error while parsing peer list returned by server: {}'.format(
-                            ke), type='error')
-                        return
+            response_dict = exchange(rs_address, message)
+            if response_dict['message_type'] != MessageType.SERVER_RESPONSE.name:
+                log(self.log_filename,
+                    'Response sent by registration server might be invalid!', type='warning')
+            if response_dict['status_code'] != StatusCodes.SUCCESS.value:
+                raise Exception(
+                    'Server indicated - {}'.format(response_dict['status_code']))
+            if method == MethodType.PQUERY:
+                try:
+                    data = response_dict['data']
+                    # legacy servers send the list as a string
+                    peer_list = data if isinstance(
+                        data, (list, dict)) else literal_eval(data)
+                except KeyError as ke:
+                    log(self.log_filename, 'No peer list data returned in server response: {}'.format(
+                        ke), type='error')
+                    return
+                except (SyntaxError, ValueError) as se:
+                    log(self.log_filename, 'Error while parsing peer list returned by server: {}'.format(
+                        se), type='error')
+                    return
         except (socket.error, Exception) as e:
             log(self.log_filename, '{} : {}'.format(
-                log_entries['failure'], e), type='error')
+                log_entries.get('failure', 'Request to server failed'), e), type='error')
             return
-        log(self.log_filename, log_entries['success'], type='info')
+        log(self.log_filename, log_entries['success'],
+            type='info', event=log_entries.get('event'))
         if method == MethodType.PQUERY:
             return peer_list
 
-    # Overridden from parent class
-    def process_new_connection(self, peer_socket: socket.socket, peer_address: socket._RetAddress) -> None:
-        try:
-            received = receive(peer_socket)
-        except (socket.error, Exception) as e:
-            log(self.log_filename, str(e), type='error')
-            response = self.create_error_response(
-                MessageType.PEER_RESPONSE, e, StatusCodes.INTERNAL_ERROR)
-            send(peer_socket, response.to_bytes())
-            return
-        try:
-            message_dict = Message.bytes_to_dict(received)
-            if message_dict['message_type'] != MessageType.REQUEST_PEER.name:
-                raise BadFormatException('Incorrect message type!')
-            else:
-                method_type = message_dict['method_type']
-                if method_type == MethodType.RFC_QUERY.name:
-                    self.send_rfc_index(peer_socket, peer_address)
-                elif method_type == MethodType.GET_RFC.name:
-                    self.send_rfc(message_dict, peer_socket, peer_address)
-                else:
-                    raise BadFormatException('Method type not supported!')
-        except Exception as e:
-            log(self.log_filename, 'Invalid message received from peer: {}'.format(
-                str(e)), type='error')
-            response = self.create_error_response(
-                MessageType.PEER_RESPONSE, e, StatusCodes.BAD_REQUEST)
-            send(peer_socket, response.to_bytes())
-            return
-
-    def send_rfc_index(self, peer_socket: socket.socket, peer_address: socket._RetAddress) -> None:
+    # data can be {'since': version, 'epoch': epoch} to get only the rfcs
+    # changed since that version of this index, answered with
+    # {'epoch', 'version', 'full', 'rfcs'}; full is True when the whole index
+    # had to be sent because the change log does not reach back far enough
+    # or the index was recreated since
+    def send_rfc_index(self, message_dict: Dict, peer_address: socket._RetAddress) -> Message:
+        request_data = message_dict.get('data')
+        response = Message(MessageType.PEER_RESPONSE)
         self.lock.acquire()
         try:
-            response = Message(MessageType.PEER_RESPONSE)
+            index = self.client_rfc_index
             response.headers['hostname'] = self.host
-            response.data = str(self.client_rfc_index)
+            if isinstance(request_data, dict) and 'since' in request_data:
+                changed = None
+                if request_data.get('epoch') == index.epoch:
+                    changed = index.changes_since(request_data['since'])
+                response.data = {'epoch': index.epoch, 'version': index.version, 'full': changed == None,
+                                 'rfcs': index.to_dict((self.host, self.port), changed),
+                                 'digests': index.to_digests(changed)}
+            else:
+                response.data = index.to_dict((self.host, self.port))
             response.status_code = StatusCodes.SUCCESS.value
-            sent = True
+            log(self.log_filename, 'Sending RFC Index to {}:{}'.format(
+                peer_address[0], peer_address[1]), type='info')
         except Exception as ie:
             log(self.log_filename, 'Internal error occurred while sending RFC index : {}'.format(
                 ie), type='error')
             response.data = 'Unexpected error occurred!'
             response.status_code = StatusCodes.INTERNAL_ERROR.value
-            sent = False
-        try:
-            send(peer_socket, response.to_bytes())
-        except (socket.error, Exception) as e:
-            log(self.log_filename,
-                'Failed to send response to peer - {}'.format(e), type='error')
-            sent = False
         finally:
             self.lock.release()
-            if sent:
-                log(self.log_filename, 'Successfully sent RFC Index to {}:{}'.format(
-                    peer_address[0], peer_address[1]), type='info')
+        return response
 
-    def send_rfc(self, message_dict: Dict, peer_socket: socket.socket, peer_address: socket._RetAddress) -> None:
-        self.lock.acquire()
+    # data is {'query': keywords, 'limit': results wanted} or just the
+    # keywords, answered with a list of [rfc, score], best match first
+    def send_search_results(self, message_dict: Dict, peer_address: socket._RetAddress) -> Message:
         response = Message(MessageType.PEER_RESPONSE)
         response.headers['hostname'] = self.host
         response.status_code = StatusCodes.SUCCESS.value
         try:
-            rfc_requested = message_dict['data']
-            if not self.client_rfc_index.is_owned(rfc_requested):
+            request_data = message_dict['data']
+            if isinstance(request_data, str):
+                request_data = {'query': request_data}
+            query = request_data['query']
+            limit = request_data.get('limit', DEFAULT_SEARCH_LIMIT)
+            if not isinstance(query, str) or not isinstance(limit, int) or limit < 1:
+                raise BadFormatException('Invalid search request!')
+            search_index = self.client_rfc_index.search_index
+            matches = search_index.search(
+                query, min(limit, MAX_SEARCH_LIMIT)) if search_index else []
+            response.data = [[rfc, score] for rfc, score in matches]
+            log(self.log_filename, 'Sent {} results for {} to peer @ {}:{}'.format(
+                len(matches), query, peer_address[0], peer_address[1]), type='info')
+        except (KeyError, BadFormatException) as ke:
+            log(self.log_filename, 'Bad search request made by peer @ {}:{}'.format(
+                peer_address[0], peer_address[1]), type='error')
+            response.status_code = StatusCodes.BAD_REQUEST.value
+            response.data = str(ke)
+        return response
+
+    # data is None for every field of every rfc, or a dict with any of
+    # 'fields', 'filter', 'sort' and 'limit' as taken by Catalog.query
+    # answered with {'fields': [field], 'rows': [[value per field]]}
+    def send_catalog(self, message_dict: Dict, peer_address: socket._RetAddress) -> Message:
+        response = Message(MessageType.PEER_RESPONSE)
+        response.headers['hostname'] = self.host
+        response.status_code = StatusCodes.SUCCESS.value
+        try:
+            request_data = message_dict.get('data') or {}
+            if not isinstance(request_data, dict):
+                raise BadFormatException('Invalid catalog request!')
+            fields = request_data.get('fields') or list(CATALOG_FIELDS)
+            catalog = self.client_rfc_index.catalog
+            rows = catalog.query(fields, request_data.get('filter'), request_data.get('sort'),
+                                 request_data.get('limit')) if catalog else []
+            response.data = {'fields': fields, 'rows': rows}
+            log(self.log_filename, 'Sent catalog of {} rfcs to peer @ {}:{}'.format(
+                len(rows), peer_address[0], peer_address[1]), type='info')
+        except Exception as e:
+            log(self.log_filename, 'Bad catalog request made by peer @ {}:{} - {}'.format(
+                peer_address[0], peer_address[1], e), type='error')
+            response.status_code = StatusCodes.BAD_REQUEST.value
+            response.data = str(e)
+        return response
+
+    def stats_gauges(self) -> dict:
+        index = self.client_rfc_index
+        gauges = {'rfcs': len(index.rfcs),
+                  'owned_rfcs': sum(1 for entry in list(index.rfcs.values()) if entry.owned),
+                  'index_version': index.version}
+        gauges.update({'response_cache_{}'.format(key): value
+                       for key, value in self.response_cache.stats().items()})
+        return gauges
+
+    # with an upload cap the file goes out a chunk at a time, each chunk
+    # waiting for its share of the cap
+    def send_stream(self, client_socket: socket.socket, stream: tuple) -> None:
+        if self.upload_bucket == None:
+            return super().send_stream(client_socket, stream)
+        path, offset, count = stream
+        with open(path, 'rb') as file:
+            while count > 0:
+                size = min(count, DEFAULT_CHUNK_SIZE)
+                with self.upload_lock:
+                    delay = self.upload_bucket.borrow(size)
+                if delay > 0:
+                    time.sleep(delay)
+                client_socket.sendfile(file, offset, size)
+                offset += size
+                count -= size
+
+    async def send_stream_async(self, writer: asyncio.StreamWriter, stream: tuple) -> None:
+        if self.upload_bucket == None:
+            return await super().send_stream_async(writer, stream)
+        path, offset, count = stream
+        with open(path, 'rb') as file:
+            while count > 0:
+                size = min(count, DEFAULT_CHUNK_SIZE)
+                with self.upload_lock:
+                    delay = self.upload_bucket.borrow(size)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                await self.loop.sendfile(writer.transport, file, offset, size)
+                offset += size
+                count -= size
+
+    # replaces the stream of a response with the cached compressed copy of
+    # the byte range of the rfc it sends, the range is sent as is when
+    # compressing does not pay off
+    def compress_stream(self, response: Message, rfc_path: str, codec: str, info=None) -> None:
+        _, offset, length = response.stream
+        try:
+            compressed = self.compression_cache.get(
+                rfc_path, codec, info.digest if info else None, offset, length)
+        except Exception as e:
+            log(self.log_filename, 'Failed to compress {} with {} - {}'.format(
+                rfc_path, codec, e), type='warning')
+            return
+        if compressed:
+            cache_path, size = compressed
+            response.data['encoding'] = codec
+            response.data['length'] = size
+            response.stream = (cache_path, 0, size)
+
+    # data is either the rfc name, answered with the file's lines in the
+    # response, or {'rfc': name, 'stream': True}, answered with the file size
+    # in the response followed by the raw file bytes
+    # streaming requests can ask for a byte range with 'offset' and 'length'
+    # streaming requests can list the codecs they decode in 'codecs', the
+    # response then names the one used in 'encoding' and 'length' is the
+    # size of the compressed stream, which decompresses to the range asked
+    # for
+    def send_rfc(self, message_dict: Dict, peer_address: socket._RetAddress) -> Message:
+        response = Message(MessageType.PEER_RESPONSE)
+        response.headers['hostname'] = self.host
+        response.status_code = StatusCodes.SUCCESS.value
+        rfc_requested = None
+        try:
+            request_data = message_dict['data']
+            streaming = isinstance(request_data, dict) and request_data.get(
+                'stream', False)
+            rfc_requested = request_data['rfc'] if isinstance(
+                request_data, dict) else request_data
+            # older clients send the name in a list
+            if isinstance(rfc_requested, list):
+                rfc_requested = rfc_requested[0]
+            self.lock.acquire()
+            try:
+                owned = self.client_rfc_index.is_owned(rfc_requested)
+                rfc_store: str = self.client_rfc_index.rfc_store
+                content_store = self.client_rfc_index.content_store
+            finally:
+                self.lock.release()
+            if not owned:
                 raise Exception('Requested RFC not found!')
+            rfc_path = os.path.join(rfc_store, rfc_requested)
+            if streaming:
+                rfc_size = os.path.getsize(rfc_path)
+                offset = request_data.get('offset', 0)
+                length = request_data.get('length', rfc_size)
+                if offset < 0 or length < 0 or offset > rfc_size:
+                    raise BadFormatException('Invalid byte range requested!')
+                length = min(length, rfc_size - offset)
+                response.data = {'rfc': rfc_requested, 'size': rfc_size,
+                                 'offset': offset, 'length': length}
+                # digest and chunk hashes so the receiver can check the data
+                info = content_store.info_for(
+                    rfc_requested) if request_data.get('manifest') and content_store else None
+                if info and info.size == rfc_size:
+                    response.data.update(info.to_dict())
+                response.stream = (rfc_path, offset, length)
+                codec = choose_codec(request_data.get('codecs'))
+                if codec and length > 0:
+                    self.compress_stream(response, rfc_path, codec, info)
             else:
-                rfc_store: str = self.client_rfc_index.rfc_store
-                rfc_path = os.path.join(rfc_store, rfc_requested)
                 response.data = get_rfc_data(rfc_path)
-        except KeyError as ke:
+        except (KeyError, BadFormatException) as ke:
             log(self.log_filename, 'Bad request made by peer @ {}:{}'.format(
                 peer_address[0], peer_address[1]), type='error')
             response.status_code = StatusCodes.BAD_REQUEST.value
@@ -205,8 +495,7 @@ class RFC_Server(Server):
                 rfc_requested, peer_address[0], peer_address[1]), type='error')
             response.status_code = StatusCodes.NOT_FOUND.value
             response.data = e
-        finally:
-            if response.status_code == StatusCodes.SUCCESS.value:
-                log(self.log_filename, '{} sent to peer @ {}:{}'.format(rfc_requested,
-                    peer_address[0], peer_address[1]), type='error')
-            send(peer_socket, response.to_bytes())
+        if response.status_code == StatusCodes.SUCCESS.value:
+            log(self.log_filename, '{} sent to peer @ {}:{}'.format(rfc_requested,
+                peer_address[0], peer_address[1]), type='info', event='get_rfc')
+        return response
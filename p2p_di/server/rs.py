@@ -1,42 +1,180 @@
 import contextlib
 import datetime
 import os
+import random
 import socket
 import time
+from heapq import heappop, heappush
 from math import inf
-from threading import Lock, Thread
+from threading import Lock, RLock, Thread
 from typing import List
 from uuid import uuid4
 
-import tinydb
+from p2p_di.server.metrics import Timed_Lock
+from p2p_di.server.peer_store import (SQLite_Peer_Store, TinyDB_Peer_Store,
+                                     Write_Behind_Store)
 from p2p_di.server.server import Server
+from p2p_di.utils import codec
 from p2p_di.utils.message import Message, MessageType, MethodType, StatusCodes
-from p2p_di.utils.utils import (DEFAULT_RS_PORT, DEFAULT_UPDATE_INTERVAL,
-                                BadFormatException, NotRegisteredException,
-                                Peer_Entry, log, receive, send)
+from p2p_di.utils.utils import (DEFAULT_FLUSH_INTERVAL,
+                                DEFAULT_FLUSH_THRESHOLD, DEFAULT_LOCK_STRIPES,
+                                DEFAULT_MAX_PAGE_SIZE, DEFAULT_PEER_STORE,
+                                DEFAULT_RS_PORT, DEFAULT_TTL,
+                                DEFAULT_UPDATE_INTERVAL,
+                                HEARTBEAT, HEARTBEAT_ACK, HEARTBEAT_PING,
+                                HEARTBEAT_REJECT, HEARTBEAT_WANT_REPLY,
+                                INVALID_HEARTBEAT_BURST,
+                                INVALID_HEARTBEAT_RATE, PEER_STORE_SQLITE,
+                                PEER_STORES, SAME_AS_RS_PORT,
+                                BadFormatException,
+                                NotRegisteredException, Peer_Entry,
+                                Token_Bucket, get_logger, get_rs_address,
+                                log, pack_heartbeat, unpack_heartbeat)
+
+# list of the peers active at one listing version, shared by every PQUERY
+# until the listing changes and never modified once built; the next version
+# is made from it by applying only the peers that changed, and the full
+# encoded list is only built once a PQUERY asks for every peer
+class Peer_Snapshot():
+
+    def __init__(self, version: int, cookies: list = None, addresses: list = None, encoded: list = None,
+                 positions: dict = None) -> None:
+        self.version = version
+        self.cookies = cookies or []
+        self.addresses = addresses or []
+        self.encoded = encoded or []
+        self.positions = positions if positions != None else {
+            cookie: i for i, cookie in enumerate(self.cookies)}
+        self.encoded_list: codec.Encoded = None
+
+    # returns the snapshot at version, after changes
+    # @param changes is {cookie: (address, encoded address) or None for
+    # peers that are no longer listed}
+    # the peer lists are copied as they are, only changed peers are visited;
+    # a peer that leaves is replaced by the last one
+    def apply(self, version: int, changes: dict):
+        cookies, addresses, encoded = list(self.cookies), list(
+            self.addresses), list(self.encoded)
+        positions = self.positions.copy()
+        for cookie, listed in changes.items():
+            position = positions.get(cookie)
+            if listed != None:
+                if position == None:
+                    positions[cookie] = len(cookies)
+                    cookies.append(cookie)
+                    addresses.append(listed[0])
+                    encoded.append(listed[1])
+                else:
+                    addresses[position], encoded[position] = listed
+            elif position != None:
+                del positions[cookie]
+                last = len(cookies) - 1
+                if position != last:
+                    cookies[position] = cookies[last]
+                    addresses[position] = addresses[last]
+                    encoded[position] = encoded[last]
+                    positions[cookies[position]] = position
+                cookies.pop()
+                addresses.pop()
+                encoded.pop()
+        return Peer_Snapshot(version, cookies, addresses, encoded, positions)
+
+    # every peer, encoded; readers racing on the first call both build it
+    @property
+    def data(self) -> codec.Encoded:
+        if self.encoded_list == None:
+            self.encoded_list = codec.encode_list(
+                self.encoded, list(self.addresses))
+        return self.encoded_list
+
+    # encodes the peers at these positions without building the full list
+    def select(self, positions) -> codec.Encoded:
+        return codec.encode_list([self.encoded[i] for i in positions],
+                                 [self.addresses[i] for i in positions])
 
 # RegistrationServer, child class of Server
 
 
 class RegistrationServer(Server):
 
+    request_type = MessageType.REQUEST_SERVER
+    response_type = MessageType.SERVER_RESPONSE
+    stats_name = 'rs'
+
     # constructor
     # set clean to false to have server use existing log / peer list
-    def __init__(self, clean=True) -> None:
-        super().__init__()
-        self.lock = Lock()
+    # the peer list is written behind, see peer_store for the durability
+    # window set by flush_interval and flush_threshold
+    # @param peer_store is one of PEER_STORES, 'sqlite' keeps the peer list
+    # in assets/rs/peer_list.db instead of peer_list.json
+    # @param heartbeat_port is the udp port keep alive datagrams are accepted
+    # on, by default the number of the rs port clients send them to, None
+    # to only take keep alives over tcp
+    # @param ttl is the seconds a peer stays active without a keep alive
+    # server_options are passed on to Server (e.g. mode='asyncio')
+    def __init__(self, clean=True, flush_interval=DEFAULT_FLUSH_INTERVAL,
+                 flush_threshold=DEFAULT_FLUSH_THRESHOLD, peer_store=DEFAULT_PEER_STORE,
+                 heartbeat_port=SAME_AS_RS_PORT, ttl=DEFAULT_TTL, **server_options) -> None:
+        if peer_store not in PEER_STORES:
+            raise ValueError('Unknown peer store: {}'.format(peer_store))
+        super().__init__(**server_options)
+        self.ttl = ttl
+        if heartbeat_port == SAME_AS_RS_PORT:
+            heartbeat_port = get_rs_address()[1]
+        self.heartbeat_port = heartbeat_port
+        self.heartbeat_socket: socket.socket = None
+        self.heartbeat_thread: Thread = None
+        # source ip -> Token_Bucket limiting replies to bad cookies
+        self.invalid_heartbeats = {}
+        # a peer is guarded by one of these locks, picked by its cookie, so
+        # requests for different peers do not wait on each other
+        # reentrant so a BATCH can hold its lock across its operations
+        # waits for them are counted in the metrics
+        self.locks = [Timed_Lock(RLock(), self.metrics, 'peer')
+                      for _ in range(DEFAULT_LOCK_STRIPES)]
         self.peers = {}
+        # min-heap of (expires_at, cookie); scheduled maps the cookies the
+        # sweep should look at to the time of their live entry, entries of
+        # peers that left or were rescheduled since are skipped
+        # one lock for the whole heap, it is held for a push or a pop only
+        # and is rarely contended (see 'locks' in STATS)
+        self.expiry_lock = Timed_Lock(Lock(), self.metrics, 'expiry')
+        self.expiry_heap = []
+        self.scheduled = {}
+        # cookie -> (address, encoded address) of the active peers, PQUERY
+        # reads the snapshot made from it and takes no lock unless the
+        # listing changed since
+        # one lock too, a snapshot needs all entries at one version
+        self.listed_lock = Timed_Lock(Lock(), self.metrics, 'listing')
+        self.listed = {}
+        self.listed_version = 0
+        # the entries of listed changed since the last snapshot, None for
+        # removed ones
+        self.listing_changes = {}
+        self.snapshot_lock = Lock()
+        self.snapshot = Peer_Snapshot(0)
+        self.handlers = {
+            MethodType.REGISTER.name: self.register_client,
+            MethodType.LEAVE.name: self.mark_inactive,
+            MethodType.KEEP_ALIVE.name: self.keep_alive,
+            MethodType.PQUERY.name: self.peers_query,
+            MethodType.BATCH.name: self.batch,
+            MethodType.STATS.name: self.send_stats,
+        }
 
         base_path = os.path.dirname(__file__)
         os.makedirs(os.path.join(base_path, '..', '..',
                     'assets', 'rs'), exist_ok=True)
-        db_path = os.path.join(base_path, '..', '..',
-                               'assets', 'rs', 'peer_list.json')
-        open(db_path, 'a+') #creating the file
-        
-        self.peers_db = tinydb.TinyDB(db_path)
         self.log_filename = os.path.join(
             base_path, '..', '..', 'assets', 'rs', 'rs_log.txt')
+        if peer_store == PEER_STORE_SQLITE:
+            store = SQLite_Peer_Store(os.path.join(
+                base_path, '..', '..', 'assets', 'rs', 'peer_list.db'))
+        else:
+            store = TinyDB_Peer_Store(os.path.join(
+                base_path, '..', '..', 'assets', 'rs', 'peer_list.json'))
+        self.peers_db = Write_Behind_Store(
+            store, flush_interval, flush_threshold, self.log_filename, metrics=self.metrics)
 
         if clean:
             with contextlib.suppress(FileNotFoundError):
@@ -49,9 +187,11 @@ class RegistrationServer(Server):
             self.load_peers()
             with open(self.log_filename, 'a+') as file:
                 now = datetime.datetime.now()
-                file.write('New server instance created at:', now.isoformat())
-        
-        self.startup()
+                file.write('New server instance created at: {}'.format(now.isoformat()))
+        # log() writes to log_filename through this logger
+        get_logger('rs', self.log_filename)
+
+        self.startup(get_rs_address()[1])
 
     # Adding default port in override
     def startup(self, port=DEFAULT_RS_PORT, period=inf) -> None:
@@ -59,92 +199,74 @@ class RegistrationServer(Server):
         self.update_thread = Thread(target=self.periodic_updater, args=(
             DEFAULT_UPDATE_INTERVAL, self.update_loop), daemon=False)
         self.update_thread.start()
-        super().startup(port, period)
+        self.peers_db.start()
+        if self.heartbeat_port != None:
+            self.heartbeat_socket = socket.socket(
+                socket.AF_INET, socket.SOCK_DGRAM)
+            self.heartbeat_socket.bind((self.host, self.heartbeat_port))
+            # lets serve_heartbeats notice stop()
+            self.heartbeat_socket.settimeout(DEFAULT_UPDATE_INTERVAL)
+            self.heartbeat_thread = Thread(
+                target=self.serve_heartbeats, daemon=True)
+            self.heartbeat_thread.start()
         log(self.log_filename, 'Started Registration Server', type='info')
+        super().startup(port, period)
 
-    # Overridden from parent class
-    def process_new_connection(self, client_socket: socket.socket, client_address) -> None:
-        try:
-            received = receive(client_socket)
-        except Exception as e:
-            log(self.log_filename, str(e), type='error')
-            response = self.create_error_response(MessageType.SERVER_RESPONSE,
-                e, StatusCodes.INTERNAL_ERROR)
-            send(client_socket, response.to_bytes())
-            return
-        try:
-            message_dict = Message.bytes_to_dict(received)
-            if message_dict['message_type'] != MessageType.REQUEST_SERVER.name:
-                raise BadFormatException('Incorrect message type!')
-            else:
-                method_type = message_dict['method_type']
-                if method_type == MethodType.REGISTER.name:
-                    self.register_client(
-                        message_dict, client_socket, client_address)
-                elif method_type == MethodType.LEAVE.name:
-                    self.mark_inactive(
-                        message_dict, client_socket, client_address)
-                elif method_type == MethodType.KEEP_ALIVE.name:
-                    self.keep_alive(
-                        message_dict, client_socket, client_address)
-                elif method_type == MethodType.PQUERY.name:
-                    self.peers_query(
-                        message_dict, client_socket, client_address)
-                else:
-                    raise BadFormatException('Method type not supported!')
-        except Exception as e:
-            log(self.log_filename, str(e), type='error')
-            response = self.create_error_response(MessageType.SERVER_RESPONSE, e, StatusCodes.BAD_REQUEST)
-            send(client_socket, response.to_bytes())
-            return
-
-    def register_client(self, message_dict: dict, client_socket: socket.socket, client_address):
+    def register_client(self, message_dict: dict, client_address) -> Message:
         response = Message(MessageType.SERVER_RESPONSE)
-        client_cookie, client_hostname, client_port = ''
-        self.lock.acquire()
+        client_hostname, client_port = '', ''
+        # a new cookie is not known to anyone else yet, so the lock of the
+        # request's cookie is enough and a BATCH never holds two locks
+        lock = self.peer_lock(message_dict.get('cookie', ''))
+        lock.acquire()
         try:
+            # checked under the lock, so concurrent REGISTERs with one
+            # cookie agree on whether it is known
+            known_client = message_dict.get('cookie') in self.peers
+            client_cookie: str = message_dict['cookie'] if known_client else uuid4().hex
             client_data = message_dict['data']
             client_name = client_data['name']
             client_hostname = client_data['hostname']
             client_port = client_data['port']
             # If known client re-registering
-            if 'cookie' in message_dict and message_dict['cookie'] in self.peers:
-                client_cookie = message_dict['cookie']
+            if known_client:
                 peer_entry: Peer_Entry = self.peers[client_cookie]
                 peer_entry.re_register(client_port)
+                self.schedule_expiry(peer_entry)
                 client_last_active = peer_entry.last_active
                 client_registration_number = peer_entry.registration_number
-                Peer = tinydb.Query()
-                tinydb.TinyDB.update({'port': client_port, 'last_active': client_last_active,
-                                     'registration_number': client_registration_number}, Peer.cookie == client_cookie)
+                self.peers_db.update(client_cookie, {'port': client_port, 'last_active': client_last_active,
+                                                     'registration_number': client_registration_number})
             else:  # new client registering
-                client_cookie: str = uuid4().hex
                 peer_entry = Peer_Entry(
-                    client_cookie, client_name, client_hostname, client_port)
+                    client_cookie, client_name, client_hostname, client_port, lifetime=self.ttl)
                 self.peers[client_cookie] = peer_entry
-                tinydb.TinyDB.insert(peer_entry.to_dict())
+                self.schedule_expiry(peer_entry)
+                self.peers_db.insert(peer_entry.to_dict())
+            self.update_listing(peer_entry)
             # success response
             response.headers['hostname'] = self.host
-            response.data['cookie'] = client_cookie
+            response.data = {'cookie': client_cookie}
             response.status_code = StatusCodes.SUCCESS.value
         except Exception as e:
             log(self.log_filename, str(e), type='error')
             response = self.create_error_response(MessageType.SERVER_RESPONSE, e, StatusCodes.BAD_REQUEST)
         finally:
-            self.lock.release()
-            send(client_socket, response.to_bytes())
-            if response.status_code == StatusCodes.SUCCESS.value:
-                log(self.log_filename, 'Registered new client: {}:{}'.format(
-                    client_hostname, client_port), type="info")
-            else:
-                log(self.log_filename, 'Failed to register new client: {}'.format(
-                    client_hostname), type="info")
+            lock.release()
+        if response.status_code == StatusCodes.SUCCESS.value:
+            log(self.log_filename, 'Registered new client: {}:{}'.format(
+                client_hostname, client_port), type="info")
+        else:
+            log(self.log_filename, 'Failed to register new client: {}'.format(
+                client_hostname), type="info")
+        return response
 
-    def mark_inactive(self, message_dict: dict, client_socket: socket.socket, client_address):
+    def mark_inactive(self, message_dict: dict, client_address) -> Message:
         response = Message(MessageType.SERVER_RESPONSE)
-        self.lock.acquire()
+        client_hostname = message_dict.get('hostname', client_address[0])
+        lock = self.peer_lock(message_dict.get('cookie', ''))
+        lock.acquire()
         try:
-            client_hostname = message_dict['hostname']
             # if cookie not provided or if cookie not recognized
             if 'cookie' in message_dict:
                 client_cookie = message_dict['cookie']
@@ -156,10 +278,11 @@ class RegistrationServer(Server):
                     'Cookie not provided. Include assigned cookie in request!')
             peer_entry: Peer_Entry = self.peers[client_cookie]
             peer_entry.mark_inactive()
+            self.unschedule_expiry(peer_entry)
+            self.update_listing(peer_entry)
             client_last_active = peer_entry.last_active
-            Peer = tinydb.Query()
-            tinydb.TinyDB.update(
-                {'last_active': client_last_active}, Peer.cookie == client_cookie)
+            self.peers_db.update(
+                client_cookie, {'last_active': client_last_active})
             # success response
             response.headers['hostname'] = self.host
             response.headers['cookie'] = client_cookie
@@ -171,16 +294,17 @@ class RegistrationServer(Server):
             log(self.log_filename, str(e), type='error')
             response = self.create_error_response(MessageType.SERVER_RESPONSE, e, StatusCodes.BAD_REQUEST)
         finally:
-            self.lock.release()
-            send(client_socket, response.to_bytes())
-            log(self.log_filename, '{} left server'.format(
-                client_hostname), type="info")
+            lock.release()
+        log(self.log_filename, '{} left server'.format(
+            client_hostname), type="info")
+        return response
 
-    def keep_alive(self, message_dict: dict, client_socket: socket.socket, client_address):
+    def keep_alive(self, message_dict: dict, client_address) -> Message:
         response = Message(MessageType.SERVER_RESPONSE)
-        self.lock.acquire()
+        client_hostname = message_dict.get('hostname', client_address[0])
+        lock = self.peer_lock(message_dict.get('cookie', ''))
+        lock.acquire()
         try:
-            client_hostname = message_dict['hostname']
             # if cookie not provided or if cookie not recognized
             if 'cookie' in message_dict:
                 client_cookie = message_dict['cookie']
@@ -192,10 +316,11 @@ class RegistrationServer(Server):
                     'Cookie not provided. Include assigned cookie in request!')
             peer_entry: Peer_Entry = self.peers[client_cookie]
             peer_entry.keep_alive()
+            self.schedule_expiry(peer_entry)
+            self.update_listing(peer_entry)
             client_last_active = peer_entry.last_active
-            Peer = tinydb.Query()
-            tinydb.TinyDB.update(
-                {'last_active': client_last_active}, Peer.cookie == client_cookie)
+            self.peers_db.update(
+                client_cookie, {'last_active': client_last_active})
             # success response
             response.headers['hostname'] = self.host
             response.headers['cookie'] = client_cookie
@@ -207,16 +332,21 @@ class RegistrationServer(Server):
             log(self.log_filename, str(e), type='error')
             response = self.create_error_response(MessageType.SERVER_RESPONSE, e, StatusCodes.BAD_REQUEST)
         finally:
-            self.lock.release()
-            send(client_socket, response.to_bytes())
-            log(self.log_filename, '{} ttl reset!'.format(
-                client_hostname), type="info")
+            lock.release()
+        log(self.log_filename, '{} ttl reset!'.format(
+            client_hostname), type="info", event='keep_alive')
+        return response
 
-    def peers_query(self, message_dict: dict, client_socket: socket.socket, client_address):
+    # data can hold options to bound the response, see select_peers
+    def peers_query(self, message_dict: dict, client_address) -> Message:
         response = Message(MessageType.SERVER_RESPONSE)
-        self.lock.acquire()
+        client_hostname = message_dict.get('hostname', client_address[0])
+        options = message_dict.get('data')
+        lock = self.peer_lock(message_dict.get('cookie', ''))
+        lock.acquire()
         try:
-            client_hostname = message_dict['hostname']
+            if options != None and not isinstance(options, dict):
+                raise BadFormatException('PQUERY options must be a dict!')
             # if cookie not provided or if cookie not recognized
             if not 'cookie' in message_dict or not message_dict['cookie'] in self.peers:
                 raise NotRegisteredException(
@@ -225,12 +355,12 @@ class RegistrationServer(Server):
             # marking alive on last action
             peer_entry: Peer_Entry = self.peers[client_cookie]
             peer_entry.keep_alive()
+            self.schedule_expiry(peer_entry)
+            self.update_listing(peer_entry)
             client_last_active = peer_entry.last_active
-            Peer = tinydb.Query()
-            tinydb.TinyDB.update(
-                {'last_active': client_last_active}, Peer.cookie == client_cookie)
+            self.peers_db.update(
+                client_cookie, {'last_active': client_last_active})
             # success response
-            response.data = str(self.get_active_peers())
             response.headers['hostname'] = self.host
             response.headers['cookie'] = client_cookie
             response.status_code = StatusCodes.SUCCESS.value
@@ -241,16 +371,139 @@ class RegistrationServer(Server):
             log(self.log_filename, str(e), type='error')
             response = self.create_error_response(MessageType.SERVER_RESPONSE, e, StatusCodes.BAD_REQUEST)
         finally:
-            self.lock.release()
-            send(client_socket, response.to_bytes())
-            log(self.log_filename,
-                'Sent list of active peers to client @ {}'.format(client_hostname), type="info")
+            lock.release()
+        if response.status_code == StatusCodes.SUCCESS.value:
+            # peer list comes from the snapshot, outside the lock
+            try:
+                response.data = self.select_peers(
+                    self.get_snapshot(), options, client_cookie)
+            except Exception as e:
+                log(self.log_filename, str(e), type='error')
+                response = self.create_error_response(
+                    MessageType.SERVER_RESPONSE, e, StatusCodes.BAD_REQUEST)
+        log(self.log_filename,
+            'Sent list of active peers to client @ {}'.format(client_hostname), type="info",
+            event='pquery')
+        return response
+
+    # receives udp keep alives
+    # a heartbeat is answered only when it asks for a reply or when its
+    # cookie is not accepted, those rejections are rate limited per source
+    def serve_heartbeats(self) -> None:
+        # one byte more than a heartbeat so longer datagrams are noticed
+        buffer = bytearray(HEARTBEAT.size + 1)
+        view = memoryview(buffer)
+        while self.update_loop_running:
+            try:
+                size, address = self.heartbeat_socket.recvfrom_into(buffer)
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            heartbeat = unpack_heartbeat(view[:size])
+            if heartbeat == None or heartbeat[0] != HEARTBEAT_PING:
+                continue
+            _, flags, cookie = heartbeat
+            if self.heartbeat(cookie):
+                if not flags & HEARTBEAT_WANT_REPLY:
+                    continue
+                reply = HEARTBEAT_ACK
+            elif self.allow_invalid_heartbeat(address[0]):
+                log(self.log_filename, 'Rejected heartbeat from {}:{}'.format(
+                    address[0], address[1]), type='warning')
+                reply = HEARTBEAT_REJECT
+            else:
+                continue
+            try:
+                self.heartbeat_socket.sendto(
+                    pack_heartbeat(reply, cookie), address)
+            except OSError as e:
+                log(self.log_filename, 'Failed to answer heartbeat from {} - {}'.format(
+                    address, e), type='error')
+
+    # keep alive for a heartbeat datagram, returns False if the cookie is
+    # unknown or expired
+    def heartbeat(self, cookie: str) -> bool:
+        with self.peer_lock(cookie):
+            peer_entry: Peer_Entry = self.peers.get(cookie)
+            if peer_entry == None or not peer_entry.is_active():
+                return False
+            peer_entry.keep_alive()
+            self.schedule_expiry(peer_entry)
+            self.peers_db.update(
+                cookie, {'last_active': peer_entry.last_active})
+        return True
+
+    def allow_invalid_heartbeat(self, source) -> bool:
+        bucket = self.invalid_heartbeats.get(source)
+        if bucket == None:
+            # forget quiet sources instead of growing without bound
+            if len(self.invalid_heartbeats) >= 4096:
+                self.invalid_heartbeats.clear()
+            bucket = self.invalid_heartbeats[source] = Token_Bucket(
+                INVALID_HEARTBEAT_RATE, INVALID_HEARTBEAT_BURST)
+        return bucket.take()
+
+    # runs an ordered list of operations sent in one request
+    # data is [{'method': method name, 'data': ...}, ...], answered with
+    # [{'status_code': code, 'data': ...}, ...] in the same order
+    # operations share the headers of the batch and run under the lock of
+    # its cookie, taken once; a REGISTER passes the cookie it was given on
+    # to the operations after it
+    def batch(self, message_dict: dict, client_address) -> Message:
+        operations = message_dict.get('data')
+        if not isinstance(operations, list):
+            raise BadFormatException(
+                'BATCH data must be a list of operations!')
+        headers = {key: value for key, value in message_dict.items()
+                   if key not in ('method', 'data')}
+        results = []
+        lock = None
+        try:
+            for operation in operations:
+                operation_lock = self.peer_lock(headers.get('cookie', ''))
+                if operation_lock is not lock:
+                    if lock != None:
+                        lock.release()
+                    lock = operation_lock
+                    lock.acquire()
+                method = None
+                try:
+                    method = operation['method']
+                    if method == MethodType.BATCH.name or method not in self.handlers:
+                        raise BadFormatException(
+                            'Method type not supported in a batch!')
+                    operation_dict = dict(headers)
+                    operation_dict['method'] = method
+                    if operation.get('data') != None:
+                        operation_dict['data'] = operation['data']
+                    result = self.handlers[method](
+                        operation_dict, client_address)
+                except Exception as e:
+                    log(self.log_filename, 'Invalid operation in batch: {}'.format(
+                        e), type='error')
+                    result = self.create_error_response(
+                        MessageType.SERVER_RESPONSE, e, StatusCodes.BAD_REQUEST)
+                if method == MethodType.REGISTER.name and result.status_code == StatusCodes.SUCCESS.value:
+                    headers['cookie'] = result.data['cookie']
+                results.append({'status_code': result.status_code,
+                                'data': result.data})
+        finally:
+            if lock != None:
+                lock.release()
+        response = Message(MessageType.SERVER_RESPONSE)
+        response.headers['hostname'] = self.host
+        response.status_code = StatusCodes.SUCCESS.value
+        response.data = results
+        log(self.log_filename, 'Processed batch of {} operations from {}'.format(
+            len(results), headers.get('hostname', client_address[0])), type='info')
+        return response
 
     # runs a function periodically
     def periodic_updater(self, delay, update_function) -> None:
         interval = delay
         next_run_time = time.time() + delay
-        while True:
+        while self.update_loop_running:
             time.sleep(max(0, next_run_time - time.time()))
             try:
                 update_function(interval)
@@ -260,34 +513,164 @@ class RegistrationServer(Server):
             interval = (time.time() - next_run_time) // delay * delay + delay
             next_run_time += interval
 
-    # goes through peer list to make any updates
-    def update_loop(self, interval) -> None:
-        self.lock.acquire()
-        for index in self.peers:
-            peer = self.peers[index]
-            if peer.is_active():
-                peer.decrement_ttl(interval)
-        self.lock.release()
+    # picks the peers a PQUERY answers with
+    # without options every active peer is sent as a list, otherwise the
+    # reply is {'peers': [...], 'cursor': next cursor or None, 'total': n}
+    # options:
+    #   sample - up to this many peers picked uniformly at random
+    #   page_size, cursor - the next page_size peers, starting at the cursor
+    #   returned with the previous page (none for the first page); peers that
+    #   join or leave between pages can be skipped or sent twice
+    #   exclude_self - leave out the requesting peer
+    # sample and page_size are capped at DEFAULT_MAX_PAGE_SIZE
+    def select_peers(self, snapshot: Peer_Snapshot, options: dict, client_cookie):
+        if not options:
+            return snapshot.data
+        size = len(snapshot.cookies)
+        own = snapshot.positions.get(
+            client_cookie) if options.get('exclude_self') else None
+        next_cursor = None
+        if options.get('sample') != None:
+            count = self.option_count(options['sample'])
+            # one spare in case the requester is drawn
+            positions = random.sample(
+                range(size), min(size, count + (own != None)))
+            positions = [i for i in positions if i != own][:count]
+        elif options.get('page_size') != None:
+            count = self.option_count(options['page_size'])
+            start = self.option_cursor(options.get('cursor'))
+            end = start + count
+            # the requester does not take up a place on its page
+            if own != None and start <= own < end:
+                end += 1
+            end = min(end, size)
+            positions = [i for i in range(start, end) if i != own]
+            if end < size:
+                next_cursor = '{:x}'.format(end)
+        else:
+            positions = [i for i in range(size) if i != own]
+        return {'peers': snapshot.select(positions), 'cursor': next_cursor,
+                'total': size - (own != None)}
+
+    @staticmethod
+    def option_count(value) -> int:
+        count = int(value)
+        if count < 0:
+            raise BadFormatException('PQUERY sizes must not be negative!')
+        return min(count, DEFAULT_MAX_PAGE_SIZE)
 
-    # go through peer list and update their status
+    # cursors are opaque to clients, they hold the position of the next page
+    @staticmethod
+    def option_cursor(cursor) -> int:
+        if not cursor:
+            return 0
+        try:
+            position = int(cursor, 16)
+        except (TypeError, ValueError):
+            position = -1
+        if position < 0:
+            raise BadFormatException('Invalid PQUERY cursor!')
+        return position
+
+    def stats_gauges(self) -> dict:
+        return {'peers': len(self.peers), 'active_peers': len(self.listed),
+                'expiry_heap': len(self.expiry_heap),
+                'unsaved_peers': self.peers_db.dirty_count()}
+
+    # lock guarding the peer with this cookie
+    def peer_lock(self, cookie) -> Timed_Lock:
+        return self.locks[hash(cookie) % len(self.locks)]
+
+    # makes sure the expiry sweep will look at the peer
+    def schedule_expiry(self, peer_entry: Peer_Entry) -> None:
+        with self.expiry_lock:
+            if peer_entry.cookie not in self.scheduled:
+                heappush(self.expiry_heap,
+                         (peer_entry.expires_at, peer_entry.cookie))
+                self.scheduled[peer_entry.cookie] = peer_entry.expires_at
+
+    # the peer left, the sweep has nothing to expire for it
+    def unschedule_expiry(self, peer_entry: Peer_Entry) -> None:
+        with self.expiry_lock:
+            self.scheduled.pop(peer_entry.cookie, None)
+
+    # adds, moves or removes the peer in the active listing to match its state
+    def update_listing(self, peer_entry: Peer_Entry) -> None:
+        address = '{}:{}'.format(peer_entry.hostname, peer_entry.port)
+        with self.listed_lock:
+            listed = self.listed.get(peer_entry.cookie)
+            if peer_entry.is_active():
+                if listed == None or listed[0] != address:
+                    listed = self.listed[peer_entry.cookie] = (
+                        address, bytes(codec.encode_value(address)))
+                    self.listing_changes[peer_entry.cookie] = listed
+                    self.listed_version += 1
+            elif listed != None:
+                del self.listed[peer_entry.cookie]
+                self.listing_changes[peer_entry.cookie] = None
+                self.listed_version += 1
+
+    # returns the snapshot of the active peers
+    # a stale snapshot is brought up to date by one reader with the changes
+    # to the listing since, readers arriving meanwhile get the previous
+    # snapshot instead of waiting
+    def get_snapshot(self) -> Peer_Snapshot:
+        snapshot = self.snapshot
+        if snapshot.version == self.listed_version or not self.snapshot_lock.acquire(blocking=False):
+            return snapshot
+        try:
+            with self.listed_lock:
+                version, changes = self.listed_version, self.listing_changes
+                self.listing_changes = {}
+            if version != self.snapshot.version:
+                self.snapshot = self.snapshot.apply(version, changes)
+            return self.snapshot
+        finally:
+            self.snapshot_lock.release()
+
+    # pops the peers whose deadline has passed, peers that were kept alive in
+    # the meantime go back on the heap with their new deadline
+    # returns the peers that expired
+    def update_loop(self, interval) -> List[Peer_Entry]:
+        expired = []
+        now = time.time()
+        with self.expiry_lock:
+            while self.expiry_heap and self.expiry_heap[0][0] <= now:
+                scheduled_at, cookie = heappop(self.expiry_heap)
+                if self.scheduled.get(cookie) != scheduled_at:
+                    continue
+                peer = self.peers.get(cookie)
+                if peer != None and peer.is_active(now):
+                    heappush(self.expiry_heap, (peer.expires_at, cookie))
+                    self.scheduled[cookie] = peer.expires_at
+                else:
+                    del self.scheduled[cookie]
+                    if peer != None:
+                        expired.append(peer)
+        for peer in expired:
+            self.update_listing(peer)
+            log(self.log_filename, '{}:{} expired'.format(
+                peer.hostname, peer.port), type='info')
+        return expired
+
+    # restores the stored peer list, peers come back inactive until they
+    # register again
     def load_peers(self):
         existing_peers = self.peers_db.all()
-        for peer_data in existing_peers:
-            peer = Peer_Entry(peer_data['cookie'], peer_data['name'], peer_data['port'],
-                              peer_data['last_active'], peer_data['registration_number'])
-        self.peers[peer_data['cookie']] = peer
+        self.peers = {peer_data['cookie']: Peer_Entry(peer_data['cookie'], peer_data['name'], peer_data.get('hostname', ''),
+                                                      peer_data['port'], peer_data['last_active'], peer_data['registration_number'],
+                                                      self.ttl)
+                      for peer_data in existing_peers}
 
     def get_active_peers(self) -> List[str]:
-        active = []
-        peer_entry: Peer_Entry
-        for peer_entry in self.peers.values():
-            if peer_entry.is_active():
-                active.append('{}:{}'.format(
-                    peer_entry.hostname, peer_entry.port))
-        return active
+        return list(self.get_snapshot().addresses)
 
     # stop the server
     def stop(self):
         self.update_loop_running = False
         self.update_thread.join()
+        if self.heartbeat_socket != None:
+            self.heartbeat_socket.close()
+            self.heartbeat_thread.join()
+        self.peers_db.close()
         super().stop()
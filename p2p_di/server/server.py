@@ -1,46 +1,414 @@
+import asyncio
+import contextlib
+import os
 import socket
 import time
 from math import inf
+from queue import Empty, Full, Queue
 from threading import Thread
 
+from p2p_di.server.metrics import UNKNOWN_METHOD, Metrics
 from p2p_di.utils.message import Message, MessageType, StatusCodes
+from p2p_di.utils.utils import (ASYNC_LISTEN_BACKLOG, DEFAULT_LISTEN_BACKLOG,
+                                DEFAULT_MAX_FRAME_SIZE,
+                                DEFAULT_OVERFLOW_POLICY, DEFAULT_POOL_SIZE,
+                                DEFAULT_QUEUE_SIZE, DEFAULT_READ_TIMEOUT,
+                                DEFAULT_SERVING_MODE,
+                                DEFAULT_STATS_INTERVAL,
+                                FRAME_HEADER, OVERFLOW_BLOCK,
+                                OVERFLOW_POLICIES, OVERFLOW_REJECT,
+                                SERVING_MODE_ASYNCIO, SERVING_MODE_POOL,
+                                SERVING_MODES, BadFormatException,
+                                FrameTooLargeException, get_host, log,
+                                receive, send)
 
 # General Server class
 
 
 class Server():
 
+    # message types handled / sent by the server
+    # set in child classes
+    request_type: MessageType = None
+    response_type: MessageType = None
+    # server label of the exported metrics
+    stats_name = 'server'
+
     # constructor
-    def __init__(self) -> None:
-        self.host = socket.gethostbyname(socket.gethostname()+".local")
+    # @param mode is one of SERVING_MODES, 'threaded' uses a thread per
+    # connection, 'asyncio' serves every connection from one event loop and
+    # 'pool' hands connections to pool_size workers through a queue holding
+    # at most queue_size connections
+    # @param backlog is the listen backlog, defaults depend on the mode
+    # @param overflow_policy is one of OVERFLOW_POLICIES, used by 'pool'
+    # when the queue is full
+    # @param max_frame_size is the largest request accepted, in bytes
+    # @param read_timeout is how long a client gets to send its request, so
+    # clients that connect and stall do not hold a thread or pool worker
+    # @param stats_file is a file the metrics are written to in the
+    # prometheus text format every stats_interval seconds, None for none
+    def __init__(self, mode=DEFAULT_SERVING_MODE, backlog: int = None, pool_size=DEFAULT_POOL_SIZE,
+                 queue_size=DEFAULT_QUEUE_SIZE, overflow_policy=DEFAULT_OVERFLOW_POLICY,
+                 max_frame_size=DEFAULT_MAX_FRAME_SIZE, read_timeout=DEFAULT_READ_TIMEOUT,
+                 stats_file: str = None, stats_interval=DEFAULT_STATS_INTERVAL) -> None:
+        if mode not in SERVING_MODES:
+            raise ValueError('Unknown serving mode: {}'.format(mode))
+        if overflow_policy not in OVERFLOW_POLICIES:
+            raise ValueError(
+                'Unknown overflow policy: {}'.format(overflow_policy))
+        self.host = get_host()
         self.running = False
+        self.mode = mode
+        if backlog == None:
+            backlog = ASYNC_LISTEN_BACKLOG if mode == SERVING_MODE_ASYNCIO else DEFAULT_LISTEN_BACKLOG
+        self.backlog = backlog
+        self.pool_size = pool_size
+        self.queue_size = queue_size
+        self.overflow_policy = overflow_policy
+        self.max_frame_size = max_frame_size
+        self.read_timeout = read_timeout
+        self.work_queue: Queue = None
+        self.rejected_connections = 0
+        self.loop: asyncio.AbstractEventLoop = None
+        self.async_server: asyncio.AbstractServer = None
+        self.metrics = Metrics()
+        self.stats_file = stats_file
+        self.stats_interval = stats_interval
+        self.stats_thread: Thread = None
+        # method name -> function(message_dict, client_address) -> Message
+        # filled in by child classes
+        self.handlers = {}
+
+    # parses a request and dispatches it to the handler for its method
+    # returns the response to be sent back, in the format of the request
+    def handle_request(self, received: bytes, client_address) -> Message:
+        method_type = None
+        try:
+            message_dict = Message.bytes_to_dict(received)
+            if message_dict['message_type'] != self.request_type.name:
+                raise BadFormatException('Incorrect message type!')
+            method_type = message_dict.get('method')
+            if method_type not in self.handlers:
+                method_type = None
+                raise BadFormatException('Method type not supported!')
+            response = self.handlers[method_type](message_dict, client_address)
+        except Exception as e:
+            log(self.log_filename, 'Invalid message received from {}: {}'.format(
+                client_address, e), type='error')
+            response = self.create_error_response(
+                self.response_type, e, StatusCodes.BAD_REQUEST)
+        response.wire_format = Message.wire_format_of(received)
+        response.request_method = method_type
+        return response
+
+    # coroutine version of handle_request used by the asyncio serving mode
+    # handlers take locks and read or write files, so they run in the
+    # loop's default executor instead of blocking the loop
+    async def handle_request_async(self, received: bytes, client_address) -> Message:
+        return await asyncio.get_running_loop().run_in_executor(
+            None, self.handle_request, received, client_address)
 
     # function to process new connections in separate threads
-    # overridden in child classes
-    def process_new_connection(client_socket, client_address) -> None:
-        pass
+    def process_new_connection(self, client_socket: socket.socket, client_address) -> None:
+        self.metrics.connection_opened()
+        try:
+            with client_socket:
+                received = None
+                client_socket.settimeout(self.read_timeout)
+                try:
+                    received = receive(client_socket, self.max_frame_size)
+                except socket.timeout:
+                    te = TimeoutError('No request from {} after {}s'.format(
+                        client_address, self.read_timeout))
+                    log(self.log_filename, str(te), type='error')
+                    response = self.create_error_response(
+                        self.response_type, te, StatusCodes.REQUEST_TIMEOUT)
+                except FrameTooLargeException as fe:
+                    log(self.log_filename, str(fe), type='error')
+                    response = self.create_error_response(
+                        self.response_type, fe, StatusCodes.BAD_REQUEST)
+                except Exception as e:
+                    log(self.log_filename, str(e), type='error')
+                    response = self.create_error_response(
+                        self.response_type, e, StatusCodes.INTERNAL_ERROR)
+                # requests are timed from the moment they are read
+                start = time.perf_counter()
+                if received != None:
+                    response = self.handle_request(received, client_address)
+                bytes_out = 0
+                failed = False
+                try:
+                    if response.framed != None:
+                        client_socket.sendall(response.framed)
+                        bytes_out = len(response.framed)
+                    else:
+                        data = response.to_bytes()
+                        send(client_socket, data)
+                        bytes_out = FRAME_HEADER.size + len(data)
+                    if response.stream:
+                        self.send_stream(client_socket, response.stream)
+                        bytes_out += response.stream[2]
+                except (socket.error, Exception) as e:
+                    failed = True
+                    log(self.log_filename, 'Failed to send response to {} - {}'.format(
+                        client_address, e), type='error')
+                self.record_request(received, response, start, bytes_out, failed)
+        finally:
+            self.metrics.connection_closed()
+
+    # reads one framed request
+    async def receive_async(self, reader: asyncio.StreamReader) -> bytes:
+        data_len = FRAME_HEADER.unpack(await reader.readexactly(FRAME_HEADER.size))[0]
+        if data_len > self.max_frame_size:
+            raise FrameTooLargeException('Frame of {} bytes exceeds limit of {} bytes!'.format(
+                data_len, self.max_frame_size))
+        return await reader.readexactly(data_len)
+
+    # function to process new connections as coroutines on the event loop
+    async def process_new_connection_async(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self.metrics.connection_opened()
+        try:
+            client_address = writer.get_extra_info('peername')
+            received = None
+            try:
+                received = await asyncio.wait_for(self.receive_async(reader), self.read_timeout)
+            except asyncio.TimeoutError:
+                te = TimeoutError('No request from {} after {}s'.format(
+                    client_address, self.read_timeout))
+                log(self.log_filename, str(te), type='error')
+                response = self.create_error_response(
+                    self.response_type, te, StatusCodes.REQUEST_TIMEOUT)
+            except FrameTooLargeException as fe:
+                log(self.log_filename, str(fe), type='error')
+                response = self.create_error_response(
+                    self.response_type, fe, StatusCodes.BAD_REQUEST)
+            except Exception as e:
+                log(self.log_filename, str(e), type='error')
+                response = self.create_error_response(
+                    self.response_type, e, StatusCodes.INTERNAL_ERROR)
+            start = time.perf_counter()
+            if received != None:
+                response = await self.handle_request_async(received, client_address)
+            bytes_out = 0
+            failed = False
+            try:
+                if response.framed != None:
+                    writer.write(response.framed)
+                    bytes_out = len(response.framed)
+                else:
+                    data = response.to_bytes()
+                    writer.writelines([FRAME_HEADER.pack(len(data)), data])
+                    bytes_out = FRAME_HEADER.size + len(data)
+                await writer.drain()
+                if response.stream:
+                    await self.send_stream_async(writer, response.stream)
+                    bytes_out += response.stream[2]
+            except (socket.error, Exception) as e:
+                failed = True
+                log(self.log_filename, 'Failed to send response to {} - {}'.format(
+                    client_address, e), type='error')
+            finally:
+                writer.close()
+                with contextlib.suppress(socket.error, Exception):
+                    await writer.wait_closed()
+            self.record_request(received, response, start, bytes_out, failed)
+        finally:
+            self.metrics.connection_closed()
+
+    # counts a request in the metrics, responses that are not a success
+    # count as errors
+    # @param received is None if no request could be read
+    def record_request(self, received: bytes, response: Message, start: float, bytes_out: int,
+                       failed: bool) -> None:
+        bytes_in = FRAME_HEADER.size + len(received) if received != None else 0
+        failed = failed or response.status_code not in (
+            '', StatusCodes.SUCCESS.value)
+        self.metrics.record(response.request_method or UNKNOWN_METHOD,
+                            time.perf_counter() - start, bytes_in, bytes_out, failed)
+
+    # values besides the request metrics reported by STATS, e.g. registry
+    # sizes, as {name: number}; set in child classes
+    def stats_gauges(self) -> dict:
+        return {}
+
+    def stats(self) -> dict:
+        stats = self.metrics.snapshot()
+        stats['uptime'] = round(time.time() - self.start_time, 3)
+        stats['mode'] = self.mode
+        stats['rejected_connections'] = self.rejected_connections
+        stats['gauges'] = self.stats_gauges()
+        return stats
+
+    # STATS: request counts, latencies and bytes per method, connections,
+    # lock waits and gauges, since the server started
+    def send_stats(self, message_dict: dict, client_address) -> Message:
+        response = Message(self.response_type)
+        response.headers['hostname'] = self.host
+        response.status_code = StatusCodes.SUCCESS.value
+        response.data = self.stats()
+        return response
 
-    # starts listening
+    # writes the metrics to path in the prometheus text format
+    def dump_stats(self, path: str) -> None:
+        gauges = dict(self.stats_gauges(), uptime_seconds=round(time.time() - self.start_time, 3),
+                      rejected_connections=self.rejected_connections)
+        text = self.metrics.to_prometheus(self.stats_name, gauges)
+        temp_path = '{}.part'.format(path)
+        with open(temp_path, 'w') as file:
+            file.write(text)
+        os.replace(temp_path, path)
+
+    # writes stats_file every stats_interval seconds while the server runs
+    def stats_dumper(self) -> None:
+        while self.running:
+            time.sleep(self.stats_interval)
+            try:
+                self.dump_stats(self.stats_file)
+            except Exception as e:
+                log(self.log_filename, 'Failed to write stats to {} - {}'.format(
+                    self.stats_file, e), type='error')
+
+    # sends the file data attached to a response with sendfile
+    def send_stream(self, client_socket: socket.socket, stream: tuple) -> None:
+        path, offset, count = stream
+        with open(path, 'rb') as file:
+            client_socket.sendfile(file, offset, count)
+
+    async def send_stream_async(self, writer: asyncio.StreamWriter, stream: tuple) -> None:
+        path, offset, count = stream
+        with open(path, 'rb') as file:
+            await self.loop.sendfile(writer.transport, file, offset, count)
+
+    # starts listening and serves until stopped
     # @param port to listen on
     # @param period is how long to run server for. Default is infinite
     def startup(self, port, period=inf) -> None:
+        self.bind(port)
+        self.serve(period)
+
+    # creates the listening socket
+    def bind(self, port) -> None:
         self.port = port
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # allows restarting on the same port while old connections are in TIME_WAIT
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.socket.bind((self.host, self.port))
-        # allow 10 connections to queue before dropping new connections
-        self.socket.listen(10)
+        # connections allowed to queue in the kernel before new ones are dropped
+        self.socket.listen(self.backlog)
         self.running = True
         self.start_time = time.time()
+        if self.stats_file != None:
+            self.stats_thread = Thread(target=self.stats_dumper, daemon=True)
+            self.stats_thread.start()
         print("Ready to connect on: {}:{}".format(self.host, self.port))
 
+    # serves connections on the bound socket using the configured mode
+    def serve(self, period=inf) -> None:
+        if self.mode == SERVING_MODE_ASYNCIO:
+            asyncio.run(self.serve_asyncio(period))
+        elif self.mode == SERVING_MODE_POOL:
+            self.serve_pool(period)
+        else:
+            self.serve_threaded(period)
+
+    def serve_threaded(self, period=inf) -> None:
         while self.running and time.time() < self.start_time + period:
-            client_socket, client_address = self.socket.accept()
+            try:
+                client_socket, client_address = self.socket.accept()
+            except OSError:
+                # socket closed by stop()
+                if not self.running:
+                    break
+                raise
             new_thread = Thread(target=self.process_new_connection, args=(
                 client_socket, client_address), daemon=True)
             new_thread.start()
 
+    def serve_pool(self, period=inf) -> None:
+        self.work_queue = Queue(self.queue_size)
+        workers = [Thread(target=self.pool_worker, daemon=True)
+                   for _ in range(self.pool_size)]
+        for worker in workers:
+            worker.start()
+        try:
+            while self.running and time.time() < self.start_time + period:
+                try:
+                    client_socket, client_address = self.socket.accept()
+                except OSError:
+                    # socket closed by stop()
+                    if not self.running:
+                        break
+                    raise
+                self.admit_connection(client_socket, client_address)
+        finally:
+            # one sentinel per worker, queued behind the remaining work
+            for _ in workers:
+                self.work_queue.put(None)
+
+    # worker thread for the pool serving mode
+    def pool_worker(self) -> None:
+        while True:
+            work = self.work_queue.get()
+            if work == None:
+                return
+            try:
+                self.process_new_connection(*work)
+            except Exception as e:
+                log(self.log_filename, 'Worker failed to process connection - {}'.format(
+                    e), type='error')
+
+    # queues a connection for the pool, applying the overflow policy when full
+    def admit_connection(self, client_socket: socket.socket, client_address) -> None:
+        work = (client_socket, client_address)
+        if self.overflow_policy == OVERFLOW_BLOCK:
+            self.work_queue.put(work)
+            return
+        try:
+            self.work_queue.put_nowait(work)
+            return
+        except Full:
+            if self.overflow_policy == OVERFLOW_REJECT:
+                self.reject_connection(*work)
+                return
+        # shedding the oldest, only this thread adds work so a slot frees up
+        # unless the workers already emptied the queue
+        with contextlib.suppress(Empty):
+            self.reject_connection(*self.work_queue.get_nowait())
+        try:
+            self.work_queue.put_nowait(work)
+        except Full:
+            self.reject_connection(*work)
+
+    # answers a connection the server has no capacity for
+    def reject_connection(self, client_socket: socket.socket, client_address) -> None:
+        self.rejected_connections += 1
+        with client_socket:
+            try:
+                # drain whatever request already arrived so closing does not reset the connection
+                client_socket.setblocking(False)
+                with contextlib.suppress(BlockingIOError):
+                    client_socket.recv(65536)
+                client_socket.settimeout(1)
+                response = self.create_error_response(self.response_type, Exception(
+                    'Server is overloaded, try again later!'), StatusCodes.INTERNAL_ERROR)
+                send(client_socket, response.to_bytes())
+            except (socket.error, Exception) as e:
+                log(self.log_filename, 'Failed to reject connection from {} - {}'.format(
+                    client_address, e), type='error')
+
+    async def serve_asyncio(self, period=inf) -> None:
+        self.loop = asyncio.get_running_loop()
+        self.async_server = await asyncio.start_server(
+            self.process_new_connection_async, sock=self.socket, backlog=self.backlog)
+        timeout = None
+        if period != inf:
+            timeout = max(0, self.start_time + period - time.time())
+        with contextlib.suppress(asyncio.CancelledError, asyncio.TimeoutError):
+            await asyncio.wait_for(self.async_server.serve_forever(), timeout)
+        self.async_server.close()
+        self.running = False
+
     def create_error_response(self, type: MessageType, e: Exception, code: StatusCodes) -> Message:
-        type: MessageType = None
         response = Message(type)
         response.headers['hostname'] = self.host
         response.status_code = code.value
@@ -49,5 +417,12 @@ class Server():
 
     # stop the server
     def stop(self):
-        self.socket.close()
         self.running = False
+        if self.loop is not None and self.async_server is not None:
+            self.loop.call_soon_threadsafe(self.async_server.close)
+        else:
+            # close() alone leaves a blocked accept() listening, so the port
+            # could not be bound again until a connection came in
+            with contextlib.suppress(OSError):
+                self.socket.shutdown(socket.SHUT_RDWR)
+            self.socket.close()
@@ -0,0 +1,225 @@
+from struct import Struct
+from typing import Any, Tuple
+
+# Binary wire format for Message
+#
+# frame = header, headers, data
+# header = magic (B), version (B), message_type (B), method (B),
+#          status_code (H), number of headers (H)
+# headers = (key, value) pairs, each a short string: length (H) + utf-8
+# data = one typed value: tag (1 byte) followed by its payload
+#
+# The magic byte can never start a legacy text message (those start with
+# a quote), so a receiver can tell the two formats apart from the first
+# byte and answer in the format it was spoken to.
+
+MAGIC = 0xB7
+VERSION = 1
+
+HEADER = Struct('>BBBBHH')
+TINY_LEN = Struct('>B')
+SHORT_LEN = Struct('>H')
+LONG_LEN = Struct('>I')
+INT = Struct('>q')
+FLOAT = Struct('>d')
+
+# value tags
+NONE = b'N'
+TRUE = b'T'
+FALSE = b'F'
+INT_TAG = b'i'
+FLOAT_TAG = b'f'
+STR = b's'
+TINY_STR = b't'  # strings under 256 bytes, most keys and addresses
+BYTES = b'b'
+LIST = b'l'
+DICT = b'd'
+
+
+class CodecException(Exception):
+    pass
+
+
+# a value encoded ahead of time, encode_into copies its bytes as they are
+# so responses that are sent often can be serialized once
+# str() gives the value itself for the legacy text format
+class Encoded():
+
+    def __init__(self, data: bytes, value: Any) -> None:
+        self.data = bytes(data)
+        self.value = value
+
+    def __str__(self) -> str:
+        return str(self.value)
+
+    def __repr__(self) -> str:
+        return repr(self.value)
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+
+# encodes a list from items already encoded with encode_value
+def encode_list(encoded_items, value: Any = None) -> Encoded:
+    out = bytearray(LIST)
+    out += LONG_LEN.pack(len(encoded_items))
+    out += b''.join(encoded_items)
+    return Encoded(out, value)
+
+
+def is_binary(data: bytes) -> bool:
+    return len(data) > 0 and data[0] == MAGIC
+
+
+def encode_frame(message_type: int, method: int, status_code: int, headers: dict, data: Any) -> bytearray:
+    out = bytearray(HEADER.pack(MAGIC, VERSION, message_type,
+                                method, status_code, len(headers)))
+    for key, value in headers.items():
+        encode_short_string(out, str(key))
+        encode_short_string(out, str(value))
+    encode_into(out, data)
+    return out
+
+# returns (message_type, method, status_code, headers, data)
+
+
+def decode_frame(data: bytes) -> Tuple[int, int, int, dict, Any]:
+    view = memoryview(data)
+    if len(view) < HEADER.size:
+        raise CodecException('Frame too short!')
+    magic, version, message_type, method, status_code, header_count = HEADER.unpack_from(
+        view)
+    if magic != MAGIC:
+        raise CodecException('Not a binary frame!')
+    if version > VERSION:
+        raise CodecException(
+            'Unsupported wire format version {}!'.format(version))
+    offset = HEADER.size
+    headers = {}
+    for _ in range(header_count):
+        key, offset = decode_short_string(view, offset)
+        value, offset = decode_short_string(view, offset)
+        headers[key] = value
+    value, offset = decode_value(view, offset)
+    if offset != len(view):
+        raise CodecException('Trailing bytes after frame data!')
+    return message_type, method, status_code, headers, value
+
+
+def encode_value(value: Any) -> bytearray:
+    out = bytearray()
+    encode_into(out, value)
+    return out
+
+
+def encode_short_string(out: bytearray, string: str) -> None:
+    encoded = string.encode('utf-8')
+    out += SHORT_LEN.pack(len(encoded))
+    out += encoded
+
+
+def encode_into(out: bytearray, value: Any) -> None:
+    if value is None:
+        out += NONE
+    elif value is True:
+        out += TRUE
+    elif value is False:
+        out += FALSE
+    elif isinstance(value, int):
+        out += INT_TAG
+        out += INT.pack(value)
+    elif isinstance(value, float):
+        out += FLOAT_TAG
+        out += FLOAT.pack(value)
+    elif isinstance(value, str):
+        encoded = value.encode('utf-8')
+        if len(encoded) < 256:
+            out += TINY_STR
+            out += TINY_LEN.pack(len(encoded))
+        else:
+            out += STR
+            out += LONG_LEN.pack(len(encoded))
+        out += encoded
+    elif isinstance(value, Encoded):
+        out += value.data
+    elif isinstance(value, (bytes, bytearray, memoryview)):
+        out += BYTES
+        out += LONG_LEN.pack(len(value))
+        out += value
+    elif isinstance(value, dict):
+        out += DICT
+        out += LONG_LEN.pack(len(value))
+        for key, item in value.items():
+            encode_into(out, key)
+            encode_into(out, item)
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        out += LIST
+        out += LONG_LEN.pack(len(value))
+        for item in value:
+            encode_into(out, item)
+    else:
+        # exceptions and the like are sent as their message
+        encode_into(out, str(value))
+
+# raw bytes are returned as memoryview slices of the frame, no copies made
+
+
+def decode_value(view: memoryview, offset: int) -> Tuple[Any, int]:
+    try:
+        tag = view[offset:offset + 1].tobytes()
+        offset += 1
+        if tag == TINY_STR:
+            end = offset + 1 + view[offset]
+            if end > len(view):
+                raise CodecException('Value runs past end of frame!')
+            return str(view[offset + 1:end], 'utf-8'), end
+        elif tag == NONE:
+            return None, offset
+        elif tag == TRUE:
+            return True, offset
+        elif tag == FALSE:
+            return False, offset
+        elif tag == INT_TAG:
+            return INT.unpack_from(view, offset)[0], offset + INT.size
+        elif tag == FLOAT_TAG:
+            return FLOAT.unpack_from(view, offset)[0], offset + FLOAT.size
+        elif tag == STR or tag == BYTES:
+            length = LONG_LEN.unpack_from(view, offset)[0]
+            offset += LONG_LEN.size
+            end = offset + length
+            if end > len(view):
+                raise CodecException('Value runs past end of frame!')
+            if tag == STR:
+                return str(view[offset:end], 'utf-8'), end
+            return view[offset:end], end
+        elif tag == LIST:
+            count = LONG_LEN.unpack_from(view, offset)[0]
+            offset += LONG_LEN.size
+            items = []
+            for _ in range(count):
+                item, offset = decode_value(view, offset)
+                items.append(item)
+            return items, offset
+        elif tag == DICT:
+            count = LONG_LEN.unpack_from(view, offset)[0]
+            offset += LONG_LEN.size
+            items = {}
+            for _ in range(count):
+                key, offset = decode_value(view, offset)
+                items[key], offset = decode_value(view, offset)
+            return items, offset
+        else:
+            raise CodecException('Unknown value tag {}!'.format(tag))
+    except CodecException:
+        raise
+    except Exception as e:
+        raise CodecException('Malformed frame - {}'.format(e))
+
+
+def decode_short_string(view: memoryview, offset: int) -> Tuple[str, int]:
+    length = SHORT_LEN.unpack_from(view, offset)[0]
+    offset += SHORT_LEN.size
+    end = offset + length
+    if end > len(view):
+        raise CodecException('Header runs past end of frame!')
+    return str(view[offset:end], 'utf-8'), end
@@ -0,0 +1,185 @@
+import lzma
+import os
+import socket
+import zlib
+from threading import Lock
+from typing import List, Tuple
+
+# Compression for rfc transfers
+#
+# A client lists the codecs it can decode in its GET_RFC request, best
+# first, and the server answers with the first one it also supports. The
+# server never compresses per request: each rfc, or byte range of one that
+# parallel downloads ask for, is compressed once per codec into a cache
+# file, which is then streamed like the rfc itself would be.
+
+# codecs this peer can encode and decode, best ratio first
+SUPPORTED_CODECS = ('lzma', 'zlib')
+
+COMPRESS_CHUNK_SIZE = 256 * 1024
+# copies are built inside a GET_RFC handler the first time they are asked
+# for; higher presets barely shrink rfcs further but take much longer
+LZMA_PRESET = 6
+
+
+def compressor(codec: str):
+    if codec == 'lzma':
+        return lzma.LZMACompressor(preset=LZMA_PRESET)
+    if codec == 'zlib':
+        return zlib.compressobj(9)
+    raise ValueError('Unknown codec: {}'.format(codec))
+
+
+# the returned object has decompress(data) and eof
+def decompressor(codec: str):
+    if codec == 'lzma':
+        return lzma.LZMADecompressor()
+    if codec == 'zlib':
+        return zlib.decompressobj()
+    raise ValueError('Unknown codec: {}'.format(codec))
+
+
+# first codec offered that this peer supports, None if there is none
+def choose_codec(offered: List[str]) -> str:
+    for codec in offered or ():
+        if codec in SUPPORTED_CODECS:
+            return codec
+    return None
+
+
+# compresses length bytes of the source starting at offset, the rest of
+# the file when length is None
+def compress_file(source_path: str, target_path: str, codec: str, offset: int = 0, length: int = None) -> None:
+    engine = compressor(codec)
+    with open(source_path, 'rb') as source, open(target_path, 'wb') as target:
+        source.seek(offset)
+        while length == None or length > 0:
+            data = source.read(COMPRESS_CHUNK_SIZE if length == None else min(
+                COMPRESS_CHUNK_SIZE, length))
+            if not data:
+                break
+            if length != None:
+                length -= len(data)
+            target.write(engine.compress(data))
+        target.write(engine.flush())
+
+
+# yields what data decompresses to, at most max_length bytes at a time
+# zlib keeps the input it did not get to in unconsumed_tail, lzma buffers
+# it and clears needs_input while it has more output
+def decompress_pieces(engine, data, max_length: int):
+    while True:
+        piece = engine.decompress(data, max_length)
+        if hasattr(engine, 'unconsumed_tail'):
+            data = engine.unconsumed_tail
+            more = bool(data) or len(piece) == max_length
+        else:
+            data = b''
+            more = not engine.needs_input
+        if piece:
+            yield piece
+        if engine.eof or not more:
+            return
+
+
+# receives count compressed bytes and yields them decompressed
+# @param size is the size of the decompressed data, anything else is an
+# error; output is never expanded more than a byte past it, so a stream
+# that inflates to far more than size is stopped early
+def receive_decompressed(conn: socket.socket, count: int, codec: str, size: int,
+                         chunk_size: int = COMPRESS_CHUNK_SIZE):
+    engine = decompressor(codec)
+    buffer = bytearray(chunk_size)
+    view = memoryview(buffer)
+    left_to_receive = count
+    produced = 0
+    while left_to_receive > 0:
+        received = conn.recv_into(view, min(chunk_size, left_to_receive))
+        if received == 0:
+            raise ConnectionError('Connection closed after {} of {} bytes!'.format(
+                count - left_to_receive, count))
+        left_to_receive -= received
+        for piece in decompress_pieces(engine, view[:received], min(chunk_size, size - produced + 1)):
+            produced += len(piece)
+            if produced > size:
+                raise ValueError(
+                    'Decompressed data exceeds {} bytes!'.format(size))
+            yield piece
+    if not engine.eof or engine.unused_data or produced != size:
+        raise ValueError('Compressed stream ended after {} of {} bytes!'.format(
+            produced, size))
+
+
+# receives count compressed bytes and writes them decompressed to fd,
+# starting at offset
+# @param size is the size of the decompressed data, anything else is an error
+def receive_decompressed_to_fd(conn: socket.socket, count: int, fd: int, codec: str, size: int,
+                               offset: int = 0, chunk_size: int = COMPRESS_CHUNK_SIZE) -> None:
+    for data in receive_decompressed(conn, count, codec, size, chunk_size):
+        written = 0
+        while written < len(data):
+            written += os.pwrite(fd, data[written:], offset + written)
+        offset += len(data)
+
+
+# precompressed copies of files, one per file version, byte range and codec
+# a copy is made the first time it is asked for; the file's digest (when
+# known), mtime and size are part of the cache key, so a changed file
+# never gets an old copy
+class Compression_Cache():
+
+    def __init__(self, cache_dir: str) -> None:
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+        self.lock = Lock()
+        # cache path -> lock held while that copy is written
+        self.build_locks = {}
+        # (file path, codec, offset, length) -> current cache path, older
+        # copies are removed
+        self.current = {}
+
+    # returns (path, size) of the compressed copy of the file at path, or
+    # None if compressing does not make it smaller
+    # @param offset and length select a byte range, the whole file by default
+    def get(self, path: str, codec: str, digest: str = None, offset: int = 0,
+            length: int = None) -> Tuple[str, int]:
+        stat = os.stat(path)
+        key = '{}-{}-{}'.format(digest or os.path.basename(path),
+                                stat.st_mtime_ns, stat.st_size)
+        if length == None:
+            length = stat.st_size - offset
+        # whole files are tracked apart from their size, so the copy of a
+        # file that changed size still replaces the old one
+        whole = offset == 0 and length == stat.st_size
+        if not whole:
+            key = '{}-{}-{}'.format(key, offset, length)
+        cache_path = os.path.join(
+            self.cache_dir, '{}.{}'.format(key, codec))
+        if not os.path.exists(cache_path):
+            self.build(path, cache_path, codec, offset,
+                       None if whole else length)
+        size = os.path.getsize(cache_path)
+        if size >= length:
+            return None
+        return cache_path, size
+
+    def build(self, path: str, cache_path: str, codec: str, offset: int = 0, length: int = None) -> None:
+        with self.lock:
+            build_lock = self.build_locks.setdefault(cache_path, Lock())
+        with build_lock:
+            # another request may have built it meanwhile
+            if not os.path.exists(cache_path):
+                temp_path = '{}.part'.format(cache_path)
+                try:
+                    compress_file(path, temp_path, codec, offset, length)
+                    os.replace(temp_path, cache_path)
+                except BaseException:
+                    if os.path.exists(temp_path):
+                        os.remove(temp_path)
+                    raise
+        with self.lock:
+            self.build_locks.pop(cache_path, None)
+            previous = self.current.get((path, codec, offset, length))
+            self.current[(path, codec, offset, length)] = cache_path
+        if previous not in (None, cache_path) and os.path.exists(previous):
+            os.remove(previous)
@@ -1,6 +1,9 @@
+from ast import literal_eval
 from enum import Enum
 from typing import Any
 
+from p2p_di.utils import codec
+
 
 class MessageType(Enum):
 
@@ -22,6 +25,17 @@ class MethodType(Enum):
     RFC_QUERY = 5
     GET_RFC = 6
 
+    # several peer to RS requests in one
+    BATCH = 7
+
+    # p2p keyword search over a peer's rfcs
+    SEARCH = 8
+    # p2p metadata of a peer's rfcs
+    CATALOG = 9
+
+    # request metrics of the rs or an rfc server
+    STATS = 10
+
 
 class StatusCodes(Enum):
 
@@ -29,8 +43,17 @@ class StatusCodes(Enum):
     BAD_REQUEST = 400
     FORBIDDEN = 403
     NOT_FOUND = 404
+    REQUEST_TIMEOUT = 408
     INTERNAL_ERROR = 500
 
+
+class WireFormat(Enum):
+
+    # '<crlf>' joined text, understood by every peer
+    LEGACY = 1
+    # versioned binary frames, see codec.py
+    BINARY = 2
+
 # Class for messages across clients and servers
 
 
@@ -43,8 +66,19 @@ class Message():
         self.message_type = type.name
         self.method = ''
         self.data: Any = None
-        if type.name.__contains__('RESPONSE'):
-            self.status_code = ''
+        # only set on responses
+        self.status_code = ''
+        # format used by to_bytes, responses use the format of the request
+        self.wire_format = WireFormat.BINARY
+        # (path, offset, count) of file data sent raw right after the
+        # message, not part of the message itself
+        self.stream: tuple = None
+        # frame header and encoded message, sent instead of encoding the
+        # message again when set
+        self.framed: bytes = None
+        # method of the request a response answers, kept by the server for
+        # its metrics, not sent
+        self.request_method: str = None
 
     def __str__(self):
         string = ''
@@ -55,7 +89,9 @@ class Message():
         #
         string += "'message_type':'{}'".format(self.message_type)
         if self.method:
-            string += "{}'method':'{}'".format(self.CRLF, self.method)
+            method = self.method.name if isinstance(
+                self.method, MethodType) else self.method
+            string += "{}'method':'{}'".format(self.CRLF, method)
         if self.status_code:
             string += "{}'status_code':'{}'".format(
                 self.CRLF, self.status_code)
@@ -63,18 +99,56 @@ class Message():
             string += "{}'data':'{}'".format(self.CRLF, self.data)
         return string
 
-    def to_bytes(self):
+    def to_bytes(self) -> bytes:
+        if self.wire_format == WireFormat.BINARY:
+            return self.to_frame()
         return bytes(str(self), 'utf-8')
 
+    def to_frame(self) -> bytearray:
+        method = self.method
+        if isinstance(method, str):
+            method = MethodType[method] if method else None
+        return codec.encode_frame(MessageType[self.message_type].value,
+                                  method.value if method else 0,
+                                  int(self.status_code or 0),
+                                  self.headers, self.data)
+
+    # format a received message was sent in
+    @staticmethod
+    def wire_format_of(bytes: bytes) -> WireFormat:
+        if codec.is_binary(bytes):
+            return WireFormat.BINARY
+        return WireFormat.LEGACY
+
     @staticmethod
     def string_to_dict(string: str) -> dict:
         tokens = string.split(Message.CRLF)
         dict_string = '{'
         dict_string += ','.join(tokens)
         dict_string += '}'
-        return eval(dict_string)
+        message_dict = literal_eval(dict_string)
+        if message_dict.get('status_code'):
+            message_dict['status_code'] = int(message_dict['status_code'])
+        return message_dict
+
+    # flattens a binary frame into the same dict string_to_dict returns
+    @staticmethod
+    def frame_to_dict(bytes: bytes) -> dict:
+        message_type, method, status_code, headers, data = codec.decode_frame(
+            bytes)
+        message_dict = headers
+        message_dict['message_type'] = MessageType(message_type).name
+        if method:
+            message_dict['method'] = MethodType(method).name
+        if status_code:
+            message_dict['status_code'] = status_code
+        if data is not None:
+            message_dict['data'] = data
+        return message_dict
 
     @staticmethod
     def bytes_to_dict(bytes: bytes) -> dict:
-        string = bytes.decode('utf-8')
+        if codec.is_binary(bytes):
+            return Message.frame_to_dict(bytes)
+        string = str(bytes, 'utf-8')
         return Message.string_to_dict(string)
@@ -1,36 +1,352 @@
+import atexit
+import itertools
 import logging
+import os
 import socket
 import time
 from contextlib import closing
-from struct import pack, unpack
+from functools import lru_cache
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from queue import Empty, SimpleQueue
+from struct import Struct
+from threading import Lock
 from typing import List
 
+from p2p_di.utils import codec
+from p2p_di.utils.message import Message, WireFormat
+
 DEFAULT_TTL = 7200
 DEFAULT_RS_PORT = 65234
+# environment variables overriding the address this host is reached at and
+# the port of the registration server, e.g. P2P_DI_HOST=127.0.0.1 to run
+# everything on loopback; the rs takes udp heartbeats on the same port
+# number, so they follow P2P_DI_RS_PORT too
+HOST_ENV = 'P2P_DI_HOST'
+RS_PORT_ENV = 'P2P_DI_RS_PORT'
 DEFAULT_UPDATE_INTERVAL = 5
+# the rs writes its peer list to disk at least this often (seconds), or once
+# this many peers have unsaved changes
+DEFAULT_FLUSH_INTERVAL = 2
+DEFAULT_FLUSH_THRESHOLD = 1024
+# udp keep alives: magic, kind, flags, 16 byte cookie
+HEARTBEAT = Struct('>BBB16s')
+HEARTBEAT_PING = 1
+HEARTBEAT_ACK = 2
+HEARTBEAT_REJECT = 3  # unknown or expired cookie, register again
+HEARTBEAT_WANT_REPLY = 1
+# heartbeat_port of the rs for the udp port with the number of the tcp port
+# it listens on, get_rs_address()[1]
+SAME_AS_RS_PORT = -1
+# seconds to wait for an ack and lost acks in a row before a client goes
+# back to tcp keep alives
+DEFAULT_HEARTBEAT_TIMEOUT = 1
+DEFAULT_HEARTBEAT_LOSSES = 3
+# replies to heartbeats with bad cookies, per second and burst, per source
+INVALID_HEARTBEAT_RATE = 10
+INVALID_HEARTBEAT_BURST = 20
+# locks the rs spreads its peers over
+DEFAULT_LOCK_STRIPES = 64
+# most peers sent in one page or sample of a PQUERY reply
+DEFAULT_MAX_PAGE_SIZE = 1024
+# storage backends for the rs peer list
+PEER_STORE_TINYDB = 'tinydb'
+PEER_STORE_SQLITE = 'sqlite'
+PEER_STORES = (PEER_STORE_TINYDB, PEER_STORE_SQLITE)
+DEFAULT_PEER_STORE = PEER_STORE_TINYDB
+
+# every message is sent as a frame: 4 byte big endian length, then the data
+FRAME_HEADER = Struct('>I')
+# frames announcing more data than this are refused
+DEFAULT_MAX_FRAME_SIZE = 64 * 1024 * 1024
+# chunk size for streaming rfc files to disk
+DEFAULT_CHUNK_SIZE = 64 * 1024
+# rfcs larger than this are split into ranges fetched from several owners
+DEFAULT_DOWNLOAD_CHUNK_SIZE = 256 * 1024
+# seconds a peer gets to serve one range before it is given to another peer
+DEFAULT_TRANSFER_TIMEOUT = 10
+# rfc index lookups: seconds per peer, seconds overall and peers queried at once
+DEFAULT_PEER_TIMEOUT = 2
+DEFAULT_LOOKUP_DEADLINE = 5
+DEFAULT_FANOUT_WORKERS = 32
+# changes remembered per rfc index for delta RFC_QUERY replies
+DEFAULT_CHANGE_LOG_SIZE = 4096
+# distinct rfc owner sets kept decoded by the rfc index peer table
+PEER_SET_CACHE_SIZE = 4096
+# bytes of encoded responses an rfc server keeps for repeated requests
+DEFAULT_RESPONSE_CACHE_SIZE = 64 * 1024 * 1024
+# SEARCH results returned by default and at most, per peer
+DEFAULT_SEARCH_LIMIT = 10
+MAX_SEARCH_LIMIT = 100
+# BM25 ranking parameters for SEARCH
+SEARCH_BM25_K1 = 1.2
+SEARCH_BM25_B = 0.75
+# search index of a peer's rfcs, kept inside its rfc store so a client
+# started again over the same store finds it; rfc names never start with
+# a dot
+SEARCH_INDEX_FILE = '.search_index.json.gz'
+
+# log files: record format, level and rotation
+LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+LOG_DATE_FORMAT = '%m/%d/%Y %I:%M:%S %p'
+LOG_LEVELS = {'debug': logging.DEBUG, 'info': logging.INFO,
+              'warning': logging.WARNING, 'error': logging.ERROR}
+DEFAULT_LOG_LEVEL = logging.DEBUG
+LOG_MAX_BYTES = 16 * 1024 * 1024
+LOG_BACKUP_COUNT = 3
+# seconds buffered log records may wait before they are written
+LOG_FLUSH_INTERVAL = 1
+# events logged only 1 in N times, e.g. a keep alive from every peer
+DEFAULT_LOG_SAMPLE_RATES = {'keep_alive': 100}
+
+# seconds between writes of a server's metrics to its stats file
+DEFAULT_STATS_INTERVAL = 10
+# threads counting into their own metrics shard before the shards of
+# threads that finished are folded together
+METRICS_SHARD_FOLD_THRESHOLD = 256
+
+# serving modes for Server.startup
+SERVING_MODE_THREADED = 'threaded'
+SERVING_MODE_ASYNCIO = 'asyncio'
+SERVING_MODE_POOL = 'pool'
+SERVING_MODES = (SERVING_MODE_THREADED,
+                 SERVING_MODE_ASYNCIO, SERVING_MODE_POOL)
+DEFAULT_SERVING_MODE = SERVING_MODE_THREADED
+# listen backlogs, asyncio mode gets a larger one by default
+DEFAULT_LISTEN_BACKLOG = 10
+ASYNC_LISTEN_BACKLOG = 4096
+# worker pool used by the pool serving mode
+DEFAULT_POOL_SIZE = 16
+DEFAULT_QUEUE_SIZE = 256
+# what the pool does with a new connection when its queue is full
+OVERFLOW_REJECT = 'reject'  # answer the new connection with INTERNAL_ERROR
+OVERFLOW_BLOCK = 'block'  # stop accepting until a worker frees a slot
+OVERFLOW_SHED_OLDEST = 'shed_oldest'  # reject the longest queued connection
+OVERFLOW_POLICIES = (OVERFLOW_REJECT, OVERFLOW_BLOCK, OVERFLOW_SHED_OLDEST)
+DEFAULT_OVERFLOW_POLICY = OVERFLOW_REJECT
+# seconds a connection may take to send its request, and then each send of
+# the response may take, before the server gives up on it
+DEFAULT_READ_TIMEOUT = 10
+
+# heartbeat datagrams carry the cookie as 16 raw bytes instead of 32 hex digits
+
+
+def pack_heartbeat(kind: int, cookie: str, flags: int = 0) -> bytes:
+    return HEARTBEAT.pack(codec.MAGIC, kind, flags, bytes.fromhex(cookie))
+
+# returns (kind, flags, cookie) or None if the datagram is not a heartbeat
+
+
+def unpack_heartbeat(data) -> tuple:
+    if len(data) != HEARTBEAT.size:
+        return None
+    magic, kind, flags, cookie = HEARTBEAT.unpack(data)
+    if magic != codec.MAGIC:
+        return None
+    return kind, flags, cookie.hex()
 
 # returns tuple to be used with socket.connect()
+# resolved once, every request to the RS needs it
 
 
+@lru_cache(maxsize=None)
 def get_rs_address():
-    host = socket.gethostbyname(socket.gethostname()+".local")
-    return (host, DEFAULT_RS_PORT)
-
-
-def log(filename, log_entry, type):
-    logging.basicConfig(filename=filename,
-                        filemode='a',
-                        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-                        datefmt='%m/%d/%Y %I:%M:%S %p',
-                        level=logging.DEBUG)
-    if type == 'info':
-        logging.info(log_entry)
-    elif type == 'warning':
-        logging.warning(log_entry)
-    elif type == 'error':
-        logging.error(log_entry)
-    elif type == 'debug':
-        logging.debug(log_entry)
+    return (get_host(), int(os.environ.get(RS_PORT_ENV, DEFAULT_RS_PORT)))
+
+# address servers listen on and announce to others
+
+
+def get_host() -> str:
+    return os.environ.get(HOST_ENV) or socket.gethostbyname(socket.gethostname()+".local")
+
+
+# Logging
+#
+# Every component (the rs, each rfc server, each client) has its own logger
+# writing to its own file. Records are put on one queue shared by the
+# process and written by a single background thread, so a request never
+# waits on file i/o. Files are written through a buffer that is flushed
+# every LOG_FLUSH_INTERVAL seconds and right away for warnings and errors,
+# and rotated at LOG_MAX_BYTES. Records tagged with an event listed in the
+# sample rates are kept 1 in N, warnings and errors are always kept.
+
+
+# leaves records as they are, they do not leave the process and formatting
+# them is left to the writer thread
+class Log_Queue_Handler(QueueHandler):
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+# keeps 1 in N info and debug records of each sampled event
+class Sampling_Filter(logging.Filter):
+
+    def __init__(self, sample_rates: dict) -> None:
+        super().__init__()
+        self.sample_rates = dict(sample_rates or {})
+        self.counters = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        return self.keep(getattr(record, 'event', None), record.levelno)
+
+    def keep(self, event: str, level: int) -> bool:
+        rate = self.sample_rates.get(event)
+        if not rate or rate <= 1 or level >= logging.WARNING:
+            return True
+        counter = self.counters.get(event)
+        if counter == None:
+            counter = self.counters.setdefault(event, itertools.count())
+        return next(counter) % rate == 0
+
+
+# rotating file handler that leaves flushing to the writer thread, except
+# for warnings and errors
+class Buffered_File_Handler(RotatingFileHandler):
+
+    def __init__(self, filename: str) -> None:
+        super().__init__(filename, mode='a', maxBytes=LOG_MAX_BYTES,
+                         backupCount=LOG_BACKUP_COUNT, delay=True)
+        self.setFormatter(logging.Formatter(
+            LOG_FORMAT, datefmt=LOG_DATE_FORMAT))
+        self.flush_now = False
+
+    def emit(self, record: logging.LogRecord) -> None:
+        self.flush_now = record.levelno >= logging.WARNING
+        super().emit(record)
+
+    def flush(self) -> None:
+        if self.flush_now:
+            super().flush()
+
+    def flush_buffer(self) -> None:
+        super().flush()
+
+    # the file is opened again on the next record, after it was removed or
+    # truncated by a new instance of the component
+    def reopen(self) -> None:
+        self.acquire()
+        try:
+            if self.stream != None:
+                self.stream.flush()
+                self.stream.close()
+                self.stream = None
+        finally:
+            self.release()
+
+
+# hands each record to the file handler of the logger that made it
+class Log_Router(logging.Handler):
+
+    def __init__(self) -> None:
+        super().__init__()
+        # logger name -> Buffered_File_Handler
+        self.targets = {}
+        # absolute file path -> Buffered_File_Handler
+        self.files = {}
+        self.last_flush = time.monotonic()
+
+    def emit(self, record: logging.LogRecord) -> None:
+        target = self.targets.get(record.name)
+        if target != None:
+            target.handle(record)
+        # the queue may never run dry under load
+        if time.monotonic() - self.last_flush >= LOG_FLUSH_INTERVAL:
+            self.flush()
+
+    def flush(self) -> None:
+        for target in list(self.files.values()):
+            target.flush_buffer()
+        self.last_flush = time.monotonic()
+
+    def close(self) -> None:
+        for target in list(self.files.values()):
+            target.close()
+        super().close()
+
+
+# flushes the files whenever no record came in for LOG_FLUSH_INTERVAL
+class Log_Listener(QueueListener):
+
+    def dequeue(self, block: bool) -> logging.LogRecord:
+        while True:
+            try:
+                return self.queue.get(block, LOG_FLUSH_INTERVAL)
+            except Empty:
+                for handler in self.handlers:
+                    handler.flush()
+                if not block:
+                    raise
+
+
+log_lock = Lock()
+log_queue = SimpleQueue()
+log_router = Log_Router()
+log_listener = None
+# log file name -> (logger writing to it, its Sampling_Filter), used by log()
+log_files = {}
+
+
+def stop_logging() -> None:
+    global log_listener
+    with log_lock:
+        if log_listener != None:
+            log_listener.stop()
+            log_listener = None
+        log_router.flush()
+
+
+# returns the logger of a component, creating it on first use
+# @param name is prefixed with 'p2p_di.', e.g. 'rs' or 'client.<name>'
+# @param filename is the file its records are written to
+# @param level drops records below it before they are queued
+# @param sample_rates is {event: N}, see Sampling_Filter
+def get_logger(name: str, filename: str, level=DEFAULT_LOG_LEVEL,
+               sample_rates: dict = DEFAULT_LOG_SAMPLE_RATES) -> logging.Logger:
+    global log_listener
+    logger = logging.getLogger('p2p_di.{}'.format(name))
+    with log_lock:
+        if log_listener == None:
+            log_listener = Log_Listener(log_queue, log_router)
+            log_listener.start()
+        if not logger.handlers:
+            logger.addHandler(Log_Queue_Handler(log_queue))
+            logger.propagate = False
+        for old_filter in list(logger.filters):
+            logger.removeFilter(old_filter)
+        sampler = Sampling_Filter(sample_rates)
+        logger.addFilter(sampler)
+        path = os.path.abspath(filename)
+        target = log_router.files.get(path)
+        if target == None:
+            target = log_router.files[path] = Buffered_File_Handler(path)
+        else:
+            target.reopen()
+        log_router.targets[logger.name] = target
+        log_files[filename] = (logger, sampler)
+    logger.setLevel(level)
+    return logger
+
+
+atexit.register(stop_logging)
+
+
+# logs through the logger writing to filename, see get_logger
+# records dropped by level or sampling are never built, and the caller's
+# frame is not looked up, which is most of what a record costs
+# @param event tags high volume records so they can be sampled
+def log(filename, log_entry, type, event: str = None):
+    entry = log_files.get(filename)
+    if entry == None:
+        # a file no component registered, named after its path so two
+        # such files never share a logger
+        get_logger('file:{}'.format(os.path.abspath(filename)), filename)
+        entry = log_files[filename]
+    logger, sampler = entry
+    level = LOG_LEVELS[type]
+    if not logger.isEnabledFor(level) or not sampler.keep(event, level):
+        return
+    logger.callHandlers(logger.makeRecord(
+        logger.name, level, filename, 0, log_entry, None, None, extra={'event': event}))
 
 # finds and returns a free port for client's rfc server
 
@@ -44,35 +360,113 @@ def find_free_port() -> int:
 # returns list of strings where each element is one line of rfc text file
 
 
-def get_rfc_data(rfc_path: str) -> List[str]:
-    rfc_lines = []
+def get_rfc_data(rfc_path: str) -> List[bytes]:
     with open(rfc_path, 'rb') as rfc_file:
-        while line := rfc_file.readline().strip():
-            rfc_lines.append(line)
-    return rfc_lines
-
-# writes list of strings to text file
-
-
-def save_rfc_file(lines: List[str], rfc_path: str) -> None:
-    rfc_lines = []
-    with open(rfc_path, 'w') as rfc_file:
-        rfc_file.write('\n'.join(lines))
-
-
-def send(conn: socket.socket, data: bytes):
-    data_plus_len = pack('>I', len(data)) + data
-    conn.sendall(data_plus_len)
-
-
-def receive(conn: socket.socket) -> bytes:
-    data_len = unpack('>I', conn.recv(4))[0]
-    received_data = b''
-    left_to_receive = data_len
-    while left_to_receive != 0:
-        received_data += conn.recv(left_to_receive)
-        left_to_receive = data_len - len(received_data)
-    return received_data
+        return rfc_file.read().splitlines()
+
+# writes list of lines to rfc file
+
+
+def save_rfc_file(lines: List[bytes], rfc_path: str) -> None:
+    with open(rfc_path, 'wb') as rfc_file:
+        rfc_file.write(b'\n'.join(line.encode('utf-8') if isinstance(line, str) else bytes(line)
+                                  for line in lines))
+
+# reads count bytes from conn and writes them to fd starting at offset,
+# for whole files and for byte ranges of a file downloaded from several peers
+# hasher (e.g. hashlib.sha256()) is fed the bytes as they arrive
+
+
+def receive_to_fd(conn: socket.socket, count: int, fd: int, offset: int, chunk_size: int = DEFAULT_CHUNK_SIZE,
+                  hasher=None) -> None:
+    buffer = bytearray(chunk_size)
+    view = memoryview(buffer)
+    left_to_receive = count
+    while left_to_receive > 0:
+        received = conn.recv_into(view, min(chunk_size, left_to_receive))
+        if received == 0:
+            raise ConnectionError('Connection closed after {} of {} bytes!'.format(
+                count - left_to_receive, count))
+        if hasher != None:
+            hasher.update(view[:received])
+        written = 0
+        while written < received:
+            written += os.pwrite(fd, view[written:received], offset + written)
+        offset += received
+        left_to_receive -= received
+
+
+def send(conn: socket.socket, data: bytes) -> None:
+    send_buffers(conn, [FRAME_HEADER.pack(len(data)), data])
+
+# scatter-gather send of several buffers without joining them first
+
+
+def send_buffers(conn: socket.socket, buffers: List[bytes]) -> None:
+    if not hasattr(conn, 'sendmsg'):
+        conn.sendall(b''.join(buffers))
+        return
+    views = [memoryview(buffer).cast('B') for buffer in buffers if len(buffer)]
+    while views:
+        sent = conn.sendmsg(views)
+        # drop fully sent buffers, trim a partially sent one
+        while sent:
+            if sent >= len(views[0]):
+                sent -= len(views.pop(0))
+            else:
+                views[0] = views[0][sent:]
+                sent = 0
+
+
+def receive(conn: socket.socket, max_size: int = DEFAULT_MAX_FRAME_SIZE) -> bytearray:
+    data_len = FRAME_HEADER.unpack(receive_exactly(conn, FRAME_HEADER.size))[0]
+    if data_len > max_size:
+        raise FrameTooLargeException('Frame of {} bytes exceeds limit of {} bytes!'.format(
+            data_len, max_size))
+    return receive_exactly(conn, data_len)
+
+# reads exactly size bytes into one preallocated buffer
+
+
+def receive_exactly(conn: socket.socket, size: int) -> bytearray:
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    received = 0
+    while received < size:
+        count = conn.recv_into(view[received:], size - received)
+        if count == 0:
+            raise ConnectionError('Connection closed after {} of {} bytes!'.format(
+                received, size))
+        received += count
+    return buffer
+
+# addresses of peers that only understand the legacy text format
+legacy_peers = set()
+
+# sends a request over a new connection and returns the response as a dict
+# requests go out in the binary format unless the peer is known to be
+# legacy; a legacy reply to a binary request marks the peer as legacy and
+# the request is repeated in the legacy format
+
+
+def exchange(address, message: Message, timeout: float = None, max_size: int = DEFAULT_MAX_FRAME_SIZE) -> dict:
+    address = tuple(address)
+    if address in legacy_peers:
+        message.wire_format = WireFormat.LEGACY
+    response_bytes = request_response(
+        address, message.to_bytes(), timeout, max_size)
+    if message.wire_format == WireFormat.BINARY and Message.wire_format_of(response_bytes) == WireFormat.LEGACY:
+        legacy_peers.add(address)
+        message.wire_format = WireFormat.LEGACY
+        response_bytes = request_response(
+            address, message.to_bytes(), timeout, max_size)
+    return Message.bytes_to_dict(response_bytes)
+
+
+def request_response(address, data: bytes, timeout: float = None, max_size: int = DEFAULT_MAX_FRAME_SIZE) -> bytearray:
+    with socket.create_connection(address, timeout) as conn:
+        send(conn, data)
+        return receive(conn, max_size)
 
 # Class for entry in peer list
 # maintained by the registration server
@@ -80,19 +474,24 @@ def receive(conn: socket.socket) -> bytes:
 
 class Peer_Entry():
 
-    def __init__(self, cookie, name, hostname, port, last_active=None, registration_number=1) -> None:
+    # a peer is active until its absolute expires_at time, so checking
+    # liveness is a comparison against the clock and nothing has to count
+    # ttls down
+    # @param lifetime is the seconds a peer stays active after it was last
+    # heard from
+    def __init__(self, cookie, name, hostname, port, last_active=None, registration_number=1,
+                 lifetime=DEFAULT_TTL) -> None:
         self.cookie = cookie
         self.name = name
         self.hostname = hostname
         self.port = port
+        self.lifetime = lifetime
         if last_active == None:
-            self.active = True
             self.last_active = time.time()
-            self.ttl = DEFAULT_TTL
+            self.expires_at = self.last_active + lifetime
         else:
-            self.active = False
             self.last_active = last_active
-            self.ttl = 0
+            self.expires_at = 0
         self.registration_number = registration_number
 
     def re_register(self, port) -> None:
@@ -102,22 +501,19 @@ class Peer_Entry():
 
     def keep_alive(self) -> None:
         self.last_active = time.time()
-        self.active = True
-        self.ttl = DEFAULT_TTL
+        self.expires_at = self.last_active + self.lifetime
 
     def mark_inactive(self) -> None:
         self.last_active = time.time()
-        self.active = False
-        self.ttl = 0
+        self.expires_at = 0
 
-    def decrement_ttl(self, interval=DEFAULT_UPDATE_INTERVAL) -> None:
-        self.ttl -= interval
-        if self.ttl <= 0:
-            self.ttl = 0
-            self.active = False
+    def is_active(self, now: float = None):
+        return (now or time.time()) < self.expires_at
 
-    def is_active(self):
-        return self.active
+    # seconds left before the peer expires
+    @property
+    def ttl(self) -> float:
+        return max(0, self.expires_at - time.time())
 
     # returns dict that can be inserted in tinydb
     def to_dict(self) -> dict:
@@ -130,10 +526,39 @@ class Peer_Entry():
         db_entry['registration_number'] = self.registration_number
         return db_entry
 
-# exception for when message sent is
-# not in the correct format
 
+# allows rate events per second with bursts of up to burst events
+class Token_Bucket():
+
+    def __init__(self, rate, burst) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last_refill = time.monotonic()
+
+    def take(self) -> bool:
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens +
+                          (now - self.last_refill) * self.rate)
+        self.last_refill = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    # takes amount tokens even if there are not enough, returns the seconds
+    # to wait before using them, until the bucket is out of debt
+    def borrow(self, amount) -> float:
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens +
+                          (now - self.last_refill) * self.rate)
+        self.last_refill = now
+        self.tokens -= amount
+        return max(0, -self.tokens / self.rate)
 
+
+# exception for when message sent is
+# not in the correct format
 class BadFormatException(Exception):
     pass
 
@@ -142,3 +567,15 @@ class BadFormatException(Exception):
 
 class NotRegisteredException(Exception):
     pass
+
+# when a frame is larger than the receiver accepts
+
+
+class FrameTooLargeException(Exception):
+    pass
+
+# when received data does not match its advertised hash
+
+
+class HashMismatchException(Exception):
+    pass
@@ -0,0 +1,42 @@
+import time
+from threading import Thread
+
+import pytest
+
+from p2p_di.utils.utils import (HOST_ENV, RS_PORT_ENV, find_free_port,
+                                get_rs_address)
+
+
+# every server on loopback, with the rs on a free port instead of the
+# default one
+@pytest.fixture
+def rs_address(monkeypatch):
+    monkeypatch.setenv(HOST_ENV, '127.0.0.1')
+    monkeypatch.setenv(RS_PORT_ENV, str(find_free_port()))
+    get_rs_address.cache_clear()
+    yield get_rs_address()
+    get_rs_address.cache_clear()
+
+
+# starts RegistrationServers, whose constructor serves until stop(), in the
+# background and stops them after the test
+@pytest.fixture
+def start_rs(rs_address):
+    from p2p_di.server.rs import RegistrationServer
+    servers = []
+
+    def start(**options) -> RegistrationServer:
+        server = RegistrationServer.__new__(RegistrationServer)
+        Thread(target=server.__init__, kwargs=options, daemon=True).start()
+        deadline = time.time() + 10
+        # running is set once the server listens, after it loaded its peers
+        while not getattr(server, 'running', False):
+            if time.time() > deadline:
+                raise TimeoutError('rs did not start')
+            time.sleep(0.05)
+        servers.append(server)
+        return server
+    yield start
+    for server in servers:
+        if server.running:
+            server.stop()
@@ -0,0 +1,58 @@
+import os
+
+import pytest
+
+from p2p_di.client import search_index
+from p2p_di.client.rfc_client import Client
+
+RFCS = ['rfc3818.txt', 'rfc3827.txt']
+
+
+@pytest.fixture
+def rfcs_owned_list(tmp_path):
+    path = tmp_path / 'owned.txt'
+    path.write_text('\n'.join(RFCS))
+    return str(path)
+
+
+# clients started one after the other over the same rfc store
+@pytest.fixture
+def start_client(rs_address, tmp_path, rfcs_owned_list):
+    clients = []
+
+    def start(name: str) -> Client:
+        client = Client(name, rfcs_owned_list, rfc_store=str(tmp_path / 'rfc_store'))
+        clients.append(client)
+        return client
+    yield start
+    for client in clients:
+        client.rfc_server.stop()
+
+
+def test_restart_loads_the_search_index(start_client, monkeypatch):
+    first = start_client('first')
+    assert len(first.search_index) == len(RFCS)
+    results = first.search_index.search('rfc3818', 5)
+    assert results[0][0] == 'rfc3818.txt'
+    first.rfc_server.stop()
+
+    def no_indexing(rfc, path):
+        raise AssertionError('{} was indexed again'.format(rfc))
+    monkeypatch.setattr(search_index, 'rfc_terms', no_indexing)
+    second = start_client('second')
+    assert second.search_index.search('rfc3818', 5) == results
+    assert all(second.rfc_index.is_owned(rfc) for rfc in RFCS)
+
+
+def test_restart_keeps_stored_objects(start_client):
+    first = start_client('first')
+    digests = {rfc: first.rfc_index.get_digest(rfc) for rfc in RFCS}
+    first.rfc_server.stop()
+    second = start_client('second')
+    objects = sorted(os.listdir(second.content_store.objects_dir))
+    assert objects == sorted(digests.values())
+    for rfc, digest in digests.items():
+        assert second.content_store.hash_file(
+            second.content_store.object_path(digest)).digest == digest
+        assert os.path.samefile(os.path.join(second.content_store.root, rfc),
+                                second.content_store.object_path(digest))
@@ -0,0 +1,77 @@
+import pytest
+
+from p2p_di.utils import codec
+from p2p_di.utils.message import (Message, MessageType, MethodType,
+                                  StatusCodes, WireFormat)
+
+
+@pytest.mark.parametrize('value', [
+    None, True, False, 0, -1, 2 ** 62, 1.5, '', 'rfc1.txt', 'é' * 300,
+    [], [1, 'a', None], {'127.0.0.1': 65000, 'nested': {'list': [1.0, False]}},
+])
+def test_value_round_trip(value):
+    decoded, offset = codec.decode_value(
+        memoryview(codec.encode_value(value)), 0)
+    assert decoded == value
+    assert offset == len(codec.encode_value(value))
+
+
+def test_bytes_decode_as_views():
+    decoded, _ = codec.decode_value(
+        memoryview(codec.encode_value(b'\x00\xff' * 10)), 0)
+    assert isinstance(decoded, memoryview)
+    assert decoded.tobytes() == b'\x00\xff' * 10
+
+
+def test_tuples_and_sets_decode_as_lists():
+    assert codec.decode_value(memoryview(codec.encode_value((1, 2))), 0)[0] == [1, 2]
+    assert codec.decode_value(memoryview(codec.encode_value({3})), 0)[0] == [3]
+
+
+def test_encoded_values_are_copied_as_is():
+    items = [codec.encode_value(item) for item in ('a', 1)]
+    encoded = codec.encode_list(items, ['a', 1])
+    frame = codec.encode_frame(3, 4, 200, {}, {'peers': encoded})
+    assert codec.decode_frame(frame)[4] == {'peers': ['a', 1]}
+    assert str(encoded) == "['a', 1]"
+
+
+def test_frame_round_trip():
+    frame = codec.encode_frame(1, 6, 0, {'cookie': 'abc', 'port': 65000},
+                               {'rfc': 'rfc1.txt'})
+    assert codec.is_binary(frame)
+    assert codec.decode_frame(frame) == (
+        1, 6, 0, {'cookie': 'abc', 'port': '65000'}, {'rfc': 'rfc1.txt'})
+
+
+@pytest.mark.parametrize('frame', [
+    b'',
+    bytes(codec.HEADER.pack(codec.MAGIC, codec.VERSION + 1, 1, 1, 0, 0)) + codec.NONE,
+    bytes(codec.HEADER.pack(0x27, codec.VERSION, 1, 1, 0, 0)) + codec.NONE,
+    bytes(codec.HEADER.pack(codec.MAGIC, codec.VERSION, 1, 1, 0, 0)) + b'?',
+    bytes(codec.HEADER.pack(codec.MAGIC, codec.VERSION, 1, 1, 0, 0)) + codec.NONE + b'x',
+    bytes(codec.HEADER.pack(codec.MAGIC, codec.VERSION, 1, 1, 0, 0)) + codec.STR + codec.LONG_LEN.pack(10) + b'abc',
+    bytes(codec.HEADER.pack(codec.MAGIC, codec.VERSION, 1, 1, 0, 1)) + codec.SHORT_LEN.pack(10),
+])
+def test_malformed_frames_raise(frame):
+    with pytest.raises(codec.CodecException):
+        codec.decode_frame(frame)
+
+
+# the legacy text format quotes data, so only strings survive it
+@pytest.mark.parametrize('wire_format, data', [
+    (WireFormat.BINARY, {'127.0.0.1': 65000}),
+    (WireFormat.LEGACY, 'rfc1.txt'),
+])
+def test_message_round_trip(wire_format, data):
+    message = Message(MessageType.SERVER_RESPONSE)
+    message.method = MethodType.PQUERY
+    message.status_code = StatusCodes.SUCCESS.value
+    message.headers['cookie'] = 'abc'
+    message.data = data
+    message.wire_format = wire_format
+    encoded = message.to_bytes()
+    assert Message.wire_format_of(encoded) == wire_format
+    assert Message.bytes_to_dict(encoded) == {
+        'cookie': 'abc', 'message_type': 'SERVER_RESPONSE', 'method': 'PQUERY',
+        'status_code': 200, 'data': data}
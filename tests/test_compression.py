@@ -0,0 +1,133 @@
+import hashlib
+import os
+import socket
+from contextlib import suppress
+from threading import Thread
+
+import pytest
+
+from p2p_di.client.content_store import (Content_Info,
+                                         receive_decompressed_chunks)
+from p2p_di.utils.compression import (SUPPORTED_CODECS, Compression_Cache,
+                                      choose_codec, compress_file,
+                                      receive_decompressed,
+                                      receive_decompressed_to_fd)
+from p2p_di.utils.utils import HashMismatchException
+
+DATA = b''.join(b'line %d of an rfc\n' % i for i in range(20000))
+CHUNK_SIZE = 64 * 1024
+
+
+def compressed(tmp_path, codec: str, data: bytes = DATA, offset: int = 0, length: int = None) -> bytes:
+    source = tmp_path / 'source'
+    source.write_bytes(data)
+    compress_file(str(source), str(tmp_path / 'compressed'), codec, offset, length)
+    return (tmp_path / 'compressed').read_bytes()
+
+
+# the receiving end of a connection data is sent on from another thread,
+# so streams larger than the socket buffer do not block; receivers that
+# stop early close the connection on the sender
+@pytest.fixture
+def conn():
+    sockets = []
+
+    def send(sender: socket.socket, data: bytes) -> None:
+        with suppress(OSError), sender:
+            sender.sendall(data)
+
+    def sent(data: bytes) -> socket.socket:
+        sender, receiver = socket.socketpair()
+        sockets.extend((sender, receiver))
+        Thread(target=send, args=(sender, data), daemon=True).start()
+        return receiver
+    yield sent
+    for sock in sockets:
+        sock.close()
+
+
+def test_choose_codec():
+    assert choose_codec(['brotli', 'zlib', 'lzma']) == 'zlib'
+    assert choose_codec(['brotli']) == None
+    assert choose_codec(None) == None
+
+
+@pytest.mark.parametrize('codec', SUPPORTED_CODECS)
+def test_round_trip(tmp_path, conn, codec):
+    data = compressed(tmp_path, codec)
+    assert len(data) < len(DATA)
+    fd = os.open(tmp_path / 'out', os.O_RDWR | os.O_CREAT)
+    try:
+        receive_decompressed_to_fd(conn(data), len(data), fd, codec, len(DATA), 10)
+        assert os.pread(fd, len(DATA), 10) == DATA
+    finally:
+        os.close(fd)
+
+
+@pytest.mark.parametrize('codec', SUPPORTED_CODECS)
+def test_range_round_trip(tmp_path, conn, codec):
+    data = compressed(tmp_path, codec, offset=1000, length=50000)
+    pieces = receive_decompressed(conn(data), len(data), codec, 50000, 4096)
+    assert b''.join(pieces) == DATA[1000:51000]
+
+
+# a stream that inflates far past its advertised size is stopped after at
+# most one chunk more than that size was produced
+@pytest.mark.parametrize('codec', SUPPORTED_CODECS)
+def test_bomb_is_stopped(tmp_path, conn, codec):
+    data = compressed(tmp_path, codec, bytes(64 * 1024 * 1024))
+    produced = 0
+    with pytest.raises(ValueError):
+        for piece in receive_decompressed(conn(data), len(data), codec, 1000, 4096):
+            assert len(piece) <= 4096
+            produced += len(piece)
+    assert produced <= 1000
+
+
+@pytest.mark.parametrize('codec', SUPPORTED_CODECS)
+@pytest.mark.parametrize('size_change, data_change', [
+    (1, lambda data: data), (-1, lambda data: data),
+    (0, lambda data: data[:-10]), (0, lambda data: data + b'trailing'),
+])
+def test_bad_streams_raise(tmp_path, conn, codec, size_change, data_change):
+    data = data_change(compressed(tmp_path, codec))
+    with pytest.raises(ValueError):
+        for _ in receive_decompressed(conn(data), len(data), codec, len(DATA) + size_change):
+            pass
+
+
+def test_cache(tmp_path):
+    source = tmp_path / 'rfc1.txt'
+    source.write_bytes(DATA)
+    cache = Compression_Cache(str(tmp_path / 'cache'))
+    path, size = cache.get(str(source), 'zlib')
+    assert size == os.path.getsize(path) < len(DATA)
+    assert cache.get(str(source), 'zlib') == (path, size)
+    range_path, _ = cache.get(str(source), 'zlib', offset=100, length=30000)
+    assert range_path != path
+    source.write_bytes(os.urandom(4096))
+    assert cache.get(str(source), 'zlib') == None
+    assert not os.path.exists(path)
+
+
+# compressed ranges are checked against the manifest chunk by chunk
+@pytest.mark.parametrize('codec', SUPPORTED_CODECS)
+@pytest.mark.parametrize('offset, length', [(0, len(DATA)), (CHUNK_SIZE, 2 * CHUNK_SIZE)])
+def test_decompressed_chunks(tmp_path, conn, codec, offset, length):
+    info = Content_Info(hashlib.sha256(DATA).hexdigest(), len(DATA), CHUNK_SIZE,
+                        [hashlib.sha256(DATA[i:i + CHUNK_SIZE]).hexdigest()
+                         for i in range(0, len(DATA), CHUNK_SIZE)])
+    fd = os.open(tmp_path / 'out', os.O_RDWR | os.O_CREAT)
+    try:
+        data = compressed(tmp_path, codec, offset=offset, length=length)
+        receive_decompressed_chunks(conn(data), len(data), fd, codec, offset, length, info)
+        assert os.pread(fd, length, offset) == DATA[offset:offset + length]
+        changed = bytearray(DATA)
+        changed[offset + length // 2] ^= 1
+        corrupt = compressed(tmp_path, codec, bytes(changed), offset, length)
+        with pytest.raises(HashMismatchException):
+            receive_decompressed_chunks(conn(corrupt), len(corrupt), fd, codec, offset, length, info)
+        with pytest.raises(HashMismatchException):
+            receive_decompressed_chunks(conn(data), len(data), fd, codec, offset + 1, length, info)
+    finally:
+        os.close(fd)
@@ -0,0 +1,115 @@
+import hashlib
+import os
+import socket
+
+import pytest
+
+from p2p_di.client.content_store import (Content_Info, Content_Store,
+                                         receive_chunks)
+from p2p_di.utils.utils import HashMismatchException
+
+CHUNK_SIZE = 1024
+DATA = bytes(range(256)) * 20 + b'tail'
+
+
+def write(path, data: bytes) -> str:
+    with open(path, 'wb') as file:
+        file.write(data)
+    return str(path)
+
+
+@pytest.fixture
+def store(tmp_path):
+    return Content_Store(str(tmp_path / 'rfc_store'), CHUNK_SIZE)
+
+
+# the receiving end of a connection data was already sent on
+@pytest.fixture
+def conn():
+    sender, receiver = socket.socketpair()
+
+    def sent(data: bytes) -> socket.socket:
+        sender.sendall(data)
+        sender.close()
+        return receiver
+    yield sent
+    sender.close()
+    receiver.close()
+
+
+def test_hash_file(store, tmp_path):
+    info = store.hash_file(write(tmp_path / 'rfc', DATA))
+    assert info.digest == hashlib.sha256(DATA).hexdigest()
+    assert info.size == len(DATA)
+    assert info.chunks == [hashlib.sha256(DATA[i:i + CHUNK_SIZE]).hexdigest()
+                           for i in range(0, len(DATA), CHUNK_SIZE)]
+    empty = store.hash_file(write(tmp_path / 'empty', b''))
+    assert empty.size == 0 and empty.chunks == [hashlib.sha256(b'').hexdigest()]
+
+
+def test_identical_content_is_stored_once(store, tmp_path):
+    first = store.add('rfc1.txt', write(tmp_path / 'a', DATA))
+    second = store.add('rfc2.txt', write(tmp_path / 'b', DATA))
+    assert first is second
+    assert os.listdir(store.objects_dir) == [first.digest]
+    assert not os.path.exists(tmp_path / 'b')
+    for name in ('rfc1.txt', 'rfc2.txt'):
+        with open(os.path.join(store.root, name), 'rb') as file:
+            assert file.read() == DATA
+        assert store.info_for(name) is first
+    assert store.add_existing('rfc3.txt', first.digest) is first
+    assert store.has(first.digest)
+
+
+def test_add_relinks_a_name_to_new_content(store, tmp_path):
+    store.add('rfc1.txt', write(tmp_path / 'a', DATA))
+    info = store.add('rfc1.txt', write(tmp_path / 'b', b'other'))
+    with open(os.path.join(store.root, 'rfc1.txt'), 'rb') as file:
+        assert file.read() == b'other'
+    assert store.info_for('rfc1.txt') is info
+
+
+def test_add_rejects_the_wrong_digest(store, tmp_path):
+    path = write(tmp_path / 'a', DATA)
+    with pytest.raises(HashMismatchException):
+        store.add('rfc1.txt', path, '00' * 32)
+    assert os.path.exists(path)
+    assert store.info_for('rfc1.txt') == None
+    assert os.listdir(store.objects_dir) == []
+
+
+def test_manifest_round_trip(store, tmp_path):
+    info = store.hash_file(write(tmp_path / 'rfc', DATA))
+    copy = Content_Info.from_dict(info.size, info.to_dict())
+    assert (copy.digest, copy.size, copy.chunk_size, copy.chunks) == (
+        info.digest, info.size, info.chunk_size, info.chunks)
+    with pytest.raises(HashMismatchException):
+        Content_Info.from_dict(info.size + CHUNK_SIZE, info.to_dict())
+
+
+@pytest.mark.parametrize('offset, length', [
+    (0, len(DATA)), (CHUNK_SIZE, 2 * CHUNK_SIZE), (4 * CHUNK_SIZE, len(DATA) - 4 * CHUNK_SIZE),
+])
+def test_receive_chunks(store, tmp_path, conn, offset, length):
+    info = store.hash_file(write(tmp_path / 'rfc', DATA))
+    fd = os.open(tmp_path / 'out', os.O_RDWR | os.O_CREAT)
+    try:
+        receive_chunks(conn(DATA[offset:offset + length]), fd, offset, length, info)
+        assert os.pread(fd, length, offset) == DATA[offset:offset + length]
+    finally:
+        os.close(fd)
+
+
+@pytest.mark.parametrize('offset, length, data', [
+    (0, len(DATA), DATA[:-1] + b'!'),
+    (1, CHUNK_SIZE, DATA[1:CHUNK_SIZE + 1]),
+    (0, CHUNK_SIZE + 1, DATA[:CHUNK_SIZE + 1]),
+])
+def test_receive_chunks_rejects_bad_data(store, tmp_path, conn, offset, length, data):
+    info = store.hash_file(write(tmp_path / 'rfc', DATA))
+    fd = os.open(tmp_path / 'out', os.O_RDWR | os.O_CREAT)
+    try:
+        with pytest.raises(HashMismatchException):
+            receive_chunks(conn(data), fd, offset, length, info)
+    finally:
+        os.close(fd)
@@ -0,0 +1,42 @@
+import time
+
+from p2p_di.client.rfc_client import Client
+
+
+# the rs's own sweep first runs DEFAULT_UPDATE_INTERVAL seconds after it
+# starts, these tests call update_loop themselves before that
+def test_leave_is_not_an_expiry(start_rs):
+    rs = start_rs(ttl=0.5)
+    client = Client('leaves')
+    try:
+        client.register()
+        client.leave_rs()
+        time.sleep(0.6)
+        assert rs.update_loop(0) == []
+        assert client.cookie not in rs.scheduled
+
+        # coming back schedules the peer again, once
+        client.register()
+        assert rs.get_active_peers() == ['{}:{}'.format(client.rfc_server.host, client.rfc_server.port)]
+        time.sleep(0.6)
+        assert rs.update_loop(0) == [rs.peers[client.cookie]]
+        assert rs.expiry_heap == [] and rs.scheduled == {}
+        assert rs.get_active_peers() == []
+    finally:
+        client.rfc_server.stop()
+
+
+def test_keep_alive_moves_the_expiry(start_rs):
+    rs = start_rs(ttl=0.5)
+    client = Client('stays')
+    try:
+        client.register()
+        time.sleep(0.3)
+        client.stay_alive()
+        time.sleep(0.3)
+        assert rs.update_loop(0) == []
+        assert len(rs.expiry_heap) == 1 and client.cookie in rs.scheduled
+        time.sleep(0.3)
+        assert rs.update_loop(0) == [rs.peers[client.cookie]]
+    finally:
+        client.rfc_server.stop()
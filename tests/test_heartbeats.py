@@ -0,0 +1,18 @@
+from p2p_di.client.rfc_client import Client
+from p2p_di.utils.utils import DEFAULT_RS_PORT, HEARTBEAT_ACK, HEARTBEAT_REJECT
+
+
+def test_heartbeats_follow_the_rs_port(start_rs, rs_address):
+    assert rs_address[1] != DEFAULT_RS_PORT
+    rs = start_rs()
+    assert rs.heartbeat_port == rs_address[1]
+    client = Client('heartbeats', udp_heartbeats=True)
+    try:
+        client.register()
+        assert client.cookie in rs.peers
+        last_active = rs.peers[client.cookie].last_active
+        assert client.rfc_server.send_heartbeat(client.cookie) == HEARTBEAT_ACK
+        assert rs.peers[client.cookie].last_active >= last_active
+        assert client.rfc_server.send_heartbeat('00' * 16) == HEARTBEAT_REJECT
+    finally:
+        client.rfc_server.stop()
@@ -0,0 +1,83 @@
+from collections import deque
+from threading import Lock
+from types import SimpleNamespace
+
+from p2p_di.client.rfc_client import RFC_Index
+from p2p_di.server.rfc_server import RFC_Server
+
+OWNER = ('127.0.0.2', 65000)
+
+
+# what a peer would send for an RFC_QUERY with since and epoch
+def query(index: RFC_Index, tmp_path, since: int, epoch: str) -> dict:
+    server = SimpleNamespace(lock=Lock(), client_rfc_index=index, host=OWNER[0], port=OWNER[1],
+                             log_filename=str(tmp_path / 'rfc_server.txt'))
+    response = RFC_Server.send_rfc_index(
+        server, {'data': {'since': since, 'epoch': epoch}}, ('127.0.0.3', 1))
+    assert response.status_code == 200
+    return response.data
+
+
+def test_changes_since():
+    index = RFC_Index()
+    assert index.changes_since(0) == set()
+    index.set_owned('rfc1.txt')
+    index.set_owned('rfc2.txt', 'ab' * 32)
+    index.set_owned('rfc1.txt')
+    assert index.version == 2
+    assert index.changes_since(0) == {'rfc1.txt', 'rfc2.txt'}
+    assert index.changes_since(1) == {'rfc2.txt'}
+    assert index.changes_since(2) == set()
+    assert index.changes_since(-1) == None
+
+
+def test_changes_since_past_the_log():
+    index = RFC_Index()
+    index.change_log = deque(maxlen=2)
+    for i in range(4):
+        index.set_owned('rfc{}.txt'.format(i))
+    assert index.changes_since(2) == {'rfc2.txt', 'rfc3.txt'}
+    assert index.changes_since(1) == None
+
+
+def test_merge_records_only_new_facts():
+    index = RFC_Index()
+    index.merge_index(RFC_Index.from_dict({'rfc1.txt': {'10.0.0.1': 1}}))
+    index.merge_index(RFC_Index.from_dict({'rfc1.txt': {'10.0.0.1': 1}}))
+    assert index.version == 1
+    index.merge_index(RFC_Index.from_dict(
+        {'rfc1.txt': {'10.0.0.2': 2}}, {'rfc1.txt': 'cd' * 32}))
+    assert index.version == 2
+    assert index.get_owners('rfc1.txt') == {'10.0.0.1': 1, '10.0.0.2': 2}
+    assert index.get_digest('rfc1.txt') == 'cd' * 32
+
+
+def test_delta_round_trip(tmp_path):
+    served = RFC_Index()
+    served.set_owned('rfc1.txt', 'ab' * 32)
+    served.merge_index(RFC_Index.from_dict({'rfc2.txt': {'10.0.0.1': 1}}))
+    mirror = RFC_Index()
+
+    first = query(served, tmp_path, 0, None)
+    assert first['full']
+    mirror.merge_index(RFC_Index.from_dict(first['rfcs'], first['digests']))
+
+    served.merge_index(RFC_Index.from_dict({'rfc3.txt': {'10.0.0.1': 1}}))
+    served.merge_index(RFC_Index.from_dict({'rfc2.txt': {'10.0.0.4': 4}}))
+    delta = query(served, tmp_path, first['version'], first['epoch'])
+    assert not delta['full']
+    assert set(delta['rfcs']) == {'rfc2.txt', 'rfc3.txt'}
+    mirror.merge_index(RFC_Index.from_dict(delta['rfcs'], delta['digests']))
+
+    assert mirror.to_dict() == served.to_dict(OWNER)
+    assert mirror.to_digests() == served.to_digests()
+    assert query(served, tmp_path, delta['version'], delta['epoch'])['rfcs'] == {}
+
+
+def test_other_epoch_gets_the_full_index(tmp_path):
+    served = RFC_Index()
+    served.set_owned('rfc1.txt')
+    served.set_owned('rfc2.txt')
+    reply = query(served, tmp_path, 1, 'an epoch of an older index')
+    assert reply['full']
+    assert set(reply['rfcs']) == {'rfc1.txt', 'rfc2.txt'}
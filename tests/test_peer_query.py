@@ -0,0 +1,82 @@
+import pytest
+
+from p2p_di.server.rs import Peer_Snapshot, RegistrationServer
+from p2p_di.utils import codec
+from p2p_di.utils.utils import DEFAULT_MAX_PAGE_SIZE, BadFormatException
+
+
+def listed(i: int) -> tuple:
+    address = '127.0.0.{}:{}'.format(i % 250 + 2, 60000 + i)
+    return address, bytes(codec.encode_value(address))
+
+
+def snapshot_of(count: int) -> Peer_Snapshot:
+    return Peer_Snapshot(0).apply(1, {'cookie{}'.format(i): listed(i) for i in range(count)})
+
+
+# what a client decodes from the reply
+def wire(value):
+    return codec.decode_frame(codec.encode_frame(3, 4, 200, {}, value))[4]
+
+
+@pytest.fixture
+def rs():
+    # select_peers only reads its options, no server needs to run
+    return RegistrationServer.__new__(RegistrationServer)
+
+
+def test_snapshot_apply():
+    snapshot = snapshot_of(4)
+    changed = snapshot.apply(2, {'cookie1': None, 'cookie2': listed(20), 'cookie9': listed(9)})
+    assert snapshot.cookies == ['cookie0', 'cookie1', 'cookie2', 'cookie3']
+    assert sorted(changed.cookies) == ['cookie0', 'cookie2', 'cookie3', 'cookie9']
+    for cookie, position in changed.positions.items():
+        assert changed.cookies[position] == cookie
+    assert changed.addresses[changed.positions['cookie2']] == listed(20)[0]
+    assert wire(changed.data) == changed.addresses
+
+
+def test_no_options_sends_every_peer(rs):
+    snapshot = snapshot_of(5)
+    assert wire(rs.select_peers(snapshot, None, 'cookie0')) == snapshot.addresses
+
+
+def test_pages_cover_every_other_peer_once(rs):
+    snapshot = snapshot_of(23)
+    options = {'page_size': 5, 'exclude_self': True}
+    peers = []
+    while True:
+        reply = wire(rs.select_peers(snapshot, options, 'cookie7'))
+        assert reply['total'] == 22
+        assert len(reply['peers']) == 5 or reply['cursor'] == None
+        peers += reply['peers']
+        if reply['cursor'] == None:
+            break
+        options['cursor'] = reply['cursor']
+    assert peers == [address for address in snapshot.addresses
+                     if address != listed(7)[0]]
+
+
+def test_sample(rs):
+    snapshot = snapshot_of(50)
+    reply = wire(rs.select_peers(snapshot, {'sample': 10, 'exclude_self': True}, 'cookie3'))
+    assert len(reply['peers']) == len(set(reply['peers'])) == 10
+    assert listed(3)[0] not in reply['peers']
+    assert reply['cursor'] == None
+    assert len(wire(rs.select_peers(snapshot, {'sample': 80}, 'cookie3'))['peers']) == 50
+
+
+def test_sizes_are_capped(rs):
+    snapshot = snapshot_of(DEFAULT_MAX_PAGE_SIZE + 5)
+    reply = wire(rs.select_peers(snapshot, {'page_size': DEFAULT_MAX_PAGE_SIZE + 5}, None))
+    assert len(reply['peers']) == DEFAULT_MAX_PAGE_SIZE
+    assert reply['cursor'] != None
+
+
+@pytest.mark.parametrize('options', [
+    {'page_size': -1}, {'sample': -1}, {'page_size': 5, 'cursor': 'not a cursor'},
+    {'page_size': 5, 'cursor': '-a'},
+])
+def test_bad_options_raise(rs, options):
+    with pytest.raises(BadFormatException):
+        rs.select_peers(snapshot_of(3), options, None)
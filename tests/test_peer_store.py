@@ -0,0 +1,97 @@
+import pytest
+
+from p2p_di.client.rfc_client import Client
+from p2p_di.server.peer_store import (SQLite_Peer_Store, TinyDB_Peer_Store,
+                                      Write_Behind_Store)
+from p2p_di.utils.utils import PEER_STORE_SQLITE
+
+
+def peer(cookie, port=7000):
+    return {'cookie': cookie, 'name': 'owner', 'hostname': '127.0.0.1', 'port': port,
+            'last_active': 1.0, 'registration_number': 1}
+
+
+@pytest.mark.parametrize('store_class', [SQLite_Peer_Store, TinyDB_Peer_Store])
+def test_changes_are_written_behind(tmp_path, store_class):
+    store = store_class(str(tmp_path / 'peers'))
+    peers_db = Write_Behind_Store(store, flush_interval=60, flush_threshold=1000)
+    peers_db.insert(peer('a'))
+    peers_db.insert(peer('b'))
+    peers_db.update('a', {'port': 7001})
+    peers_db.update('b', {'last_active': 2.0})
+    assert peers_db.dirty_count() == 2 and store.all() == []
+
+    peers_db.flush()
+    assert peers_db.dirty_count() == 0
+    assert sorted(store.all(), key=lambda document: document['cookie']) == [
+        dict(peer('a'), port=7001), dict(peer('b'), last_active=2.0)]
+
+    # changes to stored peers are merged per cookie into one update
+    peers_db.update('a', {'port': 7002})
+    peers_db.update('a', {'registration_number': 2})
+    assert peers_db.dirty_count() == 1
+    peers_db.close()
+
+    store = store_class(str(tmp_path / 'peers'))
+    assert sorted(store.all(), key=lambda document: document['cookie']) == [
+        dict(peer('a'), port=7002, registration_number=2), dict(peer('b'), last_active=2.0)]
+    store.close()
+
+
+def test_threshold_asks_for_a_flush(tmp_path):
+    peers_db = Write_Behind_Store(SQLite_Peer_Store(
+        str(tmp_path / 'peers.db')), flush_interval=60, flush_threshold=64, stripes=4)
+    for i in range(64):
+        peers_db.insert(peer(str(i)))
+    assert peers_db.flush_needed.is_set()
+    peers_db.close()
+
+
+def test_failed_flush_is_retried(tmp_path):
+    store = SQLite_Peer_Store(str(tmp_path / 'peers.db'))
+    peers_db = Write_Behind_Store(store, flush_interval=60)
+    peers_db.insert(peer('a'))
+    write_batch = store.write_batch
+
+    def fail(inserts, updates):
+        raise OSError('disk full')
+    store.write_batch = fail
+    with pytest.raises(OSError):
+        peers_db.flush()
+    # a change made meanwhile wins over the failed batch
+    peers_db.update('a', {'port': 7001})
+    store.write_batch = write_batch
+    assert peers_db.all() == [dict(peer('a'), port=7001)]
+    peers_db.close()
+
+
+# peers registered before a restart are known again afterwards, inactive
+# until they register with their cookie
+def test_warm_restart_restores_peers(start_rs):
+    rs = start_rs(peer_store=PEER_STORE_SQLITE, flush_interval=60)
+    clients = [Client('restart_{}'.format(i)) for i in range(3)]
+    try:
+        for client in clients:
+            client.register()
+        cookies = {client.cookie for client in clients}
+        assert set(rs.peers) == cookies
+        # nothing is written until the flush, stop() flushes what is left
+        assert rs.peers_db.dirty_count() == 3
+        rs.stop()
+
+        rs = start_rs(peer_store=PEER_STORE_SQLITE, clean=False)
+        assert set(rs.peers) == cookies
+        for client in clients:
+            restored = rs.peers[client.cookie]
+            assert restored.name == client.name
+            assert restored.port == client.rfc_server.port
+            assert not restored.is_active()
+        assert rs.get_active_peers() == []
+
+        client = clients[0]
+        assert client.rfc_server.register(client.name, client.cookie) == client.cookie
+        assert rs.peers[client.cookie].registration_number == 2
+        assert rs.get_active_peers() == ['{}:{}'.format(client.rfc_server.host, client.rfc_server.port)]
+    finally:
+        for client in clients:
+            client.rfc_server.stop()
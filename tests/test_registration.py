@@ -0,0 +1,21 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from p2p_di.client.rfc_client import Client
+
+
+def test_concurrent_registrations(start_rs):
+    rs = start_rs(mode='asyncio')
+    client = Client('registers')
+    try:
+        with ThreadPoolExecutor(16) as executor:
+            cookies = list(executor.map(
+                lambda _: client.rfc_server.register(client.name), range(16)))
+            assert len(set(cookies)) == 16
+            cookie = cookies[0]
+            again = list(executor.map(
+                lambda _: client.rfc_server.register(client.name, cookie), range(32)))
+        assert again == [cookie] * 32
+        assert rs.peers[cookie].registration_number == 33
+        assert len(rs.peers) == 16
+    finally:
+        client.rfc_server.stop()